@@ -0,0 +1,68 @@
+"""
+Затримка інвалідації кешів (db.notify) під навантаженням на локальній БД:
+паралельні записувачі надсилають події, InvalidationListener їх отримує.
+Запуск з кореня проєкту (потрібен .env з DB_DSN):
+    python -m benchmarks.cache_invalidation [подій] [паралельних записувачів]
+"""
+import asyncio
+import logging
+import statistics
+import sys
+import time
+
+import asyncpg
+
+from config import DB_DSN, CACHE_LISTENER_CHECK_INTERVAL, CACHE_LISTENER_MAX_BACKOFF
+from db.notify import InvalidationListener, INVALIDATION_CHANNEL, publish
+
+# Тип подій заміру: кеші бота їх не обробляють
+EVENT = "bench"
+
+
+async def benchmark(events: int, writers: int):
+    """Затримка інвалідації: events подій від writers паралельних підключень"""
+    pool = await asyncpg.create_pool(dsn=DB_DSN, min_size=writers, max_size=writers)
+    received = asyncio.Event()
+    lags = []
+
+    def on_event(key: str):
+        # Ключ події - час відправки, мс
+        lags.append(time.time() * 1000 - float(key))
+        if len(lags) >= events:
+            received.set()
+
+    listener = InvalidationListener(DB_DSN, INVALIDATION_CHANNEL, CACHE_LISTENER_CHECK_INTERVAL, CACHE_LISTENER_MAX_BACKOFF)
+    listener.on(EVENT, on_event)
+    await listener.start()
+    while not listener.connected:
+        await asyncio.sleep(0.05)
+
+    async def writer(count: int):
+        async with pool.acquire() as conn:
+            for _ in range(count):
+                await publish(conn, EVENT, f"{time.time() * 1000:.3f}")
+
+    started = time.monotonic()
+    await asyncio.gather(*(writer(len(range(i, events, writers))) for i in range(writers)))
+    try:
+        await asyncio.wait_for(received.wait(), 10)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.monotonic() - started
+    await listener.stop()
+    await pool.close()
+
+    lags.sort()
+    print(f"Подій: {events}, записувачів: {writers}, отримано: {len(lags)} за {elapsed:.2f}с "
+          f"({len(lags) / elapsed:.0f}/с)")
+    if lags:
+        print(f"Затримка, мс: середня {statistics.fmean(lags):.1f}, p50 {lags[len(lags) // 2]:.1f}, "
+              f"p95 {lags[int(len(lags) * 0.95)]:.1f}, p99 {lags[int(len(lags) * 0.99)]:.1f}, max {lags[-1]:.1f}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(benchmark(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 16,
+    ))
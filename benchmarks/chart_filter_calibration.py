@@ -0,0 +1,47 @@
+"""
+Калібрування локального фільтра не-графіків (bot.chart_filter) на розміченому наборі.
+Запуск з кореня проєкту (потрібен .env):
+    python -m benchmarks.chart_filter_calibration <каталог>
+де <каталог>/chart - графіки, <каталог>/other - все інше. Друкує precision/recall
+відхилення не-графіків для кількох порогів CHART_FILTER_THRESHOLD і час оцінки.
+"""
+import os
+import sys
+import time
+
+from PIL import Image
+
+from bot.chart_filter import chart_score
+
+
+def evaluate(directory: str, thresholds=(0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5)):
+    """Precision / recall відхилення не-графіків на розміченому наборі"""
+    scores = {"chart": [], "other": []}
+    elapsed = 0.0
+    for label in scores:
+        folder = os.path.join(directory, label)
+        for name in sorted(os.listdir(folder)):
+            with Image.open(os.path.join(folder, name)) as image:
+                image.load()
+                started = time.perf_counter()
+                scores[label].append(chart_score(image))
+                elapsed += time.perf_counter() - started
+
+    count = len(scores["chart"]) + len(scores["other"])
+    print(f"Зображень: {len(scores['chart'])} графіків, {len(scores['other'])} інших; "
+          f"{elapsed / max(1, count) * 1000:.1f} мс на зображення")
+    for threshold in thresholds:
+        rejected_other = sum(score < threshold for score in scores["other"])
+        rejected_charts = sum(score < threshold for score in scores["chart"])
+        rejected = rejected_other + rejected_charts
+        precision = rejected_other / rejected if rejected else 1.0
+        recall = rejected_other / len(scores["other"]) if scores["other"] else 0.0
+        print(f"поріг {threshold:.2f}: precision {precision:.3f}, recall {recall:.3f}, "
+              f"відхилено графіків {rejected_charts}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Використання: python -m benchmarks.chart_filter_calibration <каталог з chart/ та other/>")
+        sys.exit(1)
+    evaluate(sys.argv[1])
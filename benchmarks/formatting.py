@@ -0,0 +1,71 @@
+"""
+Вартість рендерингу й санітайзера bot.formatting на типовому аналізі
+та час санітайзера на патологічних входах. Запуск з кореня проєкту (потрібен .env):
+    python -m benchmarks.formatting [повторів]
+"""
+import sys
+import timeit
+
+from bot.formatting import html_to_entities, render_analysis, sanitize_html
+
+# Поля типового аналізу; у режимі html модель повертає той самий текст, що й render_analysis
+FIELDS = {
+    "is_chart": True,
+    "instrument": "BTC/USDT",
+    "timeframe": "H4",
+    "direction": "Long",
+    "entry": "61 000 - 61 500",
+    "stop_loss": "59 800",
+    "risk_reward": "1:3.5",
+    "leverage": "до 5x",
+    "targets": ["63 000", "64 500", "66 000"],
+    "arguments": (
+        "Ціна сформувала `бичачий прапор` біля сильного рівня підтримки `61 000`. "
+        "RSI показує приховану бичачу дивергенцію, обсяги на відскоках зростають."
+    ),
+    "alternative": "Закріплення нижче `59 800` скасує ідею; далі можливе падіння до `57 000`.",
+}
+
+# Помилки розмітки, які трапляються у відповідях моделі
+BROKEN = (
+    ("<b>Інструмент:</b>", "<b>Інструмент:</b</b>"),
+    ("<code>59 800</code>", "<code>59 800"),
+    ("</blockquote>\n\n<blockquote expandable><b>⚠️", "\n\n<blockquote expandable><b>⚠️"),
+    ("RSI показує", "RSI < 30 & показує"),
+)
+
+# Патологічні входи: час має рости лінійно з довжиною
+ADVERSARIAL = (
+    ("\"<\" * 200k", "<" * 200_000),
+    ("\"<b \" * 100k", "<b " * 100_000),
+    ("\"<b>\" * 50k", "<b>" * 50_000),
+    ("\"</b\" * 50k", "</b" * 50_000),
+    ("перехресне вкладення 3k", "<b>" * 3000 + "<i>" * 3000 + "</b>" * 3000),
+)
+
+
+def microseconds(function, runs: int) -> float:
+    return timeit.timeit(function, number=runs) / runs * 1e6
+
+
+def benchmark(runs: int):
+    """Час на один аналіз: structured (рендеринг) проти html (санітайзер відповіді моделі)"""
+    model_html = render_analysis(FIELDS)
+    broken_html = model_html
+    for valid, broken in BROKEN:
+        broken_html = broken_html.replace(valid, broken, 1)
+    print(f"Аналіз: {len(model_html)} символів, повторів: {runs}")
+    cases = (
+        ("structured: render_analysis", lambda: render_analysis(FIELDS)),
+        ("html: sanitize_html", lambda: sanitize_html(model_html)),
+        ("html: sanitize_html (зламаний HTML)", lambda: sanitize_html(broken_html)),
+        ("обидва: html_to_entities", lambda: html_to_entities(model_html)),
+    )
+    for name, function in cases:
+        print(f"{name:40} {microseconds(function, runs):8.1f} мкс")
+    for name, text in ADVERSARIAL:
+        print(f"sanitize_html, {name:27} {microseconds(lambda: sanitize_html(text), 1) / 1000:8.1f} мс")
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
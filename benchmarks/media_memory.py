@@ -0,0 +1,104 @@
+"""
+Пік RSS під N одночасних аналізів: старий шлях (BytesIO -> base64 -> f-string)
+проти буферів з пулу та бюджету пам'яті bot.media. Запуск з кореня проєкту (потрібен .env):
+    python -m benchmarks.media_memory [одночасних аналізів] [розмір файлу, МБ]
+Кожен режим виконується в окремому процесі: ru_maxrss не скидається, тож режими не змішуються.
+resource є лише в POSIX-системах.
+"""
+import asyncio
+import base64
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from bot.media import download_to_buffer, encode_data_url, estimate_peak_memory, image_buffers, image_memory
+
+# Скільки аналіз тримає data URL (імітація запиту до OpenAI), секунди
+HOLD = 0.3
+
+
+class BenchmarkBot:
+    """Імітація bot.download_file: файл надходить шматками, як з aiohttp"""
+
+    def __init__(self, data: bytes, chunk: int = 64 * 1024):
+        self.data = data
+        self.chunk = chunk
+
+    async def download_file(self, file_path, destination, seek=True):
+        for start in range(0, len(self.data), self.chunk):
+            destination.write(self.data[start:start + self.chunk])
+            await asyncio.sleep(0)
+
+
+async def legacy_analysis(bot: BenchmarkBot) -> int:
+    """Шлях до буферів з пулу: BytesIO, read(), b64encode, decode і f-string"""
+    photo_bytes = io.BytesIO()
+    await bot.download_file("chart", photo_bytes)
+    photo_bytes.seek(0)
+    base64_image = base64.b64encode(photo_bytes.read()).decode("utf-8")
+    image_url = f"data:image/jpeg;base64,{base64_image}"
+    await asyncio.sleep(HOLD)
+    return len(image_url)
+
+
+async def pooled_analysis(bot: BenchmarkBot) -> int:
+    """Поточний шлях: резерв у бюджеті, буфер з пулу, data URL одним кодуванням"""
+    size = len(bot.data)
+    memory = estimate_peak_memory(size)
+    await image_memory.acquire(memory)
+    try:
+        buffer, data = await download_to_buffer(bot, "chart", size, image_buffers)
+        image_url = encode_data_url(data, "image/jpeg")
+        data.release()
+        image_buffers.release(buffer)
+        await asyncio.sleep(HOLD)
+        return len(image_url)
+    finally:
+        await image_memory.release(memory)
+
+
+def max_rss() -> int:
+    """Пік RSS процесу, байти (ru_maxrss у Linux - кілобайти)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(mode: str, concurrency: int, size: int):
+    """Один режим у поточному процесі"""
+    bot = BenchmarkBot(os.urandom(size))
+    analysis = legacy_analysis if mode == "legacy" else pooled_analysis
+
+    async def run_all():
+        await asyncio.gather(*(analysis(bot) for _ in range(concurrency)))
+
+    before = max_rss()
+    started = time.monotonic()
+    asyncio.run(run_all())
+    elapsed = time.monotonic() - started
+    print(f"{mode:7} пік RSS +{(max_rss() - before) / 2 ** 20:.0f} МБ за {elapsed:.2f}с"
+          + (f" (бюджет файлів {image_memory.limit / 2 ** 20:.0f} МБ, пік резерву {image_memory.peak / 2 ** 20:.0f} МБ)"
+             if mode == "pooled" else ""))
+
+
+def benchmark(concurrency: int, size_mb: float):
+    """Пік RSS під concurrency одночасних аналізів файлу size_mb МБ - для обох шляхів"""
+    size = int(size_mb * 2 ** 20)
+    print(f"Аналізів одночасно: {concurrency}, файл {size_mb} МБ")
+    for mode in ("legacy", "pooled"):
+        result = subprocess.run(
+            [sys.executable, "-m", "benchmarks.media_memory", "--run", mode, str(concurrency), str(size)],
+            capture_output=True, text=True, check=True,
+        )
+        print(result.stdout.strip())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":
+        run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        benchmark(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 32,
+            float(sys.argv[2]) if len(sys.argv) > 2 else 4,
+        )
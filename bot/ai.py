@@ -1,204 +1,445 @@
-import openai
-from config import OPENAI_API_KEY
+from config import (
+    ANALYSIS_OUTPUT_MODE,
+    ROUTE_SUBSCRIBER_MODEL, ROUTE_SUBSCRIBER_MAX_TOKENS, ROUTE_SUBSCRIBER_DETAIL,
+    ROUTE_TRIAL_MODEL, ROUTE_TRIAL_MAX_TOKENS, ROUTE_TRIAL_DETAIL,
+    ROUTE_DEGRADED_MODEL, ROUTE_DEGRADED_MAX_TOKENS, ROUTE_DEGRADED_DETAIL,
+    ROUTE_DEGRADE_QUEUE_DEPTH, ROUTE_DEGRADE_LATENCY, ROUTE_DEGRADE_SUBSCRIBERS,
+)
+from bot.media import encode_data_url
+from bot.formatting import render_analysis, sanitize_html
+from bot.openai_client import openai_client, CircuitOpen, is_retryable
+from bot.prompts import prompt_registry, PromptVersion, SYSTEM_PROMPT, USER_INSTRUCTION
+import json
 import logging
-import re
+import time
 
-# Ініціалізуємо асинхронний клієнт OpenAI
-client = None
+ANALYSIS_SCHEMA = {
+    "name": "chart_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "is_chart": {"type": "boolean"},
+            "instrument": {"type": "string"},
+            "timeframe": {"type": "string"},
+            "direction": {"type": "string", "enum": ["Long", "Short"]},
+            "entry": {"type": "string"},
+            "stop_loss": {"type": "string"},
+            "risk_reward": {"type": "string"},
+            "leverage": {"type": "string"},
+            "targets": {"type": "array", "items": {"type": "string"}},
+            "arguments": {"type": "string"},
+            "alternative": {"type": "string"},
+        },
+        "required": [
+            "is_chart", "instrument", "timeframe", "direction", "entry", "stop_loss",
+            "risk_reward", "leverage", "targets", "arguments", "alternative",
+        ],
+        "additionalProperties": False,
+    },
+}
 
-def get_openai_client():
-    global client
-    if client is None:
-        try:
-            client = openai.AsyncOpenAI(
-                api_key=OPENAI_API_KEY,
-                timeout=60.0
-            )
-        except Exception as e:
-            logging.error(f"Помилка ініціалізації OpenAI клієнта: {e}")
-            raise
-    return client
+REFUSAL_MESSAGE = """⚠️ <b>Система не може проаналізувати це зображення</b>
 
-def fix_html_tags(content: str) -> str:
-    """
-    Виправляє незакриті та неправильні HTML теги в контенті
-    """
-    if not content:
-        return content
-    
-    # Видаляємо всі неправильні конструкції типу </b</b>, </b></b>
-    content = re.sub(r'</[^>]*<[^>]*>', '', content)
-    
-    # Виправляємо подвійні теги типу </b></b> -> </b>
-    content = re.sub(r'(</)(\w+)(>)\2(>)', r'\1\2\3', content)
-    
-    # Видаляємо всі пошкоджені теги що містять < всередині
-    content = re.sub(r'<[^>]*<[^>]*>', '', content)
-    
-    # Видаляємо порожні теги
-    content = re.sub(r'<(\w+)></\1>', '', content)
-    
-    # Рахуємо відкриті та закриті теги
-    open_tags = []
-    
-    # Знаходимо всі правильні теги
-    tag_pattern = r'<(/?)(\w+)(?:\s[^>]*)?>'
-    matches = list(re.finditer(tag_pattern, content))
-    
-    for match in matches:
-        is_closing, tag_name = match.groups()
-        
-        if is_closing:
-            # Закриваючий тег - видаляємо останній відповідний відкритий тег
-            if open_tags and open_tags[-1] == tag_name:
-                open_tags.pop()
-        else:
-            # Відкриваючий тег - додаємо в стек
-            open_tags.append(tag_name)
-    
-    # Додаємо закриваючі теги для незакритих (в зворотному порядку)
-    for tag_name in reversed(open_tags):
-        content += f'</{tag_name}>'
-        logging.warning(f"Додано закриваючий тег для <{tag_name}>")
-    
-    # Остаточне очищення від будь-яких неправильних тегів
-    content = re.sub(r'<[^/>][^>]*[^/>]<', '<', content)
-    
-    return content
+Можливі причини:
+▫️ Зображення не містить чіткий графік
+▫️ Низька якість або розмір зображення
+▫️ Неприйнятний контент для аналізу
 
-def remove_all_html_tags(content: str) -> str:
+💡 <b>Рекомендації:</b>
+▫️ Надішліть скріншот графіка з TradingView
+▫️ Переконайтесь, що графік чіткий і читабельний
+▫️ Уникайте зображень з особистою інформацією
+
+Спробуйте надіслати інше зображення графіка."""
+
+OPENAI_REFUSAL_MESSAGE = "⚠️ OpenAI відмовився аналізувати зображення. Можливо, зображення не містить торговий графік або має неприйнятний контент. Спробуйте надіслати інше зображення графіка."
+FORMAT_ERROR_MESSAGE = "⚠️ Помилка форматування відповіді. Спробуйте надіслати зображення ще раз."
+ANALYSIS_ERROR_MESSAGE = "На жаль, під час аналізу зображення сталася помилка. Спробуйте, будь ласка, пізніше."
+OVERLOADED_MESSAGE = "⏳ Сервіс аналізу зараз перевантажений. Спробуйте, будь ласка, за кілька хвилин."
+NOT_CHART_MESSAGE = """⚠️ <b>Схоже, на зображенні немає торгового графіка</b>
+
+Надішліть, будь ласка, скріншот графіка (наприклад, з TradingView) - зі свічками або лінією ціни та шкалою цін."""
+
+# Відповіді, які не є результатом аналізу (не кешуються)
+ANALYSIS_FAILURE_MESSAGES = (
+    REFUSAL_MESSAGE, OPENAI_REFUSAL_MESSAGE, FORMAT_ERROR_MESSAGE, ANALYSIS_ERROR_MESSAGE, OVERLOADED_MESSAGE,
+    NOT_CHART_MESSAGE,
+)
+
+class AnalysisResult:
     """
-    Видаляє всі HTML теги з тексту як запасний варіант
+    Результат аналізу: текст для користувача та дані запиту до моделі
+    (модель, токени, час етапів) для історії та статистики.
+    fields - поля структурованої відповіді (лише в режимі structured);
+    latency - час запиту до моделі, upload_time - його частина до першого токена;
+    queue_time, download_time і route (маршрут, Route) заповнює обробник;
+    prompt_version - версія промптів запиту.
     """
-    if not content:
-        return content
-    
-    # Видаляємо всі HTML теги
-    content = re.sub(r'<[^>]+>', '', content)
-    
-    # Декодуємо HTML entities
-    content = content.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
-    
-    return content
+    __slots__ = (
+        "text", "model", "prompt_tokens", "cached_tokens", "completion_tokens", "latency", "fields",
+        "repaired", "queue_time", "download_time", "upload_time", "prompt_version", "route",
+    )
 
-SYSTEM_PROMPT = """
-Ти — досвідчений експерт з технічного аналізу криптовалютних графіків. Твоя мета — надати глибокий та об'єктивний аналіз, базуючись на візуальній інформації з наданого зображення. Твій аналіз має враховувати принципи конфлюенції сигналів (збіг кількох індикаторів/патернів) та контекст старших таймфреймів. Ти не даєш фінансових порад.
+    def __init__(self, text: str, model: str = None, prompt_tokens: int = 0, cached_tokens: int = 0,
+                 completion_tokens: int = 0, latency: float = 0.0, fields: dict = None,
+                 prompt_version: str = None):
+        self.text = text
+        self.model = model
+        self.prompt_version = prompt_version
+        self.prompt_tokens = prompt_tokens
+        self.cached_tokens = cached_tokens
+        self.completion_tokens = completion_tokens
+        self.latency = latency
+        self.fields = fields
+        self.repaired = False
+        self.queue_time = 0.0
+        self.download_time = 0.0
+        self.upload_time = 0.0
+        self.route = None
 
-Твоя відповідь ПОВИННА бути відформатована за допомогою HTML-тегів для Telegram. Використовуй <b> для жирного тексту та <code> для всіх тикерів та числових значень.
+    @property
+    def outcome(self) -> str:
+        """ok, html_repaired, refusal, not_chart або error"""
+        if self.text in (REFUSAL_MESSAGE, OPENAI_REFUSAL_MESSAGE):
+            return "refusal"
+        if self.text == NOT_CHART_MESSAGE:
+            return "not_chart"
+        if self.failed:
+            return "error"
+        return "html_repaired" if self.repaired else "ok"
 
-ВАЖЛИВО: Кожен відкритий HTML тег ОБОВ'ЯЗКОВО має бути закритий. Наприклад: <b>текст</b>, <code>значення</code>. Не залишай незакриті теги!
-ЗАБОРОНЕНО: Не використовуй подвійні або неправильні теги типу </b</b> або </b></b>. Використовуй тільки правильні теги!
+    @property
+    def failed(self) -> bool:
+        """Відповідь не є аналізом (помилка або відмова)"""
+        return self.text in ANALYSIS_FAILURE_MESSAGES
 
-Ось структура, якої ти маєш СУВОРО дотримуватися:
+    @classmethod
+    def combine(cls, text: str, results: list) -> "AnalysisResult":
+        """Зведений результат кількох запитів (альбом): токени сумуються, латентність - максимальна"""
+        combined = cls(text, ",".join(sorted({r.model for r in results if r.model})) or None)
+        combined.prompt_version = results[0].prompt_version if results else None
+        for result in results:
+            combined.prompt_tokens += result.prompt_tokens
+            combined.cached_tokens += result.cached_tokens
+            combined.completion_tokens += result.completion_tokens
+            combined.repaired = combined.repaired or result.repaired
+            # Запити альбому йдуть паралельно - час етапу визначає найдовший
+            for name in ("latency", "queue_time", "download_time", "upload_time"):
+                setattr(combined, name, max(getattr(combined, name), getattr(result, name)))
+        return combined
 
-📊 <b>Технічний аналіз графіка</b>
+    def set_usage(self, usage):
+        if usage is None:
+            return
+        self.prompt_tokens = usage.prompt_tokens or 0
+        self.completion_tokens = usage.completion_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
 
-<b>Інструмент:</b> <code>[Назва монети, якщо видно]</code>
-<b>Таймфрейм:</b> <code>[Таймфрейм, видимий на графіку, напр. H4, D1]</code>
-<b>Основний сценарій:</b> <code>[Ймовірний рух Long/Short]</code> [Додай емодзі 🟢 для Long або 🔴 для Short]
+class Route:
+    """Рішення маршрутизації: модель, ліміт вихідних токенів та detail зображень"""
+    __slots__ = ("tier", "model", "max_tokens", "detail", "reason")
 
-▫️ <b>Ключові рівні для входу:</b> <code>[Ціновий діапазон]</code>
-▫️ <b>Рівень для обмеження ризику (Stop-Loss):</b> <code>[Ціна]</code>
-▫️ <b>Співвідношення Ризик/Прибуток (RRR):</b> <code>[Приблизне значення, напр. 1:3.5]</code>
-▫️ <b>Рекомендоване плече:</b> <code>[Наприклад: до 5x]</code>
+    def __init__(self, tier: str, model: str, max_tokens: int, detail: str = "", reason: str = None):
+        self.tier = tier
+        self.model = model
+        self.max_tokens = max_tokens
+        self.detail = detail
+        self.reason = reason
 
-▫️ <b>Потенційні цілі (Take Profit):</b>
+    def image_detail(self, detail: str) -> str:
+        """detail зображення: заданий маршрутом або обраний за розміром зображення"""
+        return self.detail or detail
 
-<code>[Перша ціль]</code>
+class RoutingPolicy:
+    """
+    Вибирає маршрут запиту за статусом користувача (підписка чи пробна спроба)
+    та навантаженням (глибина черги, середній час обробки). Під навантаженням
+    запити переводяться на дешевший маршрут degraded; повернення відбувається,
+    коли обидва показники опускаються нижче половини / 80% порогу - щоб маршрут
+    не перемикався туди-назад на кожному запиті.
+    """
 
-<code>[Друга ціль]</code>
+    def __init__(self, subscriber: Route, trial: Route, degraded: Route,
+                 queue_depth: int, latency: float, degrade_subscribers: bool):
+        self.tiers = {"subscriber": subscriber, "trial": trial, "degraded": degraded}
+        self.queue_depth = queue_depth
+        self.latency = latency
+        self.degrade_subscribers = degrade_subscribers
+        self.overloaded = False
 
-<code>[Третя ціль, якщо доречно]</code>
+    def route(self, subscribed: bool, queue_depth: int = 0, latency: float = 0.0) -> Route:
+        reason = self._overload_reason(queue_depth, latency)
+        base = self.tiers["subscriber" if subscribed else "trial"]
+        if reason is None or (subscribed and not self.degrade_subscribers):
+            return base
+        degraded = self.tiers["degraded"]
+        return Route(degraded.tier, degraded.model, degraded.max_tokens, degraded.detail, reason)
 
-<blockquote expandable><b>📈 Детальний аналіз:</b>
-<b>Аргументи за сценарій:</b>
-[Тут опиши збіг факторів (конфлюенцію), які підтверджують основний сценарій. Наприклад: "Ціна сформувала патерн 'бичачий прапор' біля сильного рівня підтримки <code>[ціна]</code>. Додатково, індикатор RSI показує приховану бичачу дивергенцію, що підсилює сигнал на ріст."]
+    def _overload_reason(self, queue_depth: int, latency: float):
+        queue_high = bool(self.queue_depth) and queue_depth >= self.queue_depth
+        latency_high = bool(self.latency) and latency >= self.latency
+        if queue_high or latency_high:
+            if not self.overloaded:
+                logging.warning(f"Навантаження: черга {queue_depth}, обробка {latency:.1f}с - дешевший маршрут")
+            self.overloaded = True
+        elif self.overloaded:
+            queue_low = not self.queue_depth or queue_depth < self.queue_depth / 2
+            latency_low = not self.latency or latency < self.latency * 0.8
+            if queue_low and latency_low:
+                logging.info(f"Навантаження спало: черга {queue_depth}, обробка {latency:.1f}с")
+                self.overloaded = False
+        if not self.overloaded:
+            return None
+        if queue_high:
+            return "queue"
+        return "latency" if latency_high else "recovering"
 
-<b>Альтернативний сценарій:</b>
-[Коротко опиши, що може піти не так і що буде сигналом до скасування ідеї. Наприклад: "Сценарій буде недійсним, якщо ціна закріпиться нижче рівня <code>[ціна]</code>. У такому випадку можливе падіння до наступної зони підтримки в районі <code>[ціна]</code>."]</blockquote>
+def build_messages(image_url: str, detail: str = "auto",
+                   system_prompt: str = SYSTEM_PROMPT, instruction: str = USER_INSTRUCTION) -> list:
+    """Формує повідомлення запиту до OpenAI (image_url - готовий data URL)"""
+    return build_album_messages([(image_url, detail)], system_prompt, instruction)
 
-<blockquote expandable><b>⚠️ Відмова від відповідальності:</b>
-Ця інформація є виключно результатом технічного аналізу візуальних даних і не є фінансовою порадою чи торговою рекомендацією. Всі рішення приймаються на ваш власний ризик.</blockquote>
+def build_album_messages(images: list, system_prompt: str = SYSTEM_PROMPT,
+                         instruction: str = USER_INSTRUCTION, note: str = None) -> list:
+    """
+    Те саме для кількох зображень: images - список пар (data URL, detail).
+    Незмінні системний промпт та інструкція йдуть першими, щоб OpenAI кешував
+    цей префікс; зображення та примітка (note, для альбому) - в кінці.
+    """
+    content = [{"type": "text", "text": instruction}]
+    for image_url, detail in images:
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": image_url,
+                "detail": detail,
+            },
+        })
+    if note:
+        content.append({"type": "text", "text": note})
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": content,
+        }
+    ]
 
-<blockquote expandable><b>⚖️ Важливо про плече:</b>
-Рекомендоване плече базується на технічному аналізі волатильності та ризику угоди. Високе плече збільшує як потенційний прибуток, так і ризик втрат. Завжди використовуйте Stop-Loss та управляйте ризиками.</blockquote>
-"""
+def process_content(content: str) -> str:
+    """Перевіряє відповідь на відмову та виправляє HTML теги"""
+    # Якщо OpenAI відмовляється аналізувати
+    if content and ("I'm sorry" in content or "can't help" in content or "I cannot" in content):
+        return REFUSAL_MESSAGE
+    
+    # Приводимо HTML до набору тегів, який приймає Telegram
+    if content:
+        logging.info(f"Отримано відповідь від OpenAI: {content[:200]}...")
+        sanitized = sanitize_html(content)
+        if sanitized != content:
+            logging.warning("HTML теги були виправлені")
+        content = sanitized
+    
+    return content
 
-async def get_trade_recommendation(base64_image: str, mime_type: str = "image/jpeg") -> str:
+def log_usage(result: AnalysisResult):
+    logging.info(
+        f"OpenAI {result.model} (промпт {result.prompt_version}): {result.prompt_tokens} вхідних токенів (кешовано {result.cached_tokens}), "
+        f"{result.completion_tokens} вихідних, {result.latency:.2f}с"
+    )
+
+def error_message(e: Exception) -> str:
+    """Повертає текст для користувача за помилкою виклику OpenAI"""
+    logging.error(f"Помилка виклику OpenAI API: {e}")
+    # Якщо відповідь містить відмову, повертаємо більш детальну інформацію
+    if "I'm sorry" in str(e) or "can't help" in str(e):
+        return OPENAI_REFUSAL_MESSAGE
+    # Якщо помилка HTML парсингу
+    if "can't parse entities" in str(e) or "can't find end tag" in str(e):
+        return FORMAT_ERROR_MESSAGE
+    # OpenAI недоступний або перевантажений навіть після повторів
+    if isinstance(e, CircuitOpen) or is_retryable(e):
+        return OVERLOADED_MESSAGE
+    return ANALYSIS_ERROR_MESSAGE
+
+async def get_trade_recommendation(image, mime_type: str = "image/jpeg", detail: str = "auto",
+                                   prompt: PromptVersion = None, route: Route = None) -> AnalysisResult:
     """
     Аналізує зображення торгового графіка за допомогою OpenAI GPT-4o та повертає рекомендацію.
+    image - байти зображення (bytes або memoryview); data URL будується один раз.
+    prompt - версія промптів (за замовчуванням - вбудована), route - маршрут (за замовчуванням - підписника).
     """
+    prompt = prompt or prompt_registry.get()
+    route = route or routing_policy.tiers["subscriber"]
+    if ANALYSIS_OUTPUT_MODE == "structured":
+        return await get_structured_recommendation(image, mime_type, detail, prompt, route)
     try:
-        client_instance = get_openai_client()
-        response = await client_instance.chat.completions.create(
-            model="gpt-4.1",
-            messages=[
-                {
-                    "role": "system",
-                    "content": SYSTEM_PROMPT
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Проведи технічний аналіз зображення графіка нижче. Ідентифікуй патерни, ключові рівні та потенційний сценарій руху ціни. Сформуй відповідь згідно з наданою структурою в системних інструкціях."},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{base64_image}",
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=1500,
+        messages = build_messages(
+            encode_data_url(image, mime_type), route.image_detail(detail), prompt.system, prompt.instruction
         )
-        content = response.choices[0].message.content
-        
-        # Якщо OpenAI відмовляється аналізувати
-        if content and ("I'm sorry" in content or "can't help" in content or "I cannot" in content):
-            return """⚠️ <b>Система не може проаналізувати це зображення</b>
+    except Exception as e:
+        return AnalysisResult(error_message(e), prompt_version=prompt.name)
+    return await complete_html(messages, prompt, route)
 
-Можливі причини:
-▫️ Зображення не містить чіткий графік
-▫️ Низька якість або розмір зображення
-▫️ Неприйнятний контент для аналізу
+async def stream_trade_recommendation(image, mime_type: str = "image/jpeg", detail: str = "auto", on_text=None,
+                                      prompt: PromptVersion = None, route: Route = None) -> AnalysisResult:
+    """
+    Те саме, що get_trade_recommendation, але отримує відповідь потоком.
+    on_text викликається з усім текстом, отриманим на поточний момент.
+    """
+    prompt = prompt or prompt_registry.get()
+    route = route or routing_policy.tiers["subscriber"]
+    try:
+        messages = build_messages(
+            encode_data_url(image, mime_type), route.image_detail(detail), prompt.system, prompt.instruction
+        )
+    except Exception as e:
+        return AnalysisResult(error_message(e), prompt_version=prompt.name)
+    return await complete_html(messages, prompt, route, on_text)
 
-💡 <b>Рекомендації:</b>
-▫️ Надішліть скріншот графіка з TradingView
-▫️ Переконайтесь, що графік чіткий і читабельний
-▫️ Уникайте зображень з особистою інформацією
+async def get_structured_recommendation(image, mime_type: str = "image/jpeg", detail: str = "auto",
+                                        prompt: PromptVersion = None, route: Route = None) -> AnalysisResult:
+    """
+    Запитує в моделі лише змінні поля аналізу (JSON за ANALYSIS_SCHEMA)
+    і формує HTML локально - без шаблону у відповіді та без виправлення тегів.
+    """
+    prompt = prompt or prompt_registry.get()
+    route = route or routing_policy.tiers["subscriber"]
+    try:
+        messages = build_messages(
+            encode_data_url(image, mime_type), route.image_detail(detail),
+            prompt.structured_system, prompt.structured_instruction
+        )
+    except Exception as e:
+        return AnalysisResult(error_message(e), prompt_version=prompt.name)
+    return await complete_structured(messages, prompt, route)
 
-Спробуйте надіслати інше зображення графіка."""
-        
-        # Валідація та виправлення HTML тегів
-        if content:
-            logging.info(f"Отримано відповідь від OpenAI: {content[:200]}...")
-            original_content = content
-            
-            try:
-                # Спробуємо виправити HTML теги
-                content = fix_html_tags(content)
-                if original_content != content:
-                    logging.warning(f"HTML теги були виправлені")
-                
-                # Тестуємо чи валідний HTML
-                import html
-                html.escape(content)  # Простий тест на валідність
-                
-                logging.info("HTML теги валідовано та виправлено")
-            except Exception as html_error:
-                logging.error(f"Не вдалося виправити HTML: {html_error}")
-                # Якщо виправлення не допомогло, видаляємо всі HTML теги
-                content = remove_all_html_tags(original_content)
-                logging.warning("HTML теги видалено повністю")
-        
-        return content
+async def get_album_recommendation(images: list, on_text=None, prompt: PromptVersion = None,
+                                   route: Route = None) -> AnalysisResult:
+    """
+    Мультитаймфреймовий аналіз кількох графіків одним запитом.
+    images - список (байти, mime_type, detail); on_text - як у stream_trade_recommendation.
+    """
+    prompt = prompt or prompt_registry.get()
+    route = route or routing_policy.tiers["subscriber"]
+    structured = ANALYSIS_OUTPUT_MODE == "structured"
+    try:
+        image_urls = [
+            (encode_data_url(image, mime_type), route.image_detail(detail)) for image, mime_type, detail in images
+        ]
+        if structured:
+            messages = build_album_messages(
+                image_urls, prompt.structured_system, prompt.structured_instruction, prompt.album_instruction
+            )
+        else:
+            messages = build_album_messages(image_urls, prompt.system, prompt.instruction, prompt.album_instruction)
+    except Exception as e:
+        return AnalysisResult(error_message(e), prompt_version=prompt.name)
+    if structured:
+        return await complete_structured(messages, prompt, route)
+    return await complete_html(messages, prompt, route, on_text)
+
+async def complete_html(messages: list, prompt: PromptVersion, route: Route, on_text=None) -> AnalysisResult:
+    """Запит у режимі HTML; з on_text відповідь отримується потоком"""
+    started = time.monotonic()
+    try:
+        if not on_text:
+            response = await openai_client.create(
+                model=route.model,
+                messages=messages,
+                max_tokens=route.max_tokens,
+                # Запити з однаковим префіксом потрапляють на той самий кеш
+                prompt_cache_key=f"{prompt.name}:html",
+            )
+            content = response.choices[0].message.content
+            result = AnalysisResult(process_content(content), response.model, prompt_version=prompt.name)
+            result.repaired = not result.failed and result.text != content
+            result.set_usage(response.usage)
+            result.latency = time.monotonic() - started
+            log_usage(result)
+            return result
+
+        # Дедлайн запиту діє і на читання потоку, а не лише до першої відповіді
+        deadline = started + openai_client.deadline
+        stream = await openai_client.create(
+            model=route.model,
+            messages=messages,
+            max_tokens=route.max_tokens,
+            stream=True,
+            prompt_cache_key=f"{prompt.name}:html",
+            # Останній фрагмент потоку містить використання токенів
+            stream_options={"include_usage": True},
+        )
+        content = ""
+        model = None
+        usage = None
+        first_token_at = None
+        try:
+            async for chunk in openai_client.iterate(stream, deadline):
+                model = chunk.model or model
+                usage = chunk.usage or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                content += delta
+                await on_text(content)
+        finally:
+            # При скасуванні аналізу закриваємо з'єднання - генерація (і оплата) зупиняється
+            await stream.close()
+        result = AnalysisResult(process_content(content), model, prompt_version=prompt.name)
+        result.repaired = not result.failed and result.text != content
+        result.set_usage(usage)
+        result.latency = time.monotonic() - started
+        result.upload_time = (first_token_at or time.monotonic()) - started
+        log_usage(result)
+        return result
+    except Exception as e:
+        return AnalysisResult(error_message(e), prompt_version=prompt.name)
+
+async def complete_structured(messages: list, prompt: PromptVersion, route: Route) -> AnalysisResult:
+    """Запит у режимі JSON за ANALYSIS_SCHEMA з локальним рендерингом HTML"""
+    started = time.monotonic()
+    try:
+        response = await openai_client.create(
+            model=route.model,
+            messages=messages,
+            # JSON з полями аналізу значно коротший за HTML-шаблон
+            max_tokens=min(700, route.max_tokens),
+            response_format={"type": "json_schema", "json_schema": ANALYSIS_SCHEMA},
+            prompt_cache_key=f"{prompt.name}:structured",
+        )
+        message = response.choices[0].message
+        result = AnalysisResult(REFUSAL_MESSAGE, response.model, prompt_version=prompt.name)
+        result.set_usage(response.usage)
+        result.latency = time.monotonic() - started
+        log_usage(result)
+        if getattr(message, "refusal", None):
+            logging.warning(f"Модель відмовилась аналізувати зображення: {message.refusal}")
+            return result
+
+        fields = json.loads(message.content)
+        if not fields.get("is_chart"):
+            return result
+        logging.info(f"Отримано структуровану відповідь від OpenAI: {fields.get('instrument')} {fields.get('timeframe')} {fields.get('direction')}")
+        result.text = render_analysis(fields)
+        result.fields = fields
+        return result
     except Exception as e:
-        logging.error(f"Помилка виклику OpenAI API: {e}")
-        # Якщо відповідь містить відмову, повертаємо більш детальну інформацію
-        if "I'm sorry" in str(e) or "can't help" in str(e):
-            return "⚠️ OpenAI відмовився аналізувати зображення. Можливо, зображення не містить торговий графік або має неприйнятний контент. Спробуйте надіслати інше зображення графіка."
-        # Якщо помилка HTML парсингу
-        if "can't parse entities" in str(e) or "can't find end tag" in str(e):
-            return "⚠️ Помилка форматування відповіді. Спробуйте надіслати зображення ще раз."
-        return "На жаль, під час аналізу зображення сталася помилка. Спробуйте, будь ласка, пізніше." 
\ No newline at end of file
+        return AnalysisResult(error_message(e), prompt_version=prompt.name)
+
+routing_policy = RoutingPolicy(
+    subscriber=Route("subscriber", ROUTE_SUBSCRIBER_MODEL, ROUTE_SUBSCRIBER_MAX_TOKENS, ROUTE_SUBSCRIBER_DETAIL),
+    trial=Route("trial", ROUTE_TRIAL_MODEL, ROUTE_TRIAL_MAX_TOKENS, ROUTE_TRIAL_DETAIL),
+    degraded=Route("degraded", ROUTE_DEGRADED_MODEL, ROUTE_DEGRADED_MAX_TOKENS, ROUTE_DEGRADED_DETAIL),
+    queue_depth=ROUTE_DEGRADE_QUEUE_DEPTH,
+    latency=ROUTE_DEGRADE_LATENCY,
+    degrade_subscribers=ROUTE_DEGRADE_SUBSCRIBERS,
+)
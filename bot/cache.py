@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from config import (
+    ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_MAX_BYTES, ANALYSIS_CACHE_MAX_DISTANCE,
+    ANALYSIS_CACHE_HIT_USES_FREE_TRADE,
+)
+from bot.media import hamming_distance, HASH_BITS
+
+
+# Ключ запису: (варіант запиту, перцептивний хеш)
+_Key = Tuple[str, int]
+
+
+class _Entry:
+    __slots__ = ("result", "variant", "phash", "file_ids", "user_ids", "size", "created_at")
+
+    def __init__(self, result: str, variant: str, phash: int, size: int):
+        self.result = result
+        self.variant = variant
+        self.phash = phash
+        self.file_ids = set()
+        self.user_ids = set()
+        self.size = size
+        self.created_at = time.monotonic()
+
+
+class AnalysisCache:
+    """
+    Дворівневий кеш результатів аналізу:
+    1) за file_unique_id Telegram - влучання не потребує завантаження фото;
+    2) за перцептивним хешем - влучають перекодовані та трохи обрізані копії.
+    Записи мають TTL і витісняються за LRU, коли перевищено ліміт за розміром.
+    variant - усе, крім зображення, від чого залежить відповідь (маршрут, модель, промпти):
+    результати різних варіантів зберігаються й шукаються окремо.
+    Близькі хеші шукаються через індекс смуг (multi-index hashing): хеш ділиться на
+    max_distance + 1 смуг, і хеш на відстані не більше max_distance збігається з шуканим
+    щонайменше в одній смузі - відстань рахується лише для таких кандидатів.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int, max_distance: int, hit_uses_free_trade: bool):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_distance = max_distance
+        self.hit_uses_free_trade = hit_uses_free_trade
+
+        # Основне сховище (LRU-порядок) та індекс за file_unique_id
+        self._entries: "OrderedDict[_Key, _Entry]" = OrderedDict()
+        self._by_file_id: Dict[Tuple[str, str], _Key] = {}
+        # (варіант, номер смуги, значення смуги) -> хеші записів
+        self._bands: Dict[Tuple[str, int, int], Set[int]] = {}
+        self._band_bits = -(-HASH_BITS // (max_distance + 1))
+        self._bytes = 0
+
+        self.file_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_by_file_id(self, file_unique_id: str, variant: str = "") -> Optional[_Entry]:
+        """Перший рівень: пошук за file_unique_id (без завантаження фото)"""
+        key = self._by_file_id.get((variant, file_unique_id))
+        entry = self._touch(key) if key is not None else None
+        if entry:
+            self.file_hits += 1
+        return entry
+
+    def get_by_hash(self, phash: int, file_unique_id: str = None, variant: str = "") -> Optional[_Entry]:
+        """Другий рівень: точний або найближчий за відстанню Геммінга хеш того ж варіанта"""
+        entry = self._touch((variant, phash))
+        if entry is None and self.max_distance > 0:
+            best = None
+            candidates = set()
+            for band in self._split(phash):
+                candidates |= self._bands.get((variant, *band), set())
+            for candidate in candidates:
+                distance = hamming_distance(candidate, phash)
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, candidate)
+            if best:
+                entry = self._touch((variant, best[1]))
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hash_hits += 1
+        if file_unique_id:
+            entry.file_ids.add(file_unique_id)
+            self._by_file_id[(variant, file_unique_id)] = (variant, entry.phash)
+        return entry
+
+    def put(self, phash: int, file_unique_id: str, result: str, user_id: int, variant: str = ""):
+        """Зберігає результат аналізу для варіанта запиту"""
+        key = (variant, phash)
+        self._remove(key)
+        entry = _Entry(result, variant, phash, len(result.encode("utf-8")))
+        entry.file_ids.add(file_unique_id)
+        entry.user_ids.add(user_id)
+        self._entries[key] = entry
+        self._by_file_id[(variant, file_unique_id)] = key
+        for band in self._split(phash):
+            self._bands.setdefault((variant, *band), set()).add(phash)
+        self._bytes += entry.size
+
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def uses_free_trade(self, entry: _Entry, user_id: int) -> bool:
+        """
+        Чи списувати безкоштовну спробу за влучання в кеш.
+        Повторний аналіз власного графіка безкоштовний; чужий - за налаштуванням.
+        """
+        charge = user_id not in entry.user_ids and self.hit_uses_free_trade
+        entry.user_ids.add(user_id)
+        return charge
+
+    def _split(self, phash: int) -> Iterator[Tuple[int, int]]:
+        """Смуги хеша: (номер, значення)"""
+        mask = (1 << self._band_bits) - 1
+        for index in range(self.max_distance + 1):
+            yield index, (phash >> (index * self._band_bits)) & mask
+
+    def _touch(self, key: _Key) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: _Key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for band in self._split(entry.phash):
+            hashes = self._bands[(entry.variant, *band)]
+            hashes.discard(entry.phash)
+            if not hashes:
+                del self._bands[(entry.variant, *band)]
+        for file_id in entry.file_ids:
+            if self._by_file_id.get((entry.variant, file_id)) == key:
+                del self._by_file_id[(entry.variant, file_id)]
+
+    def stats(self) -> dict:
+        hits = self.file_hits + self.hash_hits
+        total = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "file_hits": self.file_hits,
+            "hash_hits": self.hash_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": hits / total if total else 0.0,
+        }
+
+
+analysis_cache = AnalysisCache(
+    ttl=ANALYSIS_CACHE_TTL,
+    max_bytes=ANALYSIS_CACHE_MAX_BYTES,
+    max_distance=ANALYSIS_CACHE_MAX_DISTANCE,
+    hit_uses_free_trade=ANALYSIS_CACHE_HIT_USES_FREE_TRADE,
+)
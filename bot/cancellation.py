@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import Dict
+
+# Причини скасування
+CANCELLED_BY_USER = "user"
+SUPERSEDED = "superseded"
+
+
+class AnalysisCancelled(Exception):
+    """Аналіз скасовано кнопкою або замінено новим графіком (reason - причина)"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class ActiveAnalyses:
+    """
+    Аналізи, що виконуються: задача кожного аналізу за користувачем та
+    повідомленням "Аналізую...", до якого прив'язана кнопка скасування.
+    Скасування задачі прибирає її з черги планувальника або перериває
+    запит до OpenAI (разом із потоком відповіді) і звільняє слот.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[int, Dict[int, asyncio.Task]] = {}
+        self._reasons: Dict[asyncio.Task, str] = {}
+        self.cancelled = 0
+        self.superseded = 0
+
+    async def run(self, user_id: int, message_id: int, coro):
+        """
+        Виконує coro окремою задачею, яку можна скасувати через cancel / supersede.
+        Піднімає AnalysisCancelled, якщо задачу скасовано; якщо ж скасовано
+        сам обробник (зупинка бота) - скасовує задачу і передає CancelledError далі.
+        """
+        task = asyncio.ensure_future(coro)
+        self._tasks.setdefault(user_id, {})[message_id] = task
+        try:
+            # wait не піднімає CancelledError при скасуванні task - лише при скасуванні нас
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            tasks = self._tasks.get(user_id)
+            if tasks is not None:
+                tasks.pop(message_id, None)
+                if not tasks:
+                    del self._tasks[user_id]
+        reason = self._reasons.pop(task, None)
+        if task.cancelled():
+            raise AnalysisCancelled(reason or CANCELLED_BY_USER)
+        return task.result()
+
+    def cancel(self, user_id: int, message_id: int, reason: str = CANCELLED_BY_USER) -> bool:
+        """
+        Скасовує аналіз, прив'язаний до повідомлення. False - аналіз уже завершився.
+        reason - причина (воркер черги передає причину, записану ботом у задачу)
+        """
+        task = self._tasks.get(user_id, {}).get(message_id)
+        if task is None or task.done():
+            return False
+        self._reasons[task] = reason
+        task.cancel()
+        if reason == SUPERSEDED:
+            self.superseded += 1
+        else:
+            self.cancelled += 1
+        logging.info(f"Аналіз користувача {user_id} скасовано ({reason})")
+        return True
+
+    def supersede(self, user_id: int) -> int:
+        """Скасовує всі незавершені аналізи користувача (надіслано новий графік)"""
+        count = 0
+        for task in list(self._tasks.get(user_id, {}).values()):
+            if not task.done():
+                self._reasons[task] = SUPERSEDED
+                task.cancel()
+                count += 1
+        if count:
+            self.superseded += count
+            logging.info(f"Новий графік користувача {user_id} замінив {count} незавершених аналізів")
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "active": sum(len(tasks) for tasks in self._tasks.values()),
+            "cancelled": self.cancelled,
+            "superseded": self.superseded,
+        }
+
+
+active_analyses = ActiveAnalyses()
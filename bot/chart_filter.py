@@ -0,0 +1,101 @@
+"""
+Локальна оцінка схожості зображення на торговий графік - до запиту в OpenAI.
+Мета - відсіяти очевидно не графіки (фото, селфі, меми) за мілісекунди,
+не витрачаючи запит до моделі та безкоштовну спробу користувача.
+
+Оцінка калібрується на розміченому наборі зображень скриптом
+benchmarks/chart_filter_calibration.py (precision/recall для кількох порогів
+CHART_FILTER_THRESHOLD).
+Поки розміченого набору в репозиторії немає, фільтр за замовчуванням вимкнено
+(CHART_FILTER_THRESHOLD=0), і оцінка не рахується.
+"""
+import numpy as np
+from PIL import Image
+
+# Розмір зменшеної копії, на якій рахуються ознаки
+SAMPLE_SIDE = 256
+# Допустиме співвідношення сторін (ширина / висота): від вертикального скріншота телефону до широкого екрана
+MIN_ASPECT = 0.4
+MAX_ASPECT = 3.2
+
+
+def _clip(value: float) -> float:
+    return min(1.0, max(0.0, float(value)))
+
+
+def _uniform_lines(gray: np.ndarray, background: float, tolerance: float = 2.0) -> int:
+    """Кількість рядків, де понад 60% пікселів у межах tolerance від медіани рядка, а медіана - не фон"""
+    medians = np.median(gray, axis=1)
+    uniform = (np.abs(gray - medians[:, None]) <= tolerance).mean(axis=1) > 0.6
+    return int((uniform & (np.abs(medians - background) > tolerance)).sum())
+
+
+def chart_features(image: Image.Image) -> dict:
+    """
+    Ознаки графіка:
+    - palette_share: частка пікселів у 8 найчастіших кольорах (графіки - пласкі кольори, фото - ні);
+    - sparse_columns: частка стовпців, де зайнята лише частина висоти (свічки, лінія ціни);
+    - candle_share: частка насичених червоних / зелених пікселів (кольори свічок);
+    - lines: кількість горизонтальних і вертикальних ліній через усе зображення (сітка, шкали);
+    - aspect: співвідношення сторін.
+    """
+    small = image.convert("RGB")
+    # Цілочисельне зменшення в рази значно швидше за інтерполяцію з повного розміру
+    factor = max(small.size) // (2 * SAMPLE_SIDE)
+    if factor > 1:
+        small = small.reduce(factor)
+    if max(small.size) > SAMPLE_SIDE:
+        small = small.resize(
+            (max(1, small.width * SAMPLE_SIDE // max(small.size)), max(1, small.height * SAMPLE_SIDE // max(small.size))),
+            Image.BILINEAR,
+        )
+    rgb = np.asarray(small, dtype=np.int16)
+    height, width = rgb.shape[:2]
+    total = height * width
+
+    # Кольори з точністю 4 біти на канал
+    quantized = rgb >> 4
+    codes = (quantized[..., 0] << 8) | (quantized[..., 1] << 4) | quantized[..., 2]
+    counts = np.bincount(codes.ravel(), minlength=4096)
+    top = np.sort(counts)[::-1]
+    palette_share = top[:8].sum() / total
+
+    # Усе, що не фон (найчастіший колір)
+    foreground = codes != np.argmax(counts)
+    column_fill = foreground.mean(axis=0)
+    sparse_columns = ((column_fill > 0.01) & (column_fill < 0.6)).mean()
+
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    green_candles = (green - red > 50) & (green >= blue - 30)
+    red_candles = (red - green > 60) & (red - blue > 30)
+    candle_share = (green_candles | red_candles).mean()
+
+    # Лінія - рядок (стовпець), більша частина якого одного кольору, відмінного від фону.
+    # Шум фото такої однорідності не дає, а тонка лінія сітки після зменшення лише блідне
+    gray = rgb.mean(axis=2)
+    background = np.median(gray)
+    line_rows = _uniform_lines(gray, background)
+    line_columns = _uniform_lines(gray.T, background)
+
+    return {
+        "palette_share": float(palette_share),
+        "sparse_columns": float(sparse_columns),
+        "candle_share": float(candle_share),
+        "lines": line_rows + line_columns,
+        "aspect": image.width / max(1, image.height),
+    }
+
+
+def chart_score(image: Image.Image) -> float:
+    """Оцінка 0..1: наскільки зображення схоже на графік"""
+    features = chart_features(image)
+    flatness = _clip(features["palette_share"] / 0.8)
+    return (
+        0.30 * flatness
+        + 0.25 * features["sparse_columns"]
+        # Червоне / зелене рахується лише на пласкому зображенні - інакше це трава чи одяг на фото
+        + 0.25 * _clip(features["candle_share"] / 0.02) * _clip(features["palette_share"] / 0.6)
+        + 0.10 * _clip(features["lines"] / 4)
+        + 0.10 * (MIN_ASPECT <= features["aspect"] <= MAX_ASPECT)
+    )
+
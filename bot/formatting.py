@@ -0,0 +1,365 @@
+"""
+Telegram HTML: санітайзер відповіді моделі, перетворення на сутності (entities)
+та локальний рендеринг структурованого аналізу.
+Замір швидкості рендерингу й санітайзера - benchmarks/formatting.py.
+"""
+import bisect
+import html
+import re
+
+# =============== САНІТАЙЗЕР TELEGRAM HTML ===============
+
+# Токен розмітки: тег ("/", назва, атрибути), уламок закриваючого тега без ">"
+# перед наступним тегом (модель пише "</b</b>"), сутність, яку приймає Telegram,
+# або одиночний спецсимвол. [^<>]* не виходить за наступний "<",
+# тому весь розбір виконується одним лінійним проходом finditer.
+# Випереджальна перевірка (?=[<>&]) пропускає звичайний текст, не пробуючи всі альтернативи
+_TOKEN_RE = re.compile(
+    r'(?=[<>&])(?:<(/?)([a-zA-Z][a-zA-Z0-9-]*)([^<>]*)>'
+    r'|</[a-zA-Z][a-zA-Z0-9-]*(?=[ \t]*<)'
+    r'|&(?:lt|gt|amp|quot|#[0-9]{1,7}|#[xX][0-9a-fA-F]{1,6});'
+    r'|[<>&])'
+)
+_ESCAPES = {"<": "&lt;", ">": "&gt;", "&": "&amp;"}
+_HREF_RE = re.compile(r'''href\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+_CLASS_RE = re.compile(r'''class\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+_LANGUAGE_RE = re.compile(r'language-[\w+#-]+')
+
+# Теги, дозволені Telegram, та їх канонічні назви
+_ALLOWED_TAGS = {
+    "b": "b", "strong": "b",
+    "i": "i", "em": "i",
+    "u": "u", "ins": "u",
+    "s": "s", "strike": "s", "del": "s",
+    "tg-spoiler": "tg-spoiler", "span": "span",
+    "a": "a", "code": "code", "pre": "pre", "blockquote": "blockquote",
+}
+_NO_OPEN_TAGS = dict.fromkeys(_ALLOWED_TAGS.values(), 0)
+# Всередині цих тегів інша розмітка не допускається
+_VERBATIM_TAGS = ("code", "pre")
+# Максимальна глибина вкладення (обмежує і вартість перевідкриття тегів)
+_MAX_DEPTH = 16
+
+
+def _attribute(pattern, attributes: str) -> str:
+    match = pattern.search(attributes)
+    return (match.group(1) or match.group(2) or "").strip() if match else ""
+
+
+def _open_tag(name: str, attributes: str, names: list, open_counts: dict):
+    """Канонічний відкриваючий тег або None, якщо Telegram його не прийме"""
+    if name == "blockquote":
+        if open_counts["blockquote"]:
+            return None
+        return "<blockquote expandable>" if "expandable" in attributes else "<blockquote>"
+    if name == "a":
+        href = _attribute(_HREF_RE, attributes)
+        if not href or open_counts["a"]:
+            return None
+        return f'<a href="{html.escape(html.unescape(href))}">'
+    if name == "span":
+        if _attribute(_CLASS_RE, attributes) != "tg-spoiler":
+            return None
+        return '<span class="tg-spoiler">'
+    if name == "code" and names and names[-1] == "pre":
+        language = _attribute(_CLASS_RE, attributes)
+        if _LANGUAGE_RE.fullmatch(language):
+            return f'<code class="{language}">'
+    return f"<{name}>"
+
+
+def sanitize_html(text: str) -> str:
+    """
+    Однопрохідний санітайзер Telegram HTML за лінійний час:
+    залишає лише дозволені теги з допустимими атрибутами, екранує
+    зайві "<", ">" і "&", відкидає уламки закриваючих тегів ("</b" перед "<"),
+    закриває незбалансовані теги та прибирає порожні.
+    """
+    if not text:
+        return text
+
+    out = []
+    # Стек відкритих тегів: (назва, відкриваючий тег, індекс у out)
+    stack = []
+    names = []
+    # Кількість відкритих тегів кожного типу (перевірка за O(1))
+    open_counts = _NO_OPEN_TAGS.copy()
+    position = 0
+
+    for token in _TOKEN_RE.finditer(text):
+        if token.start() > position:
+            out.append(text[position:token.start()])
+        position = token.end()
+
+        is_closing, raw_name, attributes = token.groups()
+        if raw_name is None:
+            # Уламок тега відкидаємо, сутність залишаємо як є, одиночний спецсимвол екрануємо
+            char = token.group()
+            if not char.startswith("</"):
+                out.append(_ESCAPES.get(char, char))
+            continue
+        raw_name = raw_name.lower()
+        if raw_name == "br" and not is_closing:
+            out.append("\n")
+            continue
+        name = _ALLOWED_TAGS.get(raw_name)
+        if name is None:
+            continue
+
+        inside_verbatim = bool(names) and names[-1] in _VERBATIM_TAGS
+        if not is_closing:
+            # У code/pre дозволений лише code з мовою всередині pre
+            if inside_verbatim and not (name == "code" and names[-1] == "pre"):
+                continue
+            if len(names) >= _MAX_DEPTH:
+                continue
+            opening = _open_tag(name, attributes, names, open_counts)
+            if opening is None:
+                continue
+            stack.append((name, opening, len(out)))
+            names.append(name)
+            open_counts[name] += 1
+            out.append(opening)
+            continue
+
+        if not open_counts[name]:
+            continue
+        if inside_verbatim and names[-1] != name:
+            continue
+        # Закриваємо вкладені теги та цільовий, після чого знову відкриваємо вкладені
+        reopen = []
+        while True:
+            open_name, opening, index = stack.pop()
+            names.pop()
+            open_counts[open_name] -= 1
+            _close(out, open_name, opening, index)
+            if open_name == name:
+                break
+            reopen.append((open_name, opening))
+        for open_name, opening in reversed(reopen):
+            stack.append((open_name, opening, len(out)))
+            names.append(open_name)
+            open_counts[open_name] += 1
+            out.append(opening)
+
+    if position < len(text):
+        out.append(text[position:])
+
+    while stack:
+        open_name, opening, index = stack.pop()
+        _close(out, open_name, opening, index)
+
+    return "".join(out)
+
+
+def _close(out: list, name: str, opening: str, index: int):
+    """Додає закриваючий тег або прибирає тег, якщо він порожній"""
+    if len(out) == index + 1 and out[index] == opening:
+        out.pop()
+    else:
+        out.append(f"</{name}>")
+
+
+def close_html_prefix(text: str) -> str:
+    """
+    Робить валідним HTML обрізаний на довільному місці текст:
+    відкидає незавершений тег чи сутність в кінці та закриває відкриті теги.
+    """
+    lt = text.rfind('<')
+    if lt > text.rfind('>'):
+        text = text[:lt]
+
+    amp = text.rfind('&')
+    if amp != -1 and ';' not in text[amp:]:
+        text = text[:amp]
+
+    return sanitize_html(text)
+
+
+# =============== TELEGRAM HTML -> MESSAGE ENTITIES ===============
+
+# Тег або сутність у вже санітизованому HTML
+_MARKUP_RE = re.compile(r'<(/?)([a-z-]+)([^<>]*)>|&[^;<>&\s]{1,10};')
+_ENTITY_TYPES = {
+    "b": "bold", "i": "italic", "u": "underline", "s": "strikethrough",
+    "tg-spoiler": "spoiler", "span": "spoiler", "a": "text_link",
+    "code": "code", "pre": "pre", "blockquote": "blockquote",
+}
+
+
+def _utf16_length(text: str) -> int:
+    """Довжина в кодових одиницях UTF-16 - в них Telegram рахує offset і length сутностей"""
+    return len(text) + sum(ord(char) > 0xFFFF for char in text)
+
+
+def html_to_entities(text: str):
+    """
+    Перетворює Telegram HTML на (текст, сутності) локально: текст надсилається з entities=,
+    тож Telegram не розбирає розмітку і помилки розбору на сервері неможливі.
+    Сутності - словники у форматі MessageEntity з offset/length в UTF-16.
+    """
+    text = sanitize_html(text)
+    plain = []
+    entities = []
+    # Стек відкритих тегів: (назва, сутність або None, початок в UTF-16)
+    stack = []
+    position = 0
+    offset = 0
+
+    def append(chunk: str):
+        nonlocal offset
+        plain.append(chunk)
+        offset += _utf16_length(chunk)
+
+    for token in _MARKUP_RE.finditer(text):
+        if token.start() > position:
+            append(text[position:token.start()])
+        position = token.end()
+
+        is_closing, name, attributes = token.groups()
+        if name is None:
+            append(html.unescape(token.group()))
+            continue
+        if not is_closing:
+            entity = {"type": _ENTITY_TYPES.get(name, name)}
+            if name == "a":
+                entity["url"] = html.unescape(_attribute(_HREF_RE, attributes))
+            elif name == "blockquote" and "expandable" in attributes:
+                entity["type"] = "expandable_blockquote"
+            elif name == "code" and stack and stack[-1][0] == "pre":
+                # <pre><code class="language-x"> - одна сутність pre з мовою
+                language = _attribute(_CLASS_RE, attributes)
+                if language:
+                    stack[-1][1]["language"] = language[len("language-"):]
+                entity = None
+            stack.append((name, entity, offset))
+            continue
+        if not stack:
+            continue
+        _, entity, start = stack.pop()
+        if entity is not None and offset > start:
+            entity.update(offset=start, length=offset - start)
+            entities.append(entity)
+
+    if position < len(text):
+        append(text[position:])
+    # Telegram очікує сутності в порядку початку, зовнішні - перед вкладеними
+    entities.sort(key=lambda entity: (entity["offset"], -entity["length"]))
+    return "".join(plain), entities
+
+
+def split_entities(text: str, entities: list, limit: int, separators=("\n\n", "\n", " ")) -> list:
+    """
+    Ділить текст із сутностями на частини не довші за limit (в UTF-16).
+    Межа шукається за першим знайденим роздільником зі separators (сам роздільник
+    та пробіли на межі відкидаються), інакше текст ріжеться по limit.
+    Сутності, що перетинають межу, обрізаються і продовжуються в наступній частині.
+    Повертає [(текст, сутності)].
+    """
+    # Початок кожного символу в UTF-16
+    units = [0]
+    for char in text:
+        units.append(units[-1] + (2 if ord(char) > 0xFFFF else 1))
+
+    parts = []
+    start = 0
+    while start < len(text):
+        if units[-1] - units[start] <= limit:
+            end = next_start = len(text)
+        else:
+            # Найдальший символ, до якого частина вміщується в limit
+            cut = bisect.bisect_right(units, units[start] + limit) - 1
+            end = next_start = cut
+            for separator in separators:
+                index = text.rfind(separator, start, cut)
+                if index > start:
+                    end, next_start = index, index + len(separator)
+                    break
+        chunk = text[start:end].rstrip()
+        if chunk.strip():
+            lead = len(chunk) - len(chunk.lstrip())
+            chunk_start, chunk_end = units[start + lead], units[start + len(chunk)]
+            chunk_entities = []
+            for entity in entities:
+                entity_start = max(entity["offset"], chunk_start)
+                entity_end = min(entity["offset"] + entity["length"], chunk_end)
+                if entity_end > entity_start:
+                    chunk_entities.append(dict(entity, offset=entity_start - chunk_start, length=entity_end - entity_start))
+            parts.append((chunk.lstrip(), chunk_entities))
+        start = next_start
+        while start < len(text) and text[start].isspace():
+            start += 1
+    return parts
+
+
+# =============== ЛОКАЛЬНИЙ РЕНДЕРИНГ СТРУКТУРОВАНОГО АНАЛІЗУ ===============
+
+# Значення в `зворотних лапках` у вільному тексті моделі показуються як <code>
+_CODE_SPAN_RE = re.compile(r'`([^`\n]+)`')
+
+_DIRECTION_EMOJI = {"long": "🟢", "short": "🔴"}
+
+ANALYSIS_TEMPLATE = (
+    "📊 <b>Технічний аналіз графіка</b>\n"
+    "\n"
+    "<b>Інструмент:</b> <code>{instrument}</code>\n"
+    "<b>Таймфрейм:</b> <code>{timeframe}</code>\n"
+    "<b>Основний сценарій:</b> <code>{direction}</code> {direction_emoji}\n"
+    "\n"
+    "▫️ <b>Ключові рівні для входу:</b> <code>{entry}</code>\n"
+    "▫️ <b>Рівень для обмеження ризику (Stop-Loss):</b> <code>{stop_loss}</code>\n"
+    "▫️ <b>Співвідношення Ризик/Прибуток (RRR):</b> <code>{risk_reward}</code>\n"
+    "▫️ <b>Рекомендоване плече:</b> <code>{leverage}</code>\n"
+    "\n"
+    "▫️ <b>Потенційні цілі (Take Profit):</b>\n"
+    "\n"
+    "{targets}\n"
+    "\n"
+    "<blockquote expandable><b>📈 Детальний аналіз:</b>\n"
+    "<b>Аргументи за сценарій:</b>\n"
+    "{arguments}\n"
+    "\n"
+    "<b>Альтернативний сценарій:</b>\n"
+    "{alternative}</blockquote>\n"
+    "\n"
+    "<blockquote expandable><b>⚠️ Відмова від відповідальності:</b>\n"
+    "Ця інформація є виключно результатом технічного аналізу візуальних даних і не є фінансовою порадою "
+    "чи торговою рекомендацією. Всі рішення приймаються на ваш власний ризик.</blockquote>\n"
+    "\n"
+    "<blockquote expandable><b>⚖️ Важливо про плече:</b>\n"
+    "Рекомендоване плече базується на технічному аналізі волатильності та ризику угоди. Високе плече "
+    "збільшує як потенційний прибуток, так і ризик втрат. Завжди використовуйте Stop-Loss та управляйте "
+    "ризиками.</blockquote>"
+).format
+
+
+def _escape(value) -> str:
+    return html.escape(str(value or "—").strip(), quote=False)
+
+
+def _escape_prose(value) -> str:
+    """Екранує вільний текст і перетворює `значення` на <code>значення</code>"""
+    return _CODE_SPAN_RE.sub(r'<code>\1</code>', _escape(value))
+
+
+def render_analysis(fields: dict) -> str:
+    """
+    Формує Telegram HTML з полів структурованої відповіді моделі.
+    Усі значення екрануються, тож результат завжди валідний.
+    """
+    direction = _escape(fields.get("direction"))
+    targets = [target for target in fields.get("targets") or [] if str(target).strip()]
+    return ANALYSIS_TEMPLATE(
+        instrument=_escape(fields.get("instrument")),
+        timeframe=_escape(fields.get("timeframe")),
+        direction=direction,
+        direction_emoji=_DIRECTION_EMOJI.get(direction.lower(), ""),
+        entry=_escape(fields.get("entry")),
+        stop_loss=_escape(fields.get("stop_loss")),
+        risk_reward=_escape(fields.get("risk_reward")),
+        leverage=_escape(fields.get("leverage")),
+        targets="\n\n".join(f"<code>{_escape(target)}</code>" for target in targets) or "<code>—</code>",
+        arguments=_escape_prose(fields.get("arguments")),
+        alternative=_escape_prose(fields.get("alternative")),
+    )
+
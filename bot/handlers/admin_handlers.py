@@ -4,13 +4,29 @@ from aiogram.dispatcher.filters import Command, Text
 from aiogram.utils.exceptions import MessageNotModified
 import logging
 
-from config import ADMIN_ID
+from config import ADMIN_ID, ANALYSIS_BACKEND, METRICS_COST_DAYS
 from db import queries as db
+from db.cache import user_cache
+from db.notify import invalidation_listener
 from bot.keyboards.reply import (
     admin_main_keyboard, admin_users_keyboard, admin_referrals_keyboard,
-    admin_referral_navigation_keyboard, admin_referral_detail_keyboard
+    admin_referral_navigation_keyboard, admin_referral_detail_keyboard,
+    admin_stats_keyboard, admin_stats_section_keyboard
 )
 from bot.states import AdminStates
+from bot.scheduler import analysis_scheduler
+from bot.stats import bot_stats, format_age
+from bot.cache import analysis_cache
+from bot.media import image_memory, image_decodes, image_buffers
+from bot.openai_client import openai_client
+from bot.history import history_writer
+from bot.metrics import analysis_metrics
+from bot.prompts import prompt_registry
+from bot.ai import routing_policy
+from bot.cancellation import active_analyses
+from bot.middlewares.throttling import throttling_middleware, rate_limit
+from bot.formatting import close_html_prefix
+from bot.streaming import MESSAGE_LIMIT
 
 
 def is_admin(user_id: int) -> bool:
@@ -20,6 +36,7 @@ def is_admin(user_id: int) -> bool:
 
 # =============== ОСНОВНІ АДМІН КОМАНДИ ===============
 
+@rate_limit("admin")
 async def cmd_admin(message: types.Message):
     """Команда /admin - відкриває адмін панель"""
     if not is_admin(message.from_user.id):
@@ -32,6 +49,7 @@ async def cmd_admin(message: types.Message):
     )
 
 
+@rate_limit("admin")
 async def callback_admin_main(callback: types.CallbackQuery):
     """Повернення до головної адмін панелі"""
     if not is_admin(callback.from_user.id):
@@ -51,6 +69,7 @@ async def callback_admin_main(callback: types.CallbackQuery):
 
 # =============== УПРАВЛІННЯ КОРИСТУВАЧАМИ ===============
 
+@rate_limit("admin")
 async def callback_admin_users(callback: types.CallbackQuery):
     """Відкриває розділ управління користувачами"""
     if not is_admin(callback.from_user.id):
@@ -68,6 +87,7 @@ async def callback_admin_users(callback: types.CallbackQuery):
     await callback.answer()
 
 
+@rate_limit("admin")
 async def callback_admin_grant_subscription(callback: types.CallbackQuery, state: FSMContext):
     """Почати процес надання підписки"""
     if not is_admin(callback.from_user.id):
@@ -135,6 +155,7 @@ async def process_grant_subscription(message: types.Message, state: FSMContext):
     await state.finish()
 
 
+@rate_limit("admin")
 async def callback_admin_grant_tries(callback: types.CallbackQuery, state: FSMContext):
     """Почати процес надання безкоштовних спроб"""
     if not is_admin(callback.from_user.id):
@@ -202,6 +223,7 @@ async def process_grant_tries(message: types.Message, state: FSMContext):
     await state.finish()
 
 
+@rate_limit("admin")
 async def callback_admin_search_user(callback: types.CallbackQuery, state: FSMContext):
     """Пошук користувача"""
     if not is_admin(callback.from_user.id):
@@ -257,6 +279,7 @@ async def process_user_search(message: types.Message, state: FSMContext):
 
 # =============== РЕФЕРАЛЬНІ ПОСИЛАННЯ ===============
 
+@rate_limit("admin")
 async def callback_admin_referrals(callback: types.CallbackQuery):
     """Відкриває розділ реферальних посилань"""
     if not is_admin(callback.from_user.id):
@@ -274,6 +297,7 @@ async def callback_admin_referrals(callback: types.CallbackQuery):
     await callback.answer()
 
 
+@rate_limit("admin")
 async def callback_admin_create_referral(callback: types.CallbackQuery, state: FSMContext):
     """Почати створення реферального посилання"""
     if not is_admin(callback.from_user.id):
@@ -329,6 +353,7 @@ async def process_create_referral(message: types.Message, state: FSMContext):
     )
 
 
+@rate_limit("admin")
 async def callback_ref_bind_user(callback: types.CallbackQuery, state: FSMContext):
     """Обробка вибору прив'язки до користувача"""
     if not is_admin(callback.from_user.id):
@@ -343,6 +368,7 @@ async def callback_ref_bind_user(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
+@rate_limit("admin")
 async def callback_ref_no_bind(callback: types.CallbackQuery, state: FSMContext):
     """Обробка створення звичайного посилання"""
     if not is_admin(callback.from_user.id):
@@ -435,6 +461,7 @@ async def process_referral_owner(message: types.Message, state: FSMContext):
     await state.finish()
 
 
+@rate_limit("admin")
 async def callback_admin_list_referrals(callback: types.CallbackQuery):
     """Показати список реферальних посилань"""
     if not is_admin(callback.from_user.id):
@@ -471,6 +498,7 @@ async def callback_admin_list_referrals(callback: types.CallbackQuery):
     await callback.answer()
 
 
+@rate_limit("admin")
 async def callback_admin_referral_detail(callback: types.CallbackQuery):
     """Показати детальну інформацію про реферальне посилання"""
     if not is_admin(callback.from_user.id):
@@ -480,8 +508,8 @@ async def callback_admin_referral_detail(callback: types.CallbackQuery):
     # Отримуємо код з callback_data
     referral_code = callback.data.split("_")[-1]
     
-    # Отримуємо інформацію про посилання
-    link = await db.get_referral_link(referral_code)
+    # Отримуємо посилання разом з лічильниками (неактивне теж - його можна увімкнути знову)
+    link = await db.get_admin_referral_link(referral_code, callback.from_user.id)
     if not link:
         await callback.answer("❌ Посилання не знайдено")
         return
@@ -491,24 +519,15 @@ async def callback_admin_referral_detail(callback: types.CallbackQuery):
     
     status_text = "🟢 Активне" if link['is_active'] else "🔴 Неактивне"
     
-    # Отримуємо статистику
-    links = await db.get_admin_referral_links(callback.from_user.id)
-    current_link = next((l for l in links if l['code'] == referral_code), None)
-    
-    if current_link:
-        registrations = current_link['registrations']
-        subscriptions = current_link['subscriptions']
-    else:
-        registrations = subscriptions = 0
-    
     try:
         await callback.message.edit_text(
             f"🔗 <b>Деталі реферального посилання</b>\n\n"
             f"📝 Назва: {link['name']}\n"
             f"🔗 Код: <code>{referral_code}</code>\n"
             f"📊 Статус: {status_text}\n"
-            f"👥 Реєстрації: {registrations}\n"
-            f"💎 Підписки: {subscriptions}\n"
+            f"👆 Переходи: {link['clicks']}\n"
+            f"👥 Реєстрації: {link['registrations']}\n"
+            f"💎 Підписки: {link['subscriptions']}\n"
             f"📅 Створено: {link['created_at'].strftime('%d.%m.%Y %H:%M')}\n\n"
             f"🌐 Посилання:\n<code>{referral_url}</code>",
             reply_markup=admin_referral_detail_keyboard(referral_code, link['is_active'])
@@ -518,6 +537,7 @@ async def callback_admin_referral_detail(callback: types.CallbackQuery):
     await callback.answer()
 
 
+@rate_limit("admin")
 async def callback_admin_toggle_referral(callback: types.CallbackQuery):
     """Змінити статус реферального посилання"""
     if not is_admin(callback.from_user.id):
@@ -531,6 +551,7 @@ async def callback_admin_toggle_referral(callback: types.CallbackQuery):
     await callback_admin_referral_detail(callback)
 
 
+@rate_limit("admin")
 async def callback_admin_copy_referral(callback: types.CallbackQuery):
     """Копіювати реферальне посилання"""
     if not is_admin(callback.from_user.id):
@@ -544,6 +565,7 @@ async def callback_admin_copy_referral(callback: types.CallbackQuery):
     await callback.answer(f"📋 Посилання скопійовано:\n{referral_url}", show_alert=True)
 
 
+@rate_limit("admin")
 async def callback_admin_referral_stats(callback: types.CallbackQuery):
     """Показати загальну статистику реферальних посилань"""
     if not is_admin(callback.from_user.id):
@@ -568,38 +590,241 @@ async def callback_admin_referral_stats(callback: types.CallbackQuery):
 
 
 # =============== СТАТИСТИКА ===============
+# Загальна статистика - окреме повідомлення з оглядом, решта метрик - у підпанелях
+# (кнопки admin_stats_<розділ>): разом вони не вміщуються в ліміт повідомлення Telegram.
+
+# Скільки рядків показувати у списках, що ростуть разом з даними
+STATS_LIST_LIMIT = 7
+
+
+def _fit_message(text: str) -> str:
+    """Обрізає панель до ліміту повідомлення, не ламаючи HTML"""
+    if len(text) > MESSAGE_LIMIT:
+        text = close_html_prefix(text[:MESSAGE_LIMIT - 64]) + "\n…"
+    return text
+
+
+def _join(items, limit: int = STATS_LIST_LIMIT) -> str:
+    """Перелік через кому, не довше за limit елементів"""
+    items = list(items)
+    text = ", ".join(items[:limit]) or "—"
+    if len(items) > limit:
+        text += f" (ще {len(items) - limit})"
+    return text
+
+
+async def _stats_overview() -> str:
+    # Загальна статистика - зі знімка, який оновлюється у фоні
+    stats, stats_age = await bot_stats.get()
+
+    # Розраховуємо конверсію
+    conversion_rate = 0
+    if stats['total_referral_clicks'] > 0:
+        conversion_rate = (stats['referral_subscriptions'] / stats['total_referral_clicks']) * 100
+
+    return (
+        f"📊 <b>Загальна статистика бота</b>\n"
+        f"<i>Користувачі та реферали станом на {format_age(stats_age)} тому "
+        f"(оновлюється кожні {format_age(bot_stats.refresh_interval)})</i>\n\n"
+        f"👥 <b>Користувачі:</b>\n"
+        f"• Всього: {stats['total_users']}\n"
+        f"• За останні 7 днів: {stats['recent_users']}\n\n"
+        f"💎 <b>Підписки:</b>\n"
+        f"• Активні: {stats['active_subscriptions']}\n"
+        f"• Через реферали: {stats['referral_subscriptions']}\n\n"
+        f"🔗 <b>Реферальна система:</b>\n"
+        f"• Всього посилань: {stats['total_referral_links']}\n"
+        f"• Реєстрації: {stats['total_referral_clicks']}\n"
+        f"• Конверсія: {conversion_rate:.1f}%\n\n"
+        f"📈 <b>Ефективність:</b>\n"
+        f"• Підписок на користувача: {(stats['active_subscriptions'] / max(stats['total_users'], 1) * 100):.1f}%\n\n"
+        f"<i>Детальні метрики - у розділах нижче</i>"
+    )
+
+
+async def _analysis_usage():
+    """
+    Метрики аналізів (AnalysisMetrics.stats(), cost_rollup()): з пам'яті бота, а з
+    ANALYSIS_BACKEND=queue - з рядків analysis_jobs, бо аналізують процеси воркерів
+    """
+    if ANALYSIS_BACKEND == "queue":
+        return await db.get_analysis_job_metrics(METRICS_COST_DAYS)
+    return analysis_metrics.stats(), analysis_metrics.cost_rollup()
+
+
+async def _stats_queue() -> str:
+    queue = analysis_scheduler.stats()
+    cancellations = active_analyses.stats()
+    # Черга в БД (ANALYSIS_BACKEND=queue) виконується процесами воркерів
+    jobs = await db.get_analysis_job_stats() if ANALYSIS_BACKEND == "queue" else None
+    return (
+        f"⏳ <b>Черга аналізів:</b>\n"
+        f"• В обробці: {queue['in_flight']}/{queue['concurrency']}\n"
+        f"• У черзі: {queue['queue_depth']} (користувачів: {queue['queued_users']})\n"
+        f"• Очікування: {queue['wait_avg']:.1f}с (p95 {queue['wait_p95']:.1f}с)\n"
+        f"• Обробка: {queue['service_avg']:.1f}с (p95 {queue['service_p95']:.1f}с)\n"
+        f"• Відхилено: {queue['rejected']}\n"
+        f"• Скасовано: {cancellations['cancelled']} (замінено новим графіком: {cancellations['superseded']}, "
+        f"знято з планувальника: {queue['cancelled']})\n"
+        + (
+            f"• Черга БД: {jobs['queued']} очікують, {jobs['running']} у воркерах, "
+            f"dead letter за добу: {jobs['dead']}\n" if jobs else ""
+        )
+    )
+
+
+async def _stats_caches() -> str:
+    cache = analysis_cache.stats()
+    users = user_cache.stats()
+    listener = invalidation_listener.stats()
+    return (
+        f"🗂 <b>Кеш аналізів:</b>\n"
+        f"• Записів: {cache['entries']} ({cache['bytes'] // 1024} КБ)\n"
+        f"• Влучання: {cache['file_hits']} за file_id, {cache['hash_hits']} за хешем\n"
+        f"• Промахи: {cache['misses']}\n"
+        f"• Hit ratio: {cache['hit_ratio'] * 100:.1f}%\n\n"
+        f"👥 <b>Кеш користувачів:</b>\n"
+        f"• {users['entries']} записів, hit ratio {users['hit_ratio'] * 100:.1f}% "
+        f"({users['hits']}/{users['hits'] + users['misses']}), скинуто {users['invalidations']}\n"
+        f"• Події інвалідації: {listener['received']} (затримка {listener['lag_avg']:.0f} мс, "
+        f"p95 {listener['lag_p95']:.0f} мс), слухач {'підключений' if listener['connected'] else 'відключений'}, "
+        f"перепідключень {listener['reconnects']}\n"
+    )
+
+
+async def _stats_resources() -> str:
+    memory = image_memory.stats()
+    decodes = image_decodes.stats()
+    buffers = image_buffers.stats()
+    database = db.get_pool_stats()
+    history = history_writer.stats()
+    throttling = throttling_middleware.stats()
+    return (
+        f"🧠 <b>Пам'ять на зображення:</b>\n"
+        f"• Зараз: {memory['in_use'] // 1024} КБ з {memory['limit'] // 1024} КБ\n"
+        f"• Пік: {memory['peak'] // 1024} КБ (на запит: {memory['peak_request'] // 1024} КБ)\n"
+        f"• Декодування: {decodes['in_use'] // 1024} КБ з {decodes['limit'] // 1024} КБ, "
+        f"пік {decodes['peak'] // 1024} КБ\n"
+        f"• Пул буферів: {buffers['retained'] // 1024} КБ з {buffers['max_bytes'] // 1024} КБ, "
+        f"повторно використано {buffers['reused']} з {buffers['reused'] + buffers['allocated']}\n\n"
+        f"🐘 <b>PostgreSQL:</b>\n"
+        f"• Пул: {database['pool_size']}/{database['pool_max']} підключень (вільних {database['pool_idle']}), "
+        f"відкрито всього {database['connections_opened']}\n"
+        f"• Очікування підключення: {database['acquire_avg']:.1f} мс (p95 {database['acquire_p95']:.0f} мс)\n"
+        f"• Повільних запитів: {database['slow']}\n"
+        f"• Найдовші (сумарно): " + _join(
+            f"{query['name']} {query['calls']}×{query['avg']:.1f} мс (p95 {query['p95']:.0f})"
+            for query in database['top']
+        ) + "\n\n"
+        f"🗄 <b>Історія аналізів:</b>\n"
+        f"• Записано: {history['written']} ({history['batches']} пакетів)\n"
+        f"• Очікують: {history['pending']}, відкинуто: {history['dropped']}\n\n"
+        f"🚦 <b>Обмеження частоти:</b>\n"
+        + "".join(
+            f"• {key}: відхилено {budget['throttled']} (активних: {budget['users']})\n"
+            for key, budget in throttling.items()
+        )
+    )
+
+
+async def _stats_openai() -> str:
+    upstream = openai_client.stats()
+    usage, _ = await _analysis_usage()
+    return (
+        f"🤖 <b>OpenAI:</b>\n"
+        f"• Запитів: {upstream['requests']} (спроб: {upstream['attempts']}, повторів: {upstream['retries']})\n"
+        f"• Дубльовані: {upstream['hedges']} (виграли: {upstream['hedge_wins']})\n"
+        f"• Резервна модель: {upstream['fallbacks']}, відхилено запобіжником: {upstream['rejected']}\n"
+        f"• Помилки: {upstream['failures']}, потік перевищив дедлайн: {upstream['stream_timeouts']}\n"
+        + "".join(
+            f"• {name}: запобіжник {model['breaker']} (спрацював {model['trips']}), "
+            f"латентність {model['latency_avg']:.1f}с / потік {model['stream_latency_avg']:.1f}с "
+            f"(поріг дублювання {model['hedge_delay']:.1f}с / {model['stream_hedge_delay']:.1f}с)\n"
+            for name, model in list(upstream['models'].items())[:STATS_LIST_LIMIT]
+        ) + "\n"
+        f"📦 <b>Результати:</b>\n"
+        f"• " + _join(f"{name} {count}" for name, count in sorted(usage['outcomes'].items())) + "\n"
+        f"• Маршрути: " + _join(f"{name} {count}" for name, count in sorted(usage['routes'].items()))
+        + " (під навантаженням: " + _join(f"{name} {count}" for name, count in sorted(usage['route_reasons'].items()))
+        + f"; зараз {'так' if routing_policy.overloaded else 'ні'})\n"
+        f"• Етапи (сер./p95, с): " + _join(
+            f"{name} {mean:.1f}/{p95:.0f}" for name, (mean, p95) in usage['stages'].items()
+        ) + "\n"
+    )
+
+
+async def _stats_cost() -> str:
+    usage, cost = await _analysis_usage()
+    return (
+        f"💵 <b>Вартість OpenAI:</b>\n"
+        f"• Сьогодні: ${cost['today']:.2f} ({cost['today_requests']} запитів)\n"
+        f"• По днях: " + _join(f"{day[5:]} ${value:.2f}" for day, value in cost['days']) + "\n"
+        f"• Топ сьогодні: " + _join(f"<code>{uid}</code> ${value:.3f}" for uid, value in cost['top_users']) + "\n"
+        f"• Токени: {usage['prompt_tokens']} вхідних (кешовано {usage['cached_ratio'] * 100:.0f}%), "
+        f"{usage['completion_tokens']} вихідних\n"
+    )
+
 
+async def _stats_prompts() -> str:
+    usage, _ = await _analysis_usage()
+    prompts = prompt_registry.stats()
+    # Версії, що обслуговують найбільше запитів
+    versions = sorted(usage['prompt_versions'].items(), key=lambda item: item[1]['requests'], reverse=True)
+    hidden = len(versions) - STATS_LIST_LIMIT
+    return (
+        f"🧪 <b>Версії промптів</b> (розподіл: "
+        + _join(f"{name} {share * 100:.0f}%" for name, share in prompts['split'].items())
+        + f"; перезавантажень {prompts['reloads']}, помилок {prompts['errors']}):\n"
+        + "".join(
+            f"• {name}: {version['requests']} запитів, відмови {version['refusal_rate'] * 100:.0f}%, "
+            f"помилки {version['error_rate'] * 100:.0f}%, {version['prompt_tokens']:.0f}/"
+            f"{version['completion_tokens']:.0f} токенів (кеш {version['cached_ratio'] * 100:.0f}%), "
+            f"${version['cost']:.4f}/запит, {version['latency'][0]:.1f}/{version['latency'][1]:.0f}с\n"
+            for name, version in versions[:STATS_LIST_LIMIT]
+        )
+        + (f"• …ще {hidden} версій\n" if hidden > 0 else "")
+    )
+
+
+# Підпанелі статистики: callback_data admin_stats_<ключ>
+STATS_SECTIONS = {
+    "queue": _stats_queue,
+    "caches": _stats_caches,
+    "resources": _stats_resources,
+    "openai": _stats_openai,
+    "cost": _stats_cost,
+    "prompts": _stats_prompts,
+}
+
+
+@rate_limit("admin")
 async def callback_admin_stats(callback: types.CallbackQuery):
     """Показати загальну статистику бота"""
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Доступ заборонено")
         return
-    
+
+    await _show_stats(callback, _stats_overview, admin_stats_keyboard)
+
+
+@rate_limit("admin")
+async def callback_admin_stats_section(callback: types.CallbackQuery):
+    """Показати розділ статистики (admin_stats_<розділ>)"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ заборонено")
+        return
+
+    section = callback.data[len("admin_stats_"):]
+    render = STATS_SECTIONS.get(section)
+    if render is None:
+        await callback.answer()
+        return
+    await _show_stats(callback, render, admin_stats_section_keyboard(section))
+
+
+async def _show_stats(callback: types.CallbackQuery, render, keyboard: types.InlineKeyboardMarkup):
     try:
-        # Отримуємо загальну статистику
-        stats = await db.get_bot_stats()
-        
-        # Розраховуємо конверсію
-        conversion_rate = 0
-        if stats['total_referral_clicks'] > 0:
-            conversion_rate = (stats['referral_subscriptions'] / stats['total_referral_clicks']) * 100
-        
-        await callback.message.edit_text(
-            f"📊 <b>Загальна статистика бота</b>\n\n"
-            f"👥 <b>Користувачі:</b>\n"
-            f"• Всього: {stats['total_users']}\n"
-            f"• За останні 7 днів: {stats['recent_users']}\n\n"
-            f"💎 <b>Підписки:</b>\n"
-            f"• Активні: {stats['active_subscriptions']}\n"
-            f"• Через реферали: {stats['referral_subscriptions']}\n\n"
-            f"🔗 <b>Реферальна система:</b>\n"
-            f"• Всього посилань: {stats['total_referral_links']}\n"
-            f"• Реєстрації: {stats['total_referral_clicks']}\n"
-            f"• Конверсія: {conversion_rate:.1f}%\n\n"
-            f"📈 <b>Ефективність:</b>\n"
-            f"• Підписок на користувача: {(stats['active_subscriptions'] / max(stats['total_users'], 1) * 100):.1f}%",
-            reply_markup=admin_main_keyboard
-        )
+        await callback.message.edit_text(_fit_message(await render()), reply_markup=keyboard)
     except MessageNotModified:
         pass
     except Exception as e:
@@ -651,6 +876,7 @@ def register_admin_handlers(dp):
     dp.register_callback_query_handler(callback_admin_users, Text("admin_users"))
     dp.register_callback_query_handler(callback_admin_referrals, Text("admin_referrals"))
     dp.register_callback_query_handler(callback_admin_stats, Text("admin_stats"))
+    dp.register_callback_query_handler(callback_admin_stats_section, Text(startswith="admin_stats_"))
     
     # Callback кнопки - користувачі
     dp.register_callback_query_handler(callback_admin_grant_subscription, Text("admin_grant_subscription"))
@@ -0,0 +1,106 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Dispatcher, types
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.exceptions import MessageNotModified
+
+from db import queries as db
+from bot.formatting import close_html_prefix, render_analysis
+from bot.middlewares.throttling import rate_limit
+from bot.streaming import MESSAGE_LIMIT
+
+
+# Початок відліку для курсора (created_at зберігається в UTC без часової зони)
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _cursor_data(direction: str, row: dict) -> str:
+    """callback_data з курсором (created_at у мікросекундах, id) - вміщується в 64 байти"""
+    created_at = (row["created_at"] - _EPOCH) // timedelta(microseconds=1)
+    return f"history:{direction}:{created_at}:{row['id']}"
+
+
+def _parse_cursor(data: str):
+    _, direction, created_at, row_id = data.split(":")
+    return direction == "newer", (_EPOCH + timedelta(microseconds=int(created_at)), int(row_id))
+
+
+def _history_keyboard(row: dict, has_newer: bool, has_older: bool):
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton(text="◀️ Новіший", callback_data=_cursor_data("newer", row)))
+    if has_older:
+        buttons.append(InlineKeyboardButton(text="Старіший ▶️", callback_data=_cursor_data("older", row)))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+def _history_text(row: dict) -> str:
+    header = f"🗂 <b>Аналіз від {row['created_at'].strftime('%d.%m.%Y %H:%M')} UTC</b>\n\n"
+    if row["result_fields"]:
+        body = render_analysis(json.loads(row["result_fields"]))
+    else:
+        body = row["result_text"] or ""
+    text = header + body
+    if len(text) > MESSAGE_LIMIT:
+        text = close_html_prefix(text[:MESSAGE_LIMIT - 64]) + "\n…"
+    return text
+
+
+async def load_history_page(user_id: int, cursor=None, newer: bool = False):
+    """
+    Повертає (рядок, є новіші, є старіші) або None, якщо сторінка порожня.
+    Запитується на один запис більше, щоб дізнатись, чи є наступна сторінка в тому ж напрямку.
+    """
+    rows = await db.get_user_analyses(user_id, cursor, newer, limit=2)
+    if not rows:
+        return None
+    if newer:
+        # Записи від новіших до старіших: поточний - останній
+        return rows[-1], len(rows) > 1, True
+    return rows[0], cursor is not None, len(rows) > 1
+
+
+@rate_limit("profile")
+async def cmd_history(message: types.Message):
+    """Команда /history - останній аналіз користувача з навігацією по історії"""
+    page = await load_history_page(message.from_user.id)
+    if not page:
+        await message.answer("🗂 У вас ще немає збережених аналізів. Надішліть графік, щоб отримати перший.")
+        return
+    row, has_newer, has_older = page
+    await message.answer(
+        _history_text(row),
+        parse_mode="HTML",
+        reply_markup=_history_keyboard(row, has_newer, has_older)
+    )
+
+
+@rate_limit("profile")
+async def callback_history(callback: types.CallbackQuery):
+    """Перехід до новішого або старішого аналізу"""
+    try:
+        newer, cursor = _parse_cursor(callback.data)
+        page = await load_history_page(callback.from_user.id, cursor, newer)
+        if not page:
+            await callback.answer("Більше аналізів немає")
+            return
+        row, has_newer, has_older = page
+        await callback.message.edit_text(
+            _history_text(row),
+            parse_mode="HTML",
+            reply_markup=_history_keyboard(row, has_newer, has_older)
+        )
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logging.error(f"Помилка завантаження історії аналізів: {e}")
+        await callback.answer("❌ Помилка завантаження історії", show_alert=True)
+        return
+    await callback.answer()
+
+
+def register_history_handlers(dp: Dispatcher):
+    dp.register_message_handler(cmd_history, commands=["history"])
+    dp.register_callback_query_handler(callback_history, text_startswith="history:")
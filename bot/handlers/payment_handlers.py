@@ -3,6 +3,7 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from db import queries as db
 import logging
 from bot.handlers.user_handlers import show_profile
+from bot.middlewares.throttling import rate_limit
 
 async def handle_subscribe(callback_query: types.CallbackQuery):
     """Обробляє натискання кнопки підписки - направляє до адміністратора"""
@@ -84,6 +85,7 @@ async def handle_subscription_info(callback_query: types.CallbackQuery):
         logging.error(f"Помилка показу інформації про підписку: {e}")
         await callback_query.answer("❌ Помилка завантаження інформації", show_alert=True)
 
+@rate_limit("profile")
 async def handle_back_to_profile(callback_query: types.CallbackQuery):
     """Повертає назад до профілю"""
     await show_profile(callback_query)
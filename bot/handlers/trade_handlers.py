@@ -1,40 +1,510 @@
-import base64
-import io
+import asyncio
 import logging
 import os
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List, Optional, Tuple
 from aiogram import Dispatcher, types
+from aiogram.utils.exceptions import BadRequest
 from db import queries as db
-from bot.ai import get_trade_recommendation
-from bot.keyboards.reply import subscribe_keyboard
-from datetime import datetime, timezone
+from bot.ai import (
+    get_trade_recommendation, stream_trade_recommendation, get_album_recommendation,
+    AnalysisResult, ANALYSIS_ERROR_MESSAGE, NOT_CHART_MESSAGE, routing_policy,
+)
+from bot.cache import analysis_cache
+from bot.history import history_writer
+from bot.metrics import analysis_metrics
+from bot.prompts import prompt_registry
+from bot.media import (
+    perceptual_hash, prepare_image, select_photo_size, IMAGE_DOCUMENT_MIME_TYPES,
+    ImageTooLarge, download_to_buffer, estimate_peak_memory, estimate_decode_memory,
+    image_buffers, image_memory, image_decodes,
+)
+from bot.keyboards.reply import subscribe_keyboard, cancel_analysis_keyboard
+from bot.cancellation import active_analyses, AnalysisCancelled, CANCELLED_BY_USER, SUPERSEDED
+from bot.scheduler import analysis_scheduler, QueueFull
+from bot.streaming import StreamingMessage, MESSAGE_LIMIT
+from bot.formatting import html_to_entities, split_entities
+from bot.middlewares.throttling import rate_limit
+from config import (
+    ANALYSIS_STREAMING, STREAM_EDIT_INTERVAL, ANALYSIS_OUTPUT_MODE,
+    ALBUM_MODE, ALBUM_MAX_IMAGES, ALBUM_PARALLELISM, ANALYSIS_SUPERSEDE,
+    ANALYSIS_BACKEND, ANALYSIS_QUEUE_LIMIT, ANALYSIS_USER_QUEUE_LIMIT, JOB_MAX_ATTEMPTS,
+    IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, IMAGE_CROP_BORDERS, IMAGE_MAX_DOWNLOAD_BYTES,
+    CHART_FILTER_THRESHOLD, CHART_FILTER_SUBSCRIBERS,
+)
 
 
-async def handle_photo(message: types.Message):
+# Модель у записі історії для результату, взятого з кешу
+CACHE_MODEL = "cache"
+# Роздільник розділів зведеної відповіді на альбом
+ALBUM_SEPARATOR = "\n\n➖➖➖➖➖➖\n\n"
+# Повідомлення на час аналізу та при переповненій черзі
+PROCESSING_MESSAGE = "🔄 Аналізую ваш графік... Це може зайняти до хвилини."
+QUEUE_FULL_MESSAGE = (
+    "⏳ Зараз надто багато запитів на аналіз. "
+    "Будь ласка, зачекайте завершення попередніх і спробуйте ще раз."
+)
+
+
+class LoadedImage:
+    """Завантажене зображення: байти в буфері з пулу, перцептивний хеш і підготовлений JPEG"""
+    __slots__ = ("file", "data", "phash", "prepared", "buffer", "memory", "decode_memory")
+
+    def __init__(self, image_file, buffer, data, memory: int, decode_memory: int):
+        self.file = image_file
+        self.buffer = buffer
+        self.data = data
+        self.memory = memory
+        self.decode_memory = decode_memory
+        self.phash = None
+        self.prepared = None
+
+    async def decode(self, function, *args):
+        """Виконує function(data, *args) у потоці в межах бюджету пам'яті на декодування"""
+        await image_decodes.acquire(self.decode_memory)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, function, self.data, *args)
+        finally:
+            await image_decodes.release(self.decode_memory)
+
+    async def prepare(self):
+        """Обрізає поля, зменшує та перекодовує зображення для OpenAI, оцінює схожість на графік"""
+        prepared = await self.decode(
+            prepare_image, IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, IMAGE_CROP_BORDERS, CHART_FILTER_THRESHOLD > 0
+        )
+        logging.info(
+            f"Зображення підготовлено: {prepared.width}x{prepared.height} ({prepared.detail}), "
+            f"{prepared.original_size} -> {len(prepared.data)} байт (-{prepared.bytes_saved}), "
+            f"~{prepared.original_tokens} -> {prepared.tokens} токенів (-{prepared.tokens_saved}), "
+            f"схожість на графік {'-' if prepared.chart_score is None else f'{prepared.chart_score:.2f}'}"
+        )
+        self.prepared = prepared
+
+        # Якщо зображення перекодовано, оригінал більше не потрібен - звільняємо буфер
+        # і приводимо резерв пам'яті до розміру підготовленого JPEG (він буває більшим
+        # за оригінал, наприклад для маленького PNG - тоді резерв збільшується)
+        if not isinstance(prepared.data, memoryview):
+            self.data = None
+            image_buffers.release(self.buffer)
+            self.buffer = None
+            prepared_memory = estimate_peak_memory(len(prepared.data), pooled=False)
+            if prepared_memory < self.memory:
+                await image_memory.release(self.memory - prepared_memory)
+            else:
+                image_memory.grow(prepared_memory - self.memory)
+            self.memory = prepared_memory
+
+
+@asynccontextmanager
+async def load_image(bot, image_file):
     """
-    Хендлер для обробки надісланих фотографій.
+    Завантажує зображення (PhotoSize або Document) в буфер з пулу в межах
+    бюджету пам'яті та обчислює перцептивний хеш. Буфер і резерв пам'яті
+    звільняються при виході з контексту. Завеликі файли та зображення
+    (IMAGE_MAX_PIXELS) відхиляються з ImageTooLarge.
+    """
+    file_info = await bot.get_file(image_file.file_id)
+    file_size = file_info.file_size or IMAGE_MAX_DOWNLOAD_BYTES
+    if file_size > IMAGE_MAX_DOWNLOAD_BYTES:
+        raise ImageTooLarge()
+
+    # Резервуємо пам'ять під буфер завантаження, base64 та data URL
+    peak_memory = estimate_peak_memory(file_size)
+    await image_memory.acquire(peak_memory)
+    image = None
+    try:
+        # Завантажуємо фото прямо в буфер з пулу
+        buffer, image_bytes = await download_to_buffer(bot, file_info.file_path, file_size, image_buffers)
+        try:
+            # Заголовок зображення: розмір після декодування без самого декодування
+            decode_memory = estimate_decode_memory(image_bytes, IMAGE_MAX_SIDE, IMAGE_CROP_BORDERS)
+        except Exception:
+            image_buffers.release(buffer)
+            raise
+        image = LoadedImage(image_file, buffer, image_bytes, peak_memory, decode_memory)
+
+        try:
+            image.phash = await image.decode(perceptual_hash)
+        except Exception as e:
+            logging.warning(f"Не вдалося обчислити перцептивний хеш: {e}")
+        yield image
+    finally:
+        if image is None:
+            await image_memory.release(peak_memory)
+        else:
+            if image.buffer is not None:
+                image.data = None
+                image_buffers.release(image.buffer)
+            await image_memory.release(image.memory)
+
+
+def rejected_as_not_chart(image: LoadedImage, check_chart: bool) -> bool:
+    """
+    Чи відхилити зображення як не графік (оцінка нижче CHART_FILTER_THRESHOLD).
+    Без check_chart (підписники) зображення не відхиляється, лише враховується в метриках.
+    """
+    score = image.prepared.chart_score
+    if score is None or score >= CHART_FILTER_THRESHOLD:
+        return False
+    if not check_chart:
+        analysis_metrics.increment("not_chart_bypassed")
+        return False
+    logging.info(f"Зображення {image.file.file_unique_id} відхилено фільтром графіків: оцінка {score:.2f}")
+    return True
+
+
+def cache_variant(route=None, prompt=None) -> str:
+    """
+    Варіант запиту для кешу аналізів: відповіді різних маршрутів (модель, ліміт токенів),
+    версій промптів і форматів відповіді (ANALYSIS_OUTPUT_MODE) не змішуються.
+    """
+    route = route or routing_policy.tiers["subscriber"]
+    prompt = prompt or prompt_registry.get()
+    return f"{ANALYSIS_OUTPUT_MODE}:{prompt.name}:{route.tier}:{route.model}"
+
+
+async def analyse_photo(message: types.Message, image_file, on_position=None, on_text=None,
+                        prompt=None, route=None, check_chart=False):
+    """
+    Повертає (текст аналізу, чи списувати безкоштовну спробу).
+    image_file - PhotoSize або Document із зображенням,
+    prompt - версія промптів, route - маршрут запиту (модель, токени, detail),
+    check_chart - відхиляти зображення, не схожі на графік, без запиту до OpenAI.
+    Спочатку шукає результат у кеші за file_unique_id (без завантаження),
+    потім за перцептивним хешем, і лише після цього звертається до OpenAI.
+    Якщо передано on_text, відповідь отримується потоком.
     """
     user_id = message.from_user.id
-    user = await db.get_user(user_id)
+    variant = cache_variant(route, prompt)
 
-    if not user:
-        await message.answer("Будь ласка, почніть з команди /start, щоб я міг вас зареєструвати.")
+    entry = analysis_cache.get_by_file_id(image_file.file_unique_id, variant)
+    if entry:
+        return AnalysisResult(entry.result, CACHE_MODEL), analysis_cache.uses_free_trade(entry, user_id)
+
+    started = time.monotonic()
+    async with load_image(message.bot, image_file) as image:
+        if image.phash is not None:
+            entry = analysis_cache.get_by_hash(image.phash, image_file.file_unique_id, variant)
+            if entry:
+                return AnalysisResult(entry.result, CACHE_MODEL), analysis_cache.uses_free_trade(entry, user_id)
+
+        await image.prepare()
+        if rejected_as_not_chart(image, check_chart):
+            return AnalysisResult(NOT_CHART_MESSAGE), False
+        prepared = image.prepared
+        download_time = time.monotonic() - started
+        submitted = time.monotonic()
+
+        # Отримуємо аналіз від AI через планувальник (обмеження паралельних запитів).
+        # data URL будується всередині виклику, тож у черзі зберігаються лише байти JPEG
+        if on_text:
+            result = await analysis_scheduler.submit(
+                user_id, stream_trade_recommendation, prepared.data, prepared.mime_type, prepared.detail, on_text, prompt, route,
+                on_position=on_position
+            )
+        else:
+            result = await analysis_scheduler.submit(
+                user_id, get_trade_recommendation, prepared.data, prepared.mime_type, prepared.detail, prompt, route,
+                on_position=on_position
+            )
+
+        # Час у черзі - все, що не пішло на сам запит до моделі
+        result.queue_time = max(0.0, time.monotonic() - submitted - result.latency)
+        result.download_time = download_time
+
+        if image.phash is not None and not result.failed:
+            analysis_cache.put(image.phash, image_file.file_unique_id, result.text, user_id, variant)
+        return result, True
+
+
+async def analyse_album(message: types.Message, image_files: list, on_position=None, on_text=None,
+                        prompt=None, route=None, check_chart=False):
+    """
+    Аналіз альбому графіків, повертає (текст, чи списувати безкоштовну спробу).
+    combined - усі графіки одним запитом (мультитаймфреймовий аналіз);
+    parallel - кожен графік окремо, паралельно (не більше ALBUM_PARALLELISM), результати зводяться.
+    Зображення завантажуються одночасно, тож час близький до аналізу одного графіка.
+    combined-режим обходить analysis_cache: ключ кешу - одне зображення, а відповідь
+    залежить від усього набору графіків. Тому кожен такий альбом - окремий запит до OpenAI.
+    """
+    user_id = message.from_user.id
+
+    if ALBUM_MODE == "parallel":
+        semaphore = asyncio.Semaphore(ALBUM_PARALLELISM)
+
+        async def analyse_one(image_file):
+            async with semaphore:
+                return await analyse_photo(
+                    message, image_file, on_position, prompt=prompt, route=route, check_chart=check_chart
+                )
+
+        results = await asyncio.gather(*(analyse_one(f) for f in image_files), return_exceptions=True)
+        sections = []
+        analysed = []
+        uses_free_trade = False
+        for index, outcome in enumerate(results, 1):
+            if isinstance(outcome, BaseException):
+                logging.error(f"Помилка аналізу графіка {index} альбому: {outcome}")
+                text = ANALYSIS_ERROR_MESSAGE
+            else:
+                result, charge = outcome
+                text = result.text
+                if not result.failed:
+                    analysed.append(result)
+                    uses_free_trade = uses_free_trade or charge
+            sections.append(f"🖼 <b>Графік {index} з {len(results)}</b>\n\n{text}")
+        if all(isinstance(r, BaseException) for r in results):
+            raise results[0]
+        if not analysed:
+            if all(not isinstance(r, BaseException) and r[0].outcome == "not_chart" for r in results):
+                return AnalysisResult(NOT_CHART_MESSAGE), False
+            return AnalysisResult(ANALYSIS_ERROR_MESSAGE), False
+        # Спроба списується, лише якщо хоча б один графік проаналізовано
+        return AnalysisResult.combine(ALBUM_SEPARATOR.join(sections), analysed), uses_free_trade
+
+    started = time.monotonic()
+    async with AsyncExitStack() as stack:
+        images = await asyncio.gather(
+            *(stack.enter_async_context(load_image(message.bot, f)) for f in image_files)
+        )
+        await asyncio.gather(*(image.prepare() for image in images))
+        # Зображення, не схожі на графік, до запиту не потрапляють
+        images = [image for image in images if not rejected_as_not_chart(image, check_chart)]
+        if not images:
+            return AnalysisResult(NOT_CHART_MESSAGE), False
+        prepared = [(i.prepared.data, i.prepared.mime_type, i.prepared.detail) for i in images]
+        download_time = time.monotonic() - started
+        submitted = time.monotonic()
+        result = await analysis_scheduler.submit(
+            user_id, get_album_recommendation, prepared, on_text, prompt, route,
+            on_position=on_position
+        )
+    result.queue_time = max(0.0, time.monotonic() - submitted - result.latency)
+    result.download_time = download_time
+    return result, True
+
+
+async def send_analysis(message: types.Message, analysis_text: str, stream: StreamingMessage = None) -> bool:
+    """
+    Відправляє результат: HTML один раз розбирається локально в сутності (entities),
+    тож помилка розбору на сервері неможлива, а текст ділиться на частини до MESSAGE_LIMIT -
+    по одному запиту до Telegram на частину. Альбом ділиться насамперед між графіками.
+    Якщо передано stream, перша частина замінює повідомлення стріму на місці.
+    Повертає True, якщо повідомлення стріму стало першою частиною відповіді.
+    """
+    plain, entities = html_to_entities(analysis_text)
+    parts = split_entities(plain, entities, MESSAGE_LIMIT, (ALBUM_SEPARATOR, "\n\n", "\n", " "))
+    finalized_in_place = bool(stream) and await stream.finalize(*parts[0])
+    for text, part_entities in parts[finalized_in_place:]:
+        try:
+            await message.answer(text, entities=part_entities)
+        except BadRequest as e:
+            # Сутність, яку Telegram не прийняв (наприклад, посилання з некоректним URL)
+            logging.error(f"Telegram відхилив сутності відповіді: {e}")
+            analysis_metrics.increment("html_stripped")
+            await message.answer(text, entities=[])
+    return finalized_in_place
+
+
+def image_file_of(message: types.Message):
+    """Найменший достатній для аналізу розмір фото або документ-зображення (None - не зображення)"""
+    if message.photo:
+        return select_photo_size(message.photo, IMAGE_MAX_SIDE)
+    if message.document and message.document.mime_type in IMAGE_DOCUMENT_MIME_TYPES:
+        return message.document
+    return None
+
+
+def image_file_payload(image_file) -> dict:
+    """PhotoSize / Document у вигляді словника для задачі в черзі"""
+    kind = "document" if isinstance(image_file, types.Document) else "photo"
+    return {"kind": kind, **image_file.to_python()}
+
+
+def image_file_from_payload(payload: dict):
+    """Відновлює PhotoSize / Document із задачі в черзі"""
+    payload = dict(payload)
+    kind = payload.pop("kind", "photo")
+    return (types.Document if kind == "document" else types.PhotoSize).to_object(payload)
+
+
+def cancelled_text(reason: str, refund: bool) -> str:
+    """Текст повідомлення "Аналізую..." після скасування"""
+    text = "❌ Аналіз скасовано: надіслано новий графік." if reason == SUPERSEDED else "❌ Аналіз скасовано."
+    if refund:
+        text += " Безкоштовну спробу не списано."
+    return text
+
+
+async def notify_cancelled_jobs(bot, jobs: list, reason: str):
+    """Оновлює повідомлення задач, знятих з черги БД до початку виконання (решту оновить воркер)"""
+    for job in jobs:
+        if job["previous_status"] != "queued":
+            continue
+        analysis_metrics.increment("cancelled")
+        try:
+            await bot.edit_message_text(
+                cancelled_text(reason, job["refund"]), job["chat_id"], job["processing_message_id"]
+            )
+        except Exception as e:
+            logging.warning(f"Не вдалося оновити повідомлення скасованої задачі {job['id']}: {e}")
+
+
+async def routing_load():
+    """
+    Навантаження для routing_policy: (глибина черги, середній час обробки).
+    З ANALYSIS_BACKEND=queue до черги планувальника процесу додаються задачі,
+    що чекають на воркер в analysis_jobs.
+    """
+    load = analysis_scheduler.stats()
+    queue_depth = load["queue_depth"]
+    if ANALYSIS_BACKEND == "queue":
+        try:
+            queue_depth += await db.count_queued_analysis_jobs()
+        except Exception as e:
+            logging.warning(f"Не вдалося отримати глибину черги аналізів: {e}")
+    return queue_depth, load["service_avg"]
+
+
+async def analyse_and_reply(message: types.Message, image_files: list, processing_message: types.Message,
+                            subscribed: bool, refund: bool) -> Tuple[bool, Optional[AnalysisResult]]:
+    """
+    Аналізує графік (альбом) і надсилає відповідь - спільна частина бота (ANALYSIS_BACKEND=local)
+    та воркера черги (worker.py). processing_message - повідомлення "Аналізую..." з кнопкою скасування:
+    воно стає відповіддю або видаляється. refund - чи зарезервовано безкоштовну спробу.
+    Повертає (чи треба повернути спробу, результат аналізу або None, якщо аналізу не було).
+    Неочікувані помилки передаються далі, а повідомлення залишається (його прибирає бот,
+    а воркер повторює задачу).
+    """
+    user_id = message.from_user.id
+
+    async def finish(finalized_in_place: bool = False, result: AnalysisResult = None):
+        if not finalized_in_place:
+            try:
+                await processing_message.delete()
+            except Exception as delete_error:
+                logging.warning(f"Не вдалося видалити повідомлення про аналіз: {delete_error}")
+        return refund, result
+
+    # Структуровану (JSON) відповідь немає сенсу показувати по частинах
+    streaming = ANALYSIS_STREAMING and ANALYSIS_OUTPUT_MODE != "structured"
+    stream = (
+        StreamingMessage(processing_message, STREAM_EDIT_INTERVAL, reply_markup=cancel_analysis_keyboard)
+        if streaming else None
+    )
+
+    async def show_queue_position(position: int):
+        await processing_message.edit_text(
+            f"⏳ Ви <b>#{position}</b> у черзі на аналіз. Зачекайте, будь ласка...",
+            reply_markup=cancel_analysis_keyboard
+        )
+
+    # Версія промптів (A/B) - стабільна для користувача
+    prompt = prompt_registry.select(user_id)
+    # Модель, ліміт токенів і detail - за підпискою та поточним навантаженням
+    route = routing_policy.route(subscribed, *await routing_load())
+    analysis_metrics.record_route(route)
+    # Фільтр графіків для підписників за замовчуванням не застосовується
+    check_chart = not subscribed or CHART_FILTER_SUBSCRIBERS
+
+    try:
+        if len(image_files) > 1:
+            analysis = analyse_album(
+                message, image_files, show_queue_position,
+                on_text=stream.update if stream and ALBUM_MODE != "parallel" else None,
+                prompt=prompt,
+                route=route,
+                check_chart=check_chart,
+            )
+        else:
+            analysis = analyse_photo(
+                message, image_files[0], show_queue_position,
+                on_text=stream.update if stream else None,
+                prompt=prompt,
+                route=route,
+                check_chart=check_chart,
+            )
+        # Кнопка "Скасувати" (або новий графік) перериває аналіз на будь-якому етапі
+        result, uses_free_trade = await active_analyses.run(user_id, processing_message.message_id, analysis)
+    except AnalysisCancelled as e:
+        if stream:
+            stream.stop()
+        analysis_metrics.increment("cancelled")
+        try:
+            await processing_message.edit_text(cancelled_text(e.reason, refund))
+        except Exception as edit_error:
+            logging.warning(f"Не вдалося оновити повідомлення про скасування: {edit_error}")
+            return await finish()
+        return await finish(finalized_in_place=True)
+    except QueueFull:
+        await message.answer(QUEUE_FULL_MESSAGE)
+        return await finish()
+    except ImageTooLarge:
+        await message.answer(
+            "⚠️ Зображення занадто велике. Надішліть, будь ласка, скріншот графіка меншого розміру."
+        )
+        return await finish()
+
+    result.route = route
+    # Спроба залишається списаною лише за успішний аналіз, що її потребує
+    if uses_free_trade and not result.failed:
+        refund = False
+
+    # Додаємо рекомендацію про управління капіталом
+    capital_management = (
+        "\n\n"
+        "💰 <b>Управління капіталом:</b>\n"
+        "Рекомендується заходити в угоду з <b>не більше 10% від загального банку</b>. "
+        "Це дозволить вам залишатися в грі навіть при серії невдалих угод і убезпечить ваш депозит від значних втрат."
+    )
+    analysis_text = result.text + capital_management
+
+    # Завершуємо повідомлення на місці (стрімінг) або надсилаємо нове
+    finalized_in_place = await send_analysis(message, analysis_text, stream)
+
+    analysis_metrics.record(user_id, result)
+
+    # Історія пишеться у фоні - відповідь не чекає на INSERT
+    if not result.failed:
+        history_writer.record(user_id, ",".join(f.file_unique_id for f in image_files), result)
+    return await finish(finalized_in_place, result)
+
+
+@rate_limit("photo")
+async def handle_photo(message: types.Message, album: Optional[List[types.Message]] = None):
+    """
+    Хендлер для обробки надісланих фотографій та зображень-документів (PNG без стиснення).
+    Альбом (media group) збирає AlbumMiddleware і аналізується як одна угода.
+    З ANALYSIS_BACKEND=queue аналіз ставиться в чергу БД і виконується процесом worker.py.
+    """
+    image_files = [f for f in map(image_file_of, album or [message]) if f][:ALBUM_MAX_IMAGES]
+    if not image_files:
         return
 
-    # Перевіряємо, чи не закінчився термін підписки
-    subscription_expires_at = user["subscription_expires_at"]
-    if subscription_expires_at and subscription_expires_at.tzinfo is None:
-        subscription_expires_at = subscription_expires_at.replace(tzinfo=timezone.utc)
+    user_id = message.from_user.id
+    if ANALYSIS_SUPERSEDE:
+        active_analyses.supersede(user_id)
+        if ANALYSIS_BACKEND == "queue":
+            jobs = await db.cancel_analysis_jobs(user_id, reason=SUPERSEDED)
+            await notify_cancelled_jobs(message.bot, jobs, SUPERSEDED)
+
+    # Перевірка доступу та резервування безкоштовної спроби - один запит до БД
+    reservation = await db.reserve_analysis(user_id)
 
-    if user["is_subscribed"] and subscription_expires_at < datetime.now(timezone.utc):
-        # Тут можна було б оновити статус, але для простоти просто повідомимо
+    if not reservation:
+        await message.answer("Будь ласка, почніть з команди /start, щоб я міг вас зареєструвати.")
+        return
+
+    if reservation["status"] == "expired":
         await message.answer(
             "Термін вашої підписки закінчився. Будь ласка, поновіть її, щоб продовжити користуватися ботом.",
             reply_markup=subscribe_keyboard
         )
         return
 
-    # Основна логіка перевірки доступу
-    if not user["is_subscribed"] and user["free_trades_left"] <= 0:
+    if reservation["status"] == "no_trades":
         await message.answer(
             "На жаль, ваші безкоштовні спроби закінчилися. "
             "Щоб продовжити, будь ласка, оформіть підписку.",
@@ -42,64 +512,72 @@ async def handle_photo(message: types.Message):
         )
         return
 
-    processing_message = await message.answer("🔄 Аналізую ваш графік... Це може зайняти до хвилини.")
+    # Спробу повертаємо, якщо аналіз не відбувся або не мав її списувати
+    refund = reservation["status"] == "reserved"
+    subscribed = reservation["status"] == "subscribed"
+    processing_message = None
+    # Повідомленням "Аналізую..." розпоряджається analyse_and_reply або воркер
+    handed_over = False
 
     try:
-        # Отримуємо файл фотографії
-        photo = message.photo[-1]  # Беремо найбільший розмір
-        file_info = await message.bot.get_file(photo.file_id)
-        
-        # Завантажуємо фото в пам'ять
-        photo_bytes = io.BytesIO()
-        await message.bot.download_file(file_info.file_path, photo_bytes)
-        photo_bytes.seek(0)
-        
-        # Кодуємо в base64
-        base64_image = base64.b64encode(photo_bytes.read()).decode('utf-8')
-        mime_type = "image/jpeg"
-
-        # Отримуємо аналіз від AI
-        analysis_text = await get_trade_recommendation(base64_image, mime_type)
-        
-        # Додаємо рекомендацію про управління капіталом
-        capital_management = (
-            "\n\n"
-            "💰 <b>Управління капіталом:</b>\n"
-            "Рекомендується заходити в угоду з <b>не більше 10% від загального банку</b>. "
-            "Це дозволить вам залишатися в грі навіть при серії невдалих угод і убезпечить ваш депозит від значних втрат."
-        )
-        analysis_text += capital_management
+        if ANALYSIS_BACKEND == "queue":
+            processing_message = await message.answer(
+                "🔄 Графік у черзі на аналіз. Це може зайняти до хвилини.",
+                reply_markup=cancel_analysis_keyboard
+            )
+            job_id = await db.enqueue_analysis_job(
+                user_id, message.chat.id, message.message_id, processing_message.message_id,
+                [image_file_payload(f) for f in image_files], subscribed, refund,
+                ANALYSIS_USER_QUEUE_LIMIT, ANALYSIS_QUEUE_LIMIT, JOB_MAX_ATTEMPTS
+            )
+            if job_id is None:
+                await message.answer(QUEUE_FULL_MESSAGE)
+                return
+            # Спробу тепер повертає воркер (або скасування) разом із завершенням задачі
+            refund = False
+            handed_over = True
+            logging.info(f"Аналіз користувача {user_id} поставлено в чергу: задача {job_id}")
+            return
 
-        # Списуємо безкоштовну спробу, якщо це не підписник
-        if not user["is_subscribed"]:
-            await db.use_free_trade(user_id)
-            
-        # Відправляємо результат з обробкою HTML помилок
+        # Не завантажуємо фото, якщо черга аналізів вже переповнена
         try:
-            await message.answer(analysis_text, parse_mode="HTML")
-        except Exception as html_error:
-            # Якщо HTML невалідний, спробуємо видалити всі HTML теги і відправити
-            logging.error(f"Помилка HTML форматування: {html_error}")
-            try:
-                from bot.ai import remove_all_html_tags
-                clean_text = remove_all_html_tags(analysis_text)
-                await message.answer(
-                    "🔄 <b>Результат аналізу</b> (форматування спрощено через технічні обмеження):\n\n" + clean_text,
-                    parse_mode="HTML"
-                )
-            except Exception:
-                # Якщо й це не працює, відправляємо зовсім без форматування
-                await message.answer(
-                    "Результат аналізу (без форматування):\n\n" + analysis_text
-                )
+            analysis_scheduler.ensure_capacity(user_id)
+        except QueueFull:
+            await message.answer(QUEUE_FULL_MESSAGE)
+            return
+
+        processing_message = await message.answer(PROCESSING_MESSAGE, reply_markup=cancel_analysis_keyboard)
+        refund, _ = await analyse_and_reply(message, image_files, processing_message, subscribed, refund)
+        handed_over = True
 
     except Exception as e:
-        logging.error(f"Помилка під час аналізу угоди для користувача {user['user_id']}: {e}")
+        logging.error(f"Помилка під час аналізу угоди для користувача {user_id}: {e}")
         await message.answer("На жаль, сталася помилка під час обробки вашого запиту. Спробуйте ще раз пізніше.")
     finally:
-        await processing_message.delete()
+        if refund:
+            await db.refund_free_trade(user_id)
+        if processing_message and not handed_over:
+            await processing_message.delete()
+
+
+async def callback_cancel_analysis(callback: types.CallbackQuery):
+    """Кнопка "Скасувати" під повідомленням "Аналізую..." """
+    user_id = callback.from_user.id
+    message_id = callback.message.message_id
+    if active_analyses.cancel(user_id, message_id):
+        await callback.answer("Скасовую аналіз...")
+        return
+    # Аналіз у черзі БД або в процесі воркера: воркер побачить скасування при продовженні оренди
+    if ANALYSIS_BACKEND == "queue":
+        jobs = await db.cancel_analysis_jobs(user_id, message_id)
+        if jobs:
+            await notify_cancelled_jobs(callback.bot, jobs, CANCELLED_BY_USER)
+            await callback.answer("Скасовую аналіз...")
+            return
+    await callback.answer("Аналіз уже завершено")
 
 
 def register_trade_handlers(dp: Dispatcher):
     """Реєструє хендлери для обробки торгових запитів."""
-    dp.register_message_handler(handle_photo, content_types=["photo"]) 
\ No newline at end of file
+    dp.register_message_handler(handle_photo, content_types=["photo", "document"])
+    dp.register_callback_query_handler(callback_cancel_analysis, text="cancel_analysis") 
\ No newline at end of file
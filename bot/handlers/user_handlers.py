@@ -1,7 +1,7 @@
 from aiogram import Dispatcher, types
 from db import queries as db
 from bot.keyboards.reply import main_menu_keyboard, subscribe_keyboard
-from datetime import datetime, timezone
+from bot.middlewares.throttling import rate_limit
 from typing import Union
 
 
@@ -11,21 +11,19 @@ async def get_profile_data(user_id: int):
     if not user:
         return "Я не можу знайти ваш профіль. Будь ласка, натисніть /start, щоб зареєструватися.", None
 
-    current_time = datetime.now(timezone.utc)
-    is_subscribed = user["is_subscribed"]
+    # Те саме правило, що й при резервуванні аналізу та в статистиці (db.cache.subscription_active)
+    is_subscribed = user.subscription_active
     subscription_expires_at = user["subscription_expires_at"]
 
-    # Якщо з бази приходить дата без часової зони, робимо її aware (UTC)
-    if subscription_expires_at and subscription_expires_at.tzinfo is None:
-        subscription_expires_at = subscription_expires_at.replace(tzinfo=timezone.utc)
-
-    if is_subscribed and subscription_expires_at and subscription_expires_at < current_time:
-        is_subscribed = False
+    if user["is_subscribed"] and not is_subscribed:
         await db.update_subscription_status(user["user_id"], False)
 
-    if is_subscribed and subscription_expires_at:
+    if is_subscribed:
         subscription_status = "✅ Активна"
-        expires_text = f"<b>Діє до:</b> {subscription_expires_at.strftime('%d.%m.%Y %H:%M')} UTC"
+        if subscription_expires_at:
+            expires_text = f"<b>Діє до:</b> {subscription_expires_at.strftime('%d.%m.%Y %H:%M')} UTC"
+        else:
+            expires_text = "<b>Діє:</b> безстроково"
     else:
         subscription_status = "❌ Неактивна"
         expires_text = ""
@@ -145,6 +143,7 @@ async def show_profile(message_or_callback: Union[types.Message, types.CallbackQ
         await message_or_callback.answer()
 
 
+@rate_limit("profile")
 async def cmd_profile(message: types.Message):
     """Обробник команди 'Профіль'"""
     await show_profile(message)
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from config import HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL, HISTORY_QUEUE_LIMIT
+from db import queries as db
+
+
+class HistoryWriter:
+    """
+    Write-behind запис історії аналізів: обробник лише кладе запис у чергу,
+    а фонова задача зберігає записи пакетами (до batch_size або раз на flush_interval).
+    Якщо черга переповнена (БД недоступна), нові записи відкидаються, а не блокують бота.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, queue_limit: int, max_attempts: int = 3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_limit = queue_limit
+        self.max_attempts = max_attempts
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+
+    async def start(self):
+        if self._task:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_limit)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Зупиняє фонову задачу та дописує все, що залишилось у черзі"""
+        if not self._task:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        while not self._queue.empty():
+            await self._write(self._take(self.batch_size))
+
+    def record(self, user_id: int, file_unique_id: str, result):
+        """Додає результат аналізу (bot.ai.AnalysisResult) до черги запису"""
+        if self._queue is None:
+            return
+        # Для структурованої відповіді зберігаємо поля, HTML відтворюється при читанні
+        fields = json.dumps(result.fields, ensure_ascii=False) if result.fields else None
+        record = (
+            user_id,
+            file_unique_id,
+            result.model,
+            result.prompt_tokens,
+            result.cached_tokens,
+            result.completion_tokens,
+            int(result.latency * 1000),
+            None if fields else result.text,
+            fields,
+            datetime.now(timezone.utc).replace(tzinfo=None),
+        )
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.warning("Черга запису історії аналізів переповнена, запис відкинуто")
+
+    def _take(self, limit: int) -> List[tuple]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                # Добираємо пакет, поки не минув інтервал
+                deadline = loop.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                    batch.extend(self._take(self.batch_size - len(batch)))
+                await self._write(batch)
+                batch = []
+        except asyncio.CancelledError:
+            # Зупинка: пакет, що вже вийняли з черги, не губимо
+            await self._write(batch)
+            raise
+
+    async def _write(self, batch: List[tuple]):
+        if not batch:
+            return
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await db.add_analyses(batch)
+                self.written += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                logging.error(f"Помилка запису історії аналізів (спроба {attempt}): {e}")
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(self.flush_interval * attempt)
+        self.dropped += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+        }
+
+
+history_writer = HistoryWriter(
+    batch_size=HISTORY_BATCH_SIZE,
+    flush_interval=HISTORY_FLUSH_INTERVAL,
+    queue_limit=HISTORY_QUEUE_LIMIT,
+)
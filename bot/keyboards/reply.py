@@ -33,6 +33,15 @@ subscription_info_keyboard = InlineKeyboardMarkup(
     ]
 )
 
+# Кнопка скасування аналізу під повідомленням "Аналізую..."
+cancel_analysis_keyboard = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel_analysis")
+        ]
+    ]
+)
+
 # =============== АДМІНІСТРАТИВНІ КЛАВІАТУРИ ===============
 
 # Головна адмін панель
@@ -49,6 +58,39 @@ admin_main_keyboard = InlineKeyboardMarkup(
     ]
 )
 
+# Загальна статистика: розділи з детальними метриками
+admin_stats_keyboard = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="⏳ Черга", callback_data="admin_stats_queue"),
+            InlineKeyboardButton(text="🗂 Кеші", callback_data="admin_stats_caches")
+        ],
+        [
+            InlineKeyboardButton(text="🤖 OpenAI", callback_data="admin_stats_openai"),
+            InlineKeyboardButton(text="💵 Вартість", callback_data="admin_stats_cost")
+        ],
+        [
+            InlineKeyboardButton(text="🧪 Промпти", callback_data="admin_stats_prompts"),
+            InlineKeyboardButton(text="🐘 БД і ресурси", callback_data="admin_stats_resources")
+        ],
+        [
+            InlineKeyboardButton(text="🔄 Оновити", callback_data="admin_stats"),
+            InlineKeyboardButton(text="🔙 Назад до головної", callback_data="admin_main")
+        ]
+    ]
+)
+
+# Розділ статистики
+def admin_stats_section_keyboard(section: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="🔄 Оновити", callback_data=f"admin_stats_{section}"),
+                InlineKeyboardButton(text="🔙 До статистики", callback_data="admin_stats")
+            ]
+        ]
+    )
+
 # Управління користувачами
 admin_users_keyboard = InlineKeyboardMarkup(
     inline_keyboard=[
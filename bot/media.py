@@ -0,0 +1,399 @@
+"""
+Завантаження, підготовка та кодування зображень графіків.
+Замір пам'яті під одночасними аналізами - benchmarks/media_memory.py.
+"""
+import asyncio
+import binascii
+import io
+from typing import Dict, List, Optional
+
+from PIL import Image, ImageChops
+
+from bot.chart_filter import chart_score
+from config import (
+    IMAGE_MEMORY_BUDGET, IMAGE_BUFFER_POOL_BYTES, IMAGE_DECODE_MEMORY, IMAGE_MAX_PIXELS,
+)
+
+# Розмір зменшеного зображення для dHash (17x16 -> 256 бітів): у 64-бітному хеші
+# різні графіки з одного шаблону біржі відрізнялися лише на кілька бітів
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+# Більші зображення Pillow не декодує взагалі (DecompressionBombError)
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+
+def perceptual_hash(image_bytes) -> int:
+    """
+    Обчислює перцептивний хеш (dHash) зображення.
+    Перекодовані або трохи обрізані копії графіка дають близькі хеші.
+    """
+    with Image.open(MemoryReader(image_bytes)) as image:
+        image.draft("L", (HASH_SIZE * 16, HASH_SIZE * 16))
+        pixels = list(
+            image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).getdata()
+        )
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Кількість бітів, якими відрізняються два хеші"""
+    return bin(a ^ b).count("1")
+
+
+# =============== ПІДГОТОВКА ЗОБРАЖЕННЯ ДЛЯ OPENAI ===============
+
+# Параметри підрахунку токенів зображення OpenAI (detail=high)
+TILE_SIZE = 512
+TILE_TOKENS = 170
+BASE_TOKENS = 85
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+# Типи документів, які приймаються як графіки
+IMAGE_DOCUMENT_MIME_TYPES = ("image/png", "image/jpeg", "image/webp")
+
+
+class PreparedImage:
+    __slots__ = (
+        "data", "mime_type", "width", "height", "detail",
+        "original_size", "original_tokens", "tokens", "chart_score",
+    )
+
+    def __init__(self, data, mime_type: str, width: int, height: int, detail: str,
+                 original_size: int, original_tokens: int):
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+        self.detail = detail
+        self.original_size = original_size
+        self.original_tokens = original_tokens
+        self.tokens = estimate_image_tokens(width, height, detail)
+        # Схожість на графік (bot.chart_filter), None - не оцінювалась
+        self.chart_score: Optional[float] = None
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_size - len(self.data)
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.original_tokens - self.tokens
+
+
+def select_photo_size(photos, target_side: int):
+    """Найменший PhotoSize, довша сторона якого не менша за target_side (інакше найбільший)"""
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if max(photo.width, photo.height) >= target_side:
+            return photo
+    return photos[-1]
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """Оцінка кількості токенів зображення за правилами OpenAI (плитки 512x512)"""
+    if detail == "low":
+        return BASE_TOKENS
+    scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // TILE_SIZE) * -(-int(height) // TILE_SIZE)
+    return BASE_TOKENS + TILE_TOKENS * tiles
+
+
+def choose_detail(width: int, height: int) -> str:
+    """low, якщо зображення вміщується в одну плитку - high нічого не додасть"""
+    return "low" if max(width, height) <= TILE_SIZE else "high"
+
+
+def crop_uniform_borders(image: Image.Image, tolerance: int = 12) -> Image.Image:
+    """Обрізає однотонні поля навколо графіка (колір визначається за кутовим пікселем)"""
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    diff = ImageChops.difference(image, background).convert("L")
+    bbox = diff.point(lambda value: 255 if value > tolerance else 0).getbbox()
+    if bbox and bbox != (0, 0) + image.size:
+        return image.crop(bbox)
+    return image
+
+
+def _fit_size(width: int, height: int, max_side: int):
+    """
+    Розмір, що вміщується в max_side, з підрізанням до межі плитки,
+    якщо сторона лише трохи її перевищує (це економить цілий ряд плиток).
+    """
+    scale = min(1.0, max_side / max(width, height))
+    for dimension in (width, height):
+        side = dimension * scale
+        boundary = (int(side) // TILE_SIZE) * TILE_SIZE
+        if boundary and side - boundary <= side * 0.12:
+            scale *= boundary / side
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def prepare_image(image_bytes, max_side: int, quality: int, crop_borders: bool,
+                  score_chart: bool = False) -> PreparedImage:
+    """
+    Готує зображення до відправки: обрізає поля, зменшує до max_side
+    та перекодовує в JPEG. Якщо нічого не змінилось - залишає оригінальний JPEG.
+    score_chart - заодно оцінити схожість на графік (зображення вже декодоване).
+    """
+    with Image.open(MemoryReader(image_bytes)) as image:
+        original_format = image.format
+        original_dimensions = image.size
+        original_tokens = estimate_image_tokens(image.width, image.height)
+
+        # Зменшуємо ще на етапі декодування JPEG, якщо це можливо
+        image.draft("RGB", (max_side, max_side))
+        image = image.convert("RGB")
+        cropped = crop_uniform_borders(image) if crop_borders else image
+        width, height = _fit_size(cropped.width, cropped.height, max_side)
+        unchanged = cropped is image and (width, height) == original_dimensions
+
+        if unchanged and original_format == "JPEG":
+            data = image_bytes
+        else:
+            if (width, height) != cropped.size:
+                cropped = cropped.resize((width, height), Image.LANCZOS)
+            output = io.BytesIO()
+            cropped.save(output, "JPEG", quality=quality, optimize=True)
+            data = output.getvalue()
+        score = chart_score(cropped) if score_chart else None
+
+    prepared = PreparedImage(
+        data, "image/jpeg", width, height, choose_detail(width, height),
+        original_size=len(image_bytes), original_tokens=original_tokens,
+    )
+    prepared.chart_score = score
+    return prepared
+
+
+# =============== ЗАВАНТАЖЕННЯ ТА КОДУВАННЯ БЕЗ ЗАЙВИХ КОПІЙ ===============
+
+# Розмір шматка для base64 (кратний 3, щоб шматки кодувалися без "=" посередині)
+_B64_CHUNK = 3 * 64 * 1024
+
+
+class ImageTooLarge(Exception):
+    """Файл зображення перевищує IMAGE_MAX_DOWNLOAD_BYTES або IMAGE_MAX_PIXELS"""
+
+
+def buffer_capacity(size: int) -> int:
+    """Місткість буфера з пулу під файл size байт (степінь двійки, щонайменше 64 КБ)"""
+    return 1 << max(16, (size - 1).bit_length())
+
+
+class BufferPool:
+    """
+    Пул повторно використовуваних буферів для завантаження зображень.
+    Розміри округлюються до степеня двійки, щоб буфери підходили різним файлам.
+    Вільні буфери зберігаються, поки їх сумарний розмір не перевищує max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._free: Dict[int, List[bytearray]] = {}
+        self.retained = 0
+        self.reused = 0
+        self.allocated = 0
+
+    def acquire(self, size: int) -> bytearray:
+        capacity = buffer_capacity(size)
+        free = self._free.get(capacity)
+        if free:
+            self.retained -= capacity
+            self.reused += 1
+            return free.pop()
+        self.allocated += 1
+        return bytearray(capacity)
+
+    def release(self, buffer: bytearray):
+        if self.retained + len(buffer) <= self.max_bytes:
+            self._free.setdefault(len(buffer), []).append(buffer)
+            self.retained += len(buffer)
+
+    def stats(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "retained": self.retained,
+            "reused": self.reused,
+            "allocated": self.allocated,
+        }
+
+
+class MemoryBudget:
+    """
+    Обмежує сумарну пам'ять, зайняту зображеннями в обробці.
+    Запити, що не вміщуються в бюджет, чекають на звільнення пам'яті.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.peak_request = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    async def acquire(self, size: int):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        # Один запит, більший за весь бюджет, пропускаємо лише коли інших немає
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_use == 0 or self.in_use + size <= self.limit)
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+            self.peak_request = max(self.peak_request, size)
+
+    def grow(self, size: int):
+        """
+        Збільшує резерв уже допущеного запиту без очікування: запит, що чекає,
+        тримаючи резерв, міг би разом з іншими такими ж заблокувати бюджет назавжди.
+        """
+        self.in_use += size
+        self.peak = max(self.peak, self.in_use)
+
+    async def release(self, size: int):
+        async with self._condition:
+            self.in_use -= size
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "peak": self.peak,
+            "peak_request": self.peak_request,
+        }
+
+
+class _BufferWriter(io.RawIOBase):
+    """Файлоподібний об'єкт, що пише завантаження прямо в наперед виділений буфер"""
+
+    def __init__(self, buffer: bytearray):
+        self._view = memoryview(buffer)
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, chunk) -> int:
+        end = self.size + len(chunk)
+        if end > len(self._view):
+            raise ValueError("Файл більший, ніж заявлений розмір")
+        self._view[self.size:end] = chunk
+        self.size = end
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return 0
+
+    def getbuffer(self) -> memoryview:
+        return self._view[:self.size]
+
+
+class MemoryReader(io.RawIOBase):
+    """Читання з memoryview без копіювання всього буфера (для Pillow)"""
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target) -> int:
+        count = min(len(target), len(self._view) - self._position)
+        target[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, min(offset, len(self._view)))
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def estimate_peak_memory(file_size: int, pooled: bool = True) -> int:
+    """
+    Оцінка піку пам'яті на запит: сирий файл + base64 буфер + рядок data URL.
+    pooled - файл лежить у буфері з пулу, який займає всю свою місткість.
+    """
+    encoded = 4 * -(-file_size // 3)
+    return (buffer_capacity(file_size) if pooled else file_size) + 2 * encoded
+
+
+# Повних копій растрового зображення одночасно в prepare_image: декодоване,
+# RGB та (з обрізкою полів) фон і різниця для crop_uniform_borders
+_DECODE_COPIES = 2
+_CROP_DECODE_COPIES = 4
+
+
+def estimate_decode_memory(image_bytes, max_side: int, crop_borders: bool) -> int:
+    """
+    Оцінка пам'яті на декодування в prepare_image (perceptual_hash потребує менше).
+    Читає лише заголовок; Pillow тримає піксель RGB у 4 байтах.
+    Зображення більше за IMAGE_MAX_PIXELS відхиляються з ImageTooLarge.
+    """
+    with Image.open(MemoryReader(image_bytes)) as image:
+        if image.width * image.height > IMAGE_MAX_PIXELS:
+            raise ImageTooLarge()
+        # draft лише налаштовує декодер JPEG на зменшений розмір, нічого не декодуючи
+        image.draft("RGB", (max_side, max_side))
+        pixels = image.width * image.height
+    return pixels * 4 * (_CROP_DECODE_COPIES if crop_borders else _DECODE_COPIES)
+
+
+async def download_to_buffer(bot, file_path: str, file_size: int, pool: BufferPool):
+    """
+    Завантажує файл у буфер з пулу без проміжного BytesIO.
+    Повертає (буфер для повернення в пул, memoryview з даними).
+    """
+    buffer = pool.acquire(file_size)
+    writer = _BufferWriter(buffer)
+    try:
+        await bot.download_file(file_path, writer, seek=False)
+    except Exception:
+        pool.release(buffer)
+        raise
+    return buffer, writer.getbuffer()
+
+
+def encode_data_url(data, mime_type: str) -> str:
+    """
+    Будує data URL один раз: base64 кодується шматками прямо в буфер
+    потрібного розміру, а рядок створюється єдиним декодуванням.
+    """
+    view = memoryview(data)
+    prefix = f"data:{mime_type};base64,".encode("ascii")
+    output = bytearray(len(prefix) + 4 * -(-len(view) // 3))
+    output[:len(prefix)] = prefix
+    position = len(prefix)
+    for start in range(0, len(view), _B64_CHUNK):
+        encoded = binascii.b2a_base64(view[start:start + _B64_CHUNK], newline=False)
+        output[position:position + len(encoded)] = encoded
+        position += len(encoded)
+    return output.decode("ascii")
+
+
+# IMAGE_MEMORY_BUDGET ділиться між вільними буферами пулу, декодуванням і файлами
+# в обробці; декодування має окремий бюджет, бо його резерв береться, коли запит
+# уже тримає резерв на файл (очікування в одному бюджеті могло б заблокувати його)
+image_buffers = BufferPool(max_bytes=IMAGE_BUFFER_POOL_BYTES)
+image_decodes = MemoryBudget(limit=IMAGE_DECODE_MEMORY)
+image_memory = MemoryBudget(limit=max(0, IMAGE_MEMORY_BUDGET - IMAGE_BUFFER_POOL_BYTES - IMAGE_DECODE_MEMORY))
+
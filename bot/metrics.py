@@ -0,0 +1,234 @@
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from config import METRICS_COST_DAYS
+from metrics import Histogram
+
+# Ціни OpenAI, $ за 1M токенів: (вхідні, кешовані вхідні, вихідні)
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+# Межі кошиків гістограм
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90)
+TOKENS_BUCKETS = (100, 250, 500, 1000, 1500, 2000, 3000, 5000, 8000, 13000)
+
+
+def model_price(model: Optional[str]):
+    """Ціна моделі; знімки на кшталт gpt-4.1-2025-04-14 мають ціну базової моделі"""
+    if not model:
+        return None
+    best = None
+    for name in MODEL_PRICES:
+        if model.startswith(name) and (best is None or len(name) > len(best)):
+            best = name
+    return MODEL_PRICES.get(best)
+
+
+def request_cost(model: Optional[str], prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    """Вартість запиту в доларах (0, якщо ціна моделі невідома)"""
+    price = model_price(model)
+    if price is None:
+        return 0.0
+    input_price, cached_price, output_price = price
+    return (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + completion_tokens * output_price
+    ) / 1_000_000
+
+
+def result_metrics(result) -> dict:
+    """
+    Метрики результату аналізу (bot.ai.AnalysisResult) для рядка analysis_jobs:
+    воркер записує їх разом із завершенням задачі, бот будує з них панелі статистики.
+    """
+    outcome = "cache" if result.model == "cache" else result.outcome
+    route = result.route
+    return {
+        "outcome": outcome,
+        "model": result.model,
+        "prompt_version": result.prompt_version,
+        "route": f"{route.tier}:{route.model}" if route else None,
+        "route_reason": route.reason if route else None,
+        "prompt_tokens": result.prompt_tokens,
+        "cached_tokens": result.cached_tokens,
+        "completion_tokens": result.completion_tokens,
+        "queue_ms": int(result.queue_time * 1000),
+        "download_ms": int(result.download_time * 1000),
+        "upload_ms": int(result.upload_time * 1000),
+        "latency_ms": int(result.latency * 1000),
+        "cost": request_cost(result.model, result.prompt_tokens, result.cached_tokens, result.completion_tokens),
+    }
+
+
+class PromptVersionStats:
+    """Показники однієї версії промптів: відмови, токени, вартість і латентність моделі"""
+    __slots__ = ("requests", "refusals", "errors", "prompt_tokens", "cached_tokens", "completion_tokens", "cost", "latency")
+
+    def __init__(self):
+        self.requests = 0
+        self.refusals = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.latency = Histogram(SECONDS_BUCKETS)
+
+    def summary(self) -> dict:
+        requests = self.requests or 1
+        return {
+            "requests": self.requests,
+            "refusal_rate": self.refusals / requests,
+            "error_rate": self.errors / requests,
+            "prompt_tokens": self.prompt_tokens / requests,
+            "completion_tokens": self.completion_tokens / requests,
+            "cached_ratio": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "cost": self.cost / requests,
+            "latency": (self.latency.mean, self.latency.percentile(0.95)),
+        }
+
+
+class AnalysisMetrics:
+    """
+    Метрики запитів до OpenAI в пам'яті процесу:
+    лічильники результатів і моделей, гістограми етапів і токенів,
+    вартість по днях та по користувачах за день (зберігаються останні cost_days днів).
+    """
+
+    def __init__(self, cost_days: int):
+        self.cost_days = cost_days
+        self.started_at = time.time()
+
+        self.outcomes = Counter()
+        self.models = Counter()
+        self.tokens = Counter()
+        self.histograms: Dict[str, Histogram] = {
+            "queue": Histogram(SECONDS_BUCKETS),
+            "download": Histogram(SECONDS_BUCKETS),
+            "upload": Histogram(SECONDS_BUCKETS),
+            "generation": Histogram(SECONDS_BUCKETS),
+            "total": Histogram(SECONDS_BUCKETS),
+            "prompt_tokens": Histogram(TOKENS_BUCKETS),
+            "completion_tokens": Histogram(TOKENS_BUCKETS),
+        }
+        # День (UTC) -> вартість, та день -> {user_id: вартість}
+        self.daily_cost: Dict[str, float] = {}
+        self.daily_requests = Counter()
+        self.user_cost: Dict[str, Counter] = {}
+        # Версія промптів -> показники (для вибору найдешевшої версії без втрати якості)
+        self.prompt_versions: Dict[str, PromptVersionStats] = {}
+        # Рішення маршрутизації: маршрут та причина переходу на дешевший
+        self.routes = Counter()
+        self.route_reasons = Counter()
+
+    def record(self, user_id: int, result):
+        """Враховує результат аналізу (bot.ai.AnalysisResult)"""
+        if result.model == "cache":
+            self.outcomes["cache"] += 1
+            return
+
+        outcome = result.outcome
+        self.outcomes[outcome] += 1
+        # Зображення, відхилене локальним фільтром, до моделі не надсилалось
+        if outcome == "not_chart":
+            return
+        if result.model:
+            self.models[result.model] += 1
+        self.tokens["prompt"] += result.prompt_tokens
+        self.tokens["cached"] += result.cached_tokens
+        self.tokens["completion"] += result.completion_tokens
+
+        generation = result.latency - result.upload_time
+        self.histograms["queue"].observe(result.queue_time)
+        self.histograms["download"].observe(result.download_time)
+        self.histograms["upload"].observe(result.upload_time)
+        self.histograms["generation"].observe(generation)
+        self.histograms["total"].observe(
+            result.queue_time + result.download_time + result.latency
+        )
+        if result.prompt_tokens:
+            self.histograms["prompt_tokens"].observe(result.prompt_tokens)
+            self.histograms["completion_tokens"].observe(result.completion_tokens)
+
+        cost = request_cost(result.model, result.prompt_tokens, result.cached_tokens, result.completion_tokens)
+        day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        if day not in self.daily_cost:
+            self._rotate(day)
+        self.daily_cost[day] += cost
+        self.daily_requests[day] += 1
+        self.user_cost[day][user_id] += cost
+
+        if result.prompt_version:
+            version = self.prompt_versions.get(result.prompt_version)
+            if version is None:
+                version = self.prompt_versions[result.prompt_version] = PromptVersionStats()
+            version.requests += 1
+            version.refusals += outcome == "refusal"
+            version.errors += outcome == "error"
+            version.prompt_tokens += result.prompt_tokens
+            version.cached_tokens += result.cached_tokens
+            version.completion_tokens += result.completion_tokens
+            version.cost += cost
+            if outcome != "error":
+                version.latency.observe(result.latency)
+
+    def record_route(self, route):
+        """Враховує рішення маршрутизації (bot.ai.Route)"""
+        self.routes[f"{route.tier}:{route.model}"] += 1
+        if route.reason:
+            self.route_reasons[route.reason] += 1
+
+    def increment(self, outcome: str):
+        """Додатковий результат, що стає відомим після відправки (наприклад, html_stripped)"""
+        self.outcomes[outcome] += 1
+
+    def _rotate(self, day: str):
+        self.daily_cost[day] = 0.0
+        self.user_cost[day] = Counter()
+        for old in sorted(self.daily_cost)[:-self.cost_days]:
+            del self.daily_cost[old]
+            del self.user_cost[old]
+            self.daily_requests.pop(old, None)
+
+    def cost_rollup(self, top: int = 5) -> dict:
+        """Вартість за сьогодні та попередні дні, найдорожчі користувачі за сьогодні"""
+        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        users = self.user_cost.get(today, Counter())
+        return {
+            "today": self.daily_cost.get(today, 0.0),
+            "today_requests": self.daily_requests.get(today, 0),
+            "days": sorted(self.daily_cost.items(), reverse=True),
+            "top_users": users.most_common(top),
+        }
+
+    def stats(self) -> dict:
+        prompt = self.tokens["prompt"]
+        return {
+            "outcomes": dict(self.outcomes),
+            "models": dict(self.models),
+            "prompt_tokens": prompt,
+            "cached_tokens": self.tokens["cached"],
+            "completion_tokens": self.tokens["completion"],
+            "cached_ratio": self.tokens["cached"] / prompt if prompt else 0.0,
+            "stages": {
+                name: (histogram.mean, histogram.percentile(0.95))
+                for name, histogram in self.histograms.items()
+                if name in ("queue", "download", "upload", "generation", "total")
+            },
+            "routes": dict(self.routes),
+            "route_reasons": dict(self.route_reasons),
+            "prompt_versions": {
+                name: version.summary() for name, version in sorted(self.prompt_versions.items())
+            },
+        }
+
+
+analysis_metrics = AnalysisMetrics(cost_days=METRICS_COST_DAYS)
@@ -0,0 +1,42 @@
+import asyncio
+from typing import Dict, List
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from config import ALBUM_COLLECT_WINDOW
+
+
+class AlbumMiddleware(BaseMiddleware):
+    """
+    Збирає повідомлення одного альбому (media_group_id), які Telegram
+    надсилає окремими оновленнями. Обробник викликається один раз - для
+    першого повідомлення - з усіма повідомленнями альбому в параметрі album.
+    Збираються лише фото та документи (графіки); відео, аудіо тощо з альбому
+    проходять далі окремими повідомленнями без затримки.
+    """
+
+    def __init__(self, window: float):
+        super().__init__()
+        self.window = window
+        self._albums: Dict[str, List[types.Message]] = {}
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if not message.media_group_id or not (message.photo or message.document):
+            return
+
+        album = self._albums.get(message.media_group_id)
+        if album is not None:
+            album.append(message)
+            raise CancelHandler()
+
+        album = self._albums[message.media_group_id] = [message]
+        # Решта повідомлень альбому надходить одразу слідом
+        await asyncio.sleep(self.window)
+        del self._albums[message.media_group_id]
+        album.sort(key=lambda m: m.message_id)
+        data["album"] = album
+
+
+album_middleware = AlbumMiddleware(ALBUM_COLLECT_WINDOW)
@@ -0,0 +1,142 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from config import (
+    THROTTLE_PHOTO_BURST, THROTTLE_PHOTO_PER_MINUTE,
+    THROTTLE_PROFILE_BURST, THROTTLE_PROFILE_PER_MINUTE,
+    THROTTLE_ADMIN_BURST, THROTTLE_ADMIN_PER_MINUTE,
+    THROTTLE_DEFAULT_BURST, THROTTLE_DEFAULT_PER_MINUTE,
+)
+
+SLOW_DOWN_MESSAGE = "⏳ Занадто багато запитів. Зачекайте {seconds} с і спробуйте знову."
+
+
+def rate_limit(key: str):
+    """Декоратор обробника: до якого бюджету запитів він належить"""
+    def decorator(handler):
+        handler.throttling_key = key
+        return handler
+    return decorator
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.notified = False
+
+
+class TokenBuckets:
+    """
+    Token bucket для кожного користувача в межах одного бюджету.
+    Відро, що простояло довше за час повного поповнення, нічим не відрізняється
+    від нового, тому видаляється - пам'ять пропорційна активним користувачам.
+    """
+
+    def __init__(self, burst: int, per_minute: float):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.idle_after = burst / self.rate if self.rate else float("inf")
+        # Порядок - за часом останнього звернення (найстаріші спереду)
+        self._buckets: "OrderedDict[int, _Bucket]" = OrderedDict()
+        self.throttled = 0
+
+    def consume(self, user_id: int) -> Optional[_Bucket]:
+        """Знімає один токен. Повертає відро, якщо токенів немає, інакше None"""
+        now = time.monotonic()
+        self._evict(now)
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(user_id)
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.notified = False
+            return None
+        self.throttled += 1
+        return bucket
+
+    def retry_in(self, bucket: _Bucket) -> int:
+        """Через скільки секунд з'явиться наступний токен"""
+        return max(1, int((1 - bucket.tokens) / self.rate + 0.999)) if self.rate else 60
+
+    def _evict(self, now: float):
+        while self._buckets:
+            user_id, bucket = next(iter(self._buckets.items()))
+            if now - bucket.updated < self.idle_after:
+                break
+            del self._buckets[user_id]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Обмежує частоту запитів кожного користувача окремо для кожного класу
+    обробників (аналіз фото, профіль, адмін-панель, решта). Замість відповіді
+    на кожен відхилений запит надсилає одне попередження, доки ліміт не скинеться.
+    """
+
+    def __init__(self, budgets: Dict[str, TokenBuckets], default_key: str = "default"):
+        super().__init__()
+        self.budgets = budgets
+        self.default_key = default_key
+
+    def _budget(self) -> TokenBuckets:
+        handler = current_handler.get()
+        key = getattr(handler, "throttling_key", self.default_key)
+        return self.budgets.get(key, self.budgets[self.default_key])
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        budgets = self._budget()
+        bucket = budgets.consume(message.from_user.id)
+        if bucket is None:
+            return
+        if not bucket.notified:
+            bucket.notified = True
+            try:
+                await message.reply(SLOW_DOWN_MESSAGE.format(seconds=budgets.retry_in(bucket)))
+            except Exception as e:
+                logging.warning(f"Не вдалося надіслати попередження про ліміт: {e}")
+        raise CancelHandler()
+
+    async def on_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        budgets = self._budget()
+        bucket = budgets.consume(callback.from_user.id)
+        if bucket is None:
+            return
+        if not bucket.notified:
+            bucket.notified = True
+            try:
+                await callback.answer(SLOW_DOWN_MESSAGE.format(seconds=budgets.retry_in(bucket)))
+            except Exception as e:
+                logging.warning(f"Не вдалося надіслати попередження про ліміт: {e}")
+        raise CancelHandler()
+
+    def stats(self) -> dict:
+        return {
+            key: {"users": len(budget), "throttled": budget.throttled}
+            for key, budget in self.budgets.items()
+        }
+
+
+throttling_middleware = ThrottlingMiddleware({
+    "photo": TokenBuckets(THROTTLE_PHOTO_BURST, THROTTLE_PHOTO_PER_MINUTE),
+    "profile": TokenBuckets(THROTTLE_PROFILE_BURST, THROTTLE_PROFILE_PER_MINUTE),
+    "admin": TokenBuckets(THROTTLE_ADMIN_BURST, THROTTLE_ADMIN_PER_MINUTE),
+    "default": TokenBuckets(THROTTLE_DEFAULT_BURST, THROTTLE_DEFAULT_PER_MINUTE),
+})
@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional
+
+import openai
+
+from config import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_MODEL, OPENAI_FALLBACK_MODEL,
+    OPENAI_DEADLINE, OPENAI_ATTEMPT_TIMEOUT, OPENAI_MAX_RETRIES,
+    OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX,
+    OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN,
+    OPENAI_HEDGE_PERCENTILE, OPENAI_HEDGE_MIN_SAMPLES,
+)
+
+
+class CircuitOpen(Exception):
+    """OpenAI тимчасово недоступний - запит відхилено без звернення до API"""
+
+
+# Помилки, після яких має сенс повторити запит: 408/409/429/5xx, мережа, таймаут
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,  # включно з APITimeoutError
+    asyncio.TimeoutError,
+)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, RETRYABLE_ERRORS):
+        return True
+    return isinstance(e, openai.APIStatusError) and (e.status_code in (408, 409) or e.status_code >= 500)
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Затримка з заголовків retry-after-ms / retry-after (секунди) або None"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # Формат HTTP-дати не підтримуємо - використовуємо власну затримку
+        return None
+    return None
+
+
+class CircuitBreaker:
+    """
+    Запобіжник для однієї моделі: після threshold помилок поспіль
+    відхиляє запити протягом cooldown секунд, потім пропускає один пробний.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trips = 0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release(self):
+        """Пробний запит скасовано, не дочекавшись результату"""
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+
+class ResilientOpenAI:
+    """
+    Обгортка над AsyncOpenAI для chat.completions.create:
+    - повтори з експоненційною затримкою та jitter, з урахуванням Retry-After;
+    - таймаут кожної спроби коротший за загальний дедлайн запиту;
+    - запобіжник (circuit breaker) окремо для кожної моделі;
+    - дубльований (hedged) запит, якщо відповідь затримується довше за перцентиль;
+    - резервна модель, коли основна недоступна.
+    Потокові запити повторюються й дублюються лише до отримання відповіді
+    (заголовків) - текст, що вже надійшов користувачу, не дублюється.
+    Читання потоку обмежує той самий дедлайн (iterate).
+    """
+
+    def __init__(
+        self,
+        model: str,
+        fallback_model: str,
+        deadline: float,
+        attempt_timeout: float,
+        max_retries: int,
+        backoff_base: float,
+        backoff_max: float,
+        breaker_threshold: int,
+        breaker_cooldown: float,
+        hedge_percentile: float,
+        hedge_min_samples: int,
+        samples: int = 200,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+    ):
+        self.model = model
+        self.fallback_model = fallback_model
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.api_key = api_key
+        self.base_url = base_url
+
+        self._client: Optional[openai.AsyncOpenAI] = None
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        # Тривалість успішних непотокових спроб для кожної моделі
+        self._latencies: Dict[str, Deque[float]] = {}
+        # Для потокових - час до відповіді (заголовків), без читання потоку
+        self._stream_latencies: Dict[str, Deque[float]] = {}
+        self._samples = samples
+
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self.rejected = 0
+        self.failures = 0
+        self.stream_timeouts = 0
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        if self._client is None:
+            try:
+                # Повтори виконуються тут, тому вбудовані повтори SDK вимкнені
+                self._client = openai.AsyncOpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url or None,
+                    timeout=self.attempt_timeout,
+                    max_retries=0,
+                )
+            except Exception as e:
+                logging.error(f"Помилка ініціалізації OpenAI клієнта: {e}")
+                raise
+        return self._client
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+        return breaker
+
+    async def create(self, model: Optional[str] = None, **kwargs):
+        """
+        Аналог client.chat.completions.create з повторами, запобіжником та
+        резервною моделлю. Піднімає CircuitOpen, якщо всі моделі недоступні.
+        """
+        self.requests += 1
+        deadline = time.monotonic() + self.deadline
+        models = [model or self.model]
+        if self.fallback_model and self.fallback_model not in models:
+            models.append(self.fallback_model)
+
+        last_error: Optional[Exception] = None
+        for index, current in enumerate(models):
+            if index:
+                self.fallbacks += 1
+                logging.warning(f"Перемикаємось на резервну модель {current}: {last_error}")
+            try:
+                return await self._with_retries(current, deadline, kwargs)
+            except CircuitOpen as e:
+                last_error = e
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+            if time.monotonic() >= deadline:
+                break
+
+        self.failures += 1
+        raise last_error
+
+    async def _with_retries(self, model: str, deadline: float, kwargs: dict):
+        breaker = self.breaker(model)
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            if not breaker.allow():
+                self.rejected += 1
+                raise CircuitOpen(f"Модель {model} тимчасово недоступна")
+            try:
+                response = await self._hedged(model, min(self.attempt_timeout, remaining), kwargs)
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # Помилка запиту, а не стану API - запобіжник не чіпаємо
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                attempt += 1
+                delay = self._backoff(attempt, e)
+                if attempt > self.max_retries or time.monotonic() + delay >= deadline:
+                    raise
+                self.retries += 1
+                logging.warning(f"OpenAI ({model}): {type(e).__name__}, повтор {attempt} через {delay:.1f}с")
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            return response
+
+    def _backoff(self, attempt: int, e: Exception) -> float:
+        """Експоненційна затримка з full jitter; Retry-After від сервера має пріоритет"""
+        server_delay = retry_after(e)
+        if server_delay is not None:
+            return min(server_delay, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _hedged(self, model: str, timeout: float, kwargs: dict):
+        """
+        Одна спроба. Якщо відповідь не прийшла за hedge-затримку (перцентиль
+        латентності), паралельно запускається друга; повертається перша успішна.
+        """
+        stream = bool(kwargs.get("stream"))
+        delay = self._hedge_delay(model, stream)
+        if delay is None or delay >= timeout:
+            return await self._attempt(model, timeout, kwargs)
+
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self._attempt(model, timeout, kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        self.hedges += 1
+        hedge = asyncio.ensure_future(self._attempt(model, timeout - (time.monotonic() - started), kwargs))
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    if winner is hedge:
+                        self.hedge_wins += 1
+                    # Обидва потоки відкрились одночасно - зайвий закриваємо, щоб не платити за генерацію
+                    for task in done - {winner}:
+                        if stream and task.exception() is None:
+                            await task.result().close()
+                    return winner.result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _attempt(self, model: str, timeout: float, kwargs: dict):
+        self.attempts += 1
+        started = time.monotonic()
+        response = await asyncio.wait_for(
+            self.client.chat.completions.create(model=model, **kwargs),
+            timeout=timeout,
+        )
+        samples = self._stream_latencies if kwargs.get("stream") else self._latencies
+        latencies = samples.get(model)
+        if latencies is None:
+            latencies = samples[model] = deque(maxlen=self._samples)
+        latencies.append(time.monotonic() - started)
+        return response
+
+    def _hedge_delay(self, model: str, stream: bool = False) -> Optional[float]:
+        latencies = (self._stream_latencies if stream else self._latencies).get(model)
+        if not self.hedge_percentile or not latencies or len(latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(self.hedge_percentile * len(ordered)))]
+
+    async def iterate(self, stream, deadline: float) -> AsyncIterator:
+        """
+        Фрагменти потоку до дедлайну (time.monotonic()); після нього -
+        asyncio.TimeoutError. Закривати потік лишається на викликачі.
+        """
+        chunks = stream.__aiter__()
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                self.stream_timeouts += 1
+                raise
+            yield chunk
+
+    def stats(self) -> dict:
+        models = {}
+        for model in sorted({self.model, *self._breakers, *self._latencies, *self._stream_latencies}):
+            latencies = self._latencies.get(model)
+            stream_latencies = self._stream_latencies.get(model)
+            models[model] = {
+                "breaker": self.breaker(model).state,
+                "trips": self.breaker(model).trips,
+                "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+                "stream_latency_avg": sum(stream_latencies) / len(stream_latencies) if stream_latencies else 0.0,
+                "hedge_delay": self._hedge_delay(model) or 0.0,
+                "stream_hedge_delay": self._hedge_delay(model, stream=True) or 0.0,
+            }
+        return {
+            "requests": self.requests,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "fallbacks": self.fallbacks,
+            "rejected": self.rejected,
+            "failures": self.failures,
+            "stream_timeouts": self.stream_timeouts,
+            "models": models,
+        }
+
+
+openai_client = ResilientOpenAI(
+    model=OPENAI_MODEL,
+    fallback_model=OPENAI_FALLBACK_MODEL,
+    deadline=OPENAI_DEADLINE,
+    attempt_timeout=OPENAI_ATTEMPT_TIMEOUT,
+    max_retries=OPENAI_MAX_RETRIES,
+    backoff_base=OPENAI_BACKOFF_BASE,
+    backoff_max=OPENAI_BACKOFF_MAX,
+    breaker_threshold=OPENAI_BREAKER_THRESHOLD,
+    breaker_cooldown=OPENAI_BREAKER_COOLDOWN,
+    hedge_percentile=OPENAI_HEDGE_PERCENTILE,
+    hedge_min_samples=OPENAI_HEDGE_MIN_SAMPLES,
+    api_key=OPENAI_API_KEY,
+    base_url=OPENAI_BASE_URL,
+)
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import PROMPTS_FILE, PROMPTS_RELOAD_INTERVAL
+
+# Вбудована версія промптів, що діє без файлу PROMPTS_FILE.
+# Системний промпт та інструкція стоять на початку кожного запиту і не змінюються
+# від запиту до запиту - OpenAI кешує цей префікс, тож будь-яка зміна тексту
+# (навіть пробілу) скидає кеш. Змінна частина (зображення) йде в кінці.
+DEFAULT_VERSION = "v1"
+
+SYSTEM_PROMPT = """
+Ти — досвідчений експерт з технічного аналізу криптовалютних графіків. Твоя мета — надати глибокий та об'єктивний аналіз, базуючись на візуальній інформації з наданого зображення. Твій аналіз має враховувати принципи конфлюенції сигналів (збіг кількох індикаторів/патернів) та контекст старших таймфреймів. Ти не даєш фінансових порад.
+
+Твоя відповідь ПОВИННА бути відформатована за допомогою HTML-тегів для Telegram. Використовуй <b> для жирного тексту та <code> для всіх тикерів та числових значень.
+
+ВАЖЛИВО: Кожен відкритий HTML тег ОБОВ'ЯЗКОВО має бути закритий. Наприклад: <b>текст</b>, <code>значення</code>. Не залишай незакриті теги!
+ЗАБОРОНЕНО: Не використовуй подвійні або неправильні теги типу </b</b> або </b></b>. Використовуй тільки правильні теги!
+
+Ось структура, якої ти маєш СУВОРО дотримуватися:
+
+📊 <b>Технічний аналіз графіка</b>
+
+<b>Інструмент:</b> <code>[Назва монети, якщо видно]</code>
+<b>Таймфрейм:</b> <code>[Таймфрейм, видимий на графіку, напр. H4, D1]</code>
+<b>Основний сценарій:</b> <code>[Ймовірний рух Long/Short]</code> [Додай емодзі 🟢 для Long або 🔴 для Short]
+
+▫️ <b>Ключові рівні для входу:</b> <code>[Ціновий діапазон]</code>
+▫️ <b>Рівень для обмеження ризику (Stop-Loss):</b> <code>[Ціна]</code>
+▫️ <b>Співвідношення Ризик/Прибуток (RRR):</b> <code>[Приблизне значення, напр. 1:3.5]</code>
+▫️ <b>Рекомендоване плече:</b> <code>[Наприклад: до 5x]</code>
+
+▫️ <b>Потенційні цілі (Take Profit):</b>
+
+<code>[Перша ціль]</code>
+
+<code>[Друга ціль]</code>
+
+<code>[Третя ціль, якщо доречно]</code>
+
+<blockquote expandable><b>📈 Детальний аналіз:</b>
+<b>Аргументи за сценарій:</b>
+[Тут опиши збіг факторів (конфлюенцію), які підтверджують основний сценарій. Наприклад: "Ціна сформувала патерн 'бичачий прапор' біля сильного рівня підтримки <code>[ціна]</code>. Додатково, індикатор RSI показує приховану бичачу дивергенцію, що підсилює сигнал на ріст."]
+
+<b>Альтернативний сценарій:</b>
+[Коротко опиши, що може піти не так і що буде сигналом до скасування ідеї. Наприклад: "Сценарій буде недійсним, якщо ціна закріпиться нижче рівня <code>[ціна]</code>. У такому випадку можливе падіння до наступної зони підтримки в районі <code>[ціна]</code>."]</blockquote>
+
+<blockquote expandable><b>⚠️ Відмова від відповідальності:</b>
+Ця інформація є виключно результатом технічного аналізу візуальних даних і не є фінансовою порадою чи торговою рекомендацією. Всі рішення приймаються на ваш власний ризик.</blockquote>
+
+<blockquote expandable><b>⚖️ Важливо про плече:</b>
+Рекомендоване плече базується на технічному аналізі волатильності та ризику угоди. Високе плече збільшує як потенційний прибуток, так і ризик втрат. Завжди використовуйте Stop-Loss та управляйте ризиками.</blockquote>
+"""
+
+# Інструкція користувача (однакова для всіх запитів)
+USER_INSTRUCTION = "Проведи технічний аналіз зображення графіка нижче. Ідентифікуй патерни, ключові рівні та потенційний сценарій руху ціни. Сформуй відповідь згідно з наданою структурою в системних інструкціях."
+
+# Режим структурованої відповіді: модель повертає лише змінні поля,
+# а HTML формується локально (bot.formatting.render_analysis)
+STRUCTURED_SYSTEM_PROMPT = """
+Ти — досвідчений експерт з технічного аналізу криптовалютних графіків. Надай глибокий та об'єктивний аналіз на основі зображення, враховуючи конфлюенцію сигналів та контекст старших таймфреймів. Ти не даєш фінансових порад.
+
+Поверни ЛИШЕ JSON за наданою схемою, без HTML та markdown:
+- is_chart: false, якщо на зображенні немає торгового графіка (решту полів тоді заповни порожніми рядками);
+- instrument, timeframe: як видно на графіку;
+- direction: "Long" або "Short";
+- entry, stop_loss: ціновий діапазон та ціна;
+- risk_reward: напр. "1:3.5"; leverage: напр. "до 5x";
+- targets: 1-3 цілі Take Profit;
+- arguments: конфлюенція факторів на користь сценарію (2-4 речення);
+- alternative: що скасує ідею і куди може піти ціна (1-3 речення).
+Ціни та тикери у arguments і alternative бери у `зворотні лапки`.
+"""
+
+STRUCTURED_INSTRUCTION = "Проведи технічний аналіз зображення графіка нижче та поверни результат за схемою."
+
+# Примітка для альбому: йде після зображень, щоб префікс збігався з запитом на один графік
+ALBUM_INSTRUCTION = (
+    "Вище кілька графіків одного інструменту на різних таймфреймах. "
+    "Проведи мультитаймфреймовий аналіз: визнач тренд і ключові рівні на старших таймфреймах, "
+    "а точку входу та стоп-лосс - на молодшому. Сформуй одну відповідь згідно з наданою структурою; "
+    "у полі таймфрейму перелічи всі проаналізовані таймфрейми."
+)
+
+
+class PromptVersion:
+    """Набір промптів однієї версії для всіх режимів відповіді"""
+    __slots__ = ("name", "system", "instruction", "album_instruction", "structured_system", "structured_instruction")
+
+    FIELDS = ("system", "instruction", "album_instruction", "structured_system", "structured_instruction")
+
+    def __init__(self, name: str, system: str, instruction: str, album_instruction: str,
+                 structured_system: str, structured_instruction: str):
+        self.name = name
+        self.system = system
+        self.instruction = instruction
+        self.album_instruction = album_instruction
+        self.structured_system = structured_system
+        self.structured_instruction = structured_instruction
+
+    def derive(self, name: str, overrides: dict) -> "PromptVersion":
+        """Нова версія: задані поля замінюються, решта береться з цієї"""
+        unknown = set(overrides) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Невідомі поля версії {name}: {', '.join(sorted(unknown))}")
+        values = {}
+        for field in self.FIELDS:
+            value = overrides.get(field, getattr(self, field))
+            # Довгий текст у JSON зручніше записувати списком рядків
+            if isinstance(value, list):
+                value = "\n".join(value)
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError(f"Поле {field} версії {name} має бути непорожнім рядком")
+            values[field] = value
+        return PromptVersion(name, **values)
+
+
+BUILTIN_PROMPT = PromptVersion(
+    DEFAULT_VERSION,
+    system=SYSTEM_PROMPT,
+    instruction=USER_INSTRUCTION,
+    album_instruction=ALBUM_INSTRUCTION,
+    structured_system=STRUCTURED_SYSTEM_PROMPT,
+    structured_instruction=STRUCTURED_INSTRUCTION,
+)
+
+
+class PromptRegistry:
+    """
+    Версії промптів з JSON-файлу, що перечитується при зміні (mtime) без перезапуску:
+        {"versions": {"v2": {"system": [...], "instruction": "..."}},
+         "split": {"v1": 90, "v2": 10}, "salt": "exp-1"}
+    Відсутні поля версії беруться з вбудованої v1. Користувач потрапляє у версію
+    за хешем user_id (разом із salt), тож завжди отримує ту саму версію, доки
+    не змінено split або salt. Помилковий файл ігнорується - діє попередня конфігурація.
+    """
+
+    def __init__(self, path: str, reload_interval: float):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.versions: Dict[str, PromptVersion] = {DEFAULT_VERSION: BUILTIN_PROMPT}
+        self.split: List[Tuple[str, int]] = [(DEFAULT_VERSION, 1)]
+        self.salt = ""
+        self.loaded_mtime: Optional[int] = None
+        self.checked_at: Optional[float] = None
+        self.reloads = 0
+        self.errors = 0
+
+    def select(self, user_id: int) -> PromptVersion:
+        """Версія промптів для користувача"""
+        self._maybe_reload()
+        if len(self.split) == 1:
+            return self.versions[self.split[0][0]]
+        total = sum(weight for _, weight in self.split)
+        digest = hashlib.sha256(f"{self.salt}:{user_id}".encode()).digest()
+        point = int.from_bytes(digest[:8], "big") % total
+        for name, weight in self.split:
+            if point < weight:
+                return self.versions[name]
+            point -= weight
+        return self.versions[self.split[-1][0]]
+
+    def get(self, name: Optional[str] = None) -> PromptVersion:
+        """Версія за назвою (за замовчуванням - вбудована)"""
+        self._maybe_reload()
+        return self.versions.get(name or DEFAULT_VERSION, BUILTIN_PROMPT)
+
+    def _maybe_reload(self):
+        # Файл перевіряється не частіше за reload_interval - stat на кожен запит зайвий
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        except OSError as e:
+            logging.error(f"Не вдалося перевірити файл промптів {self.path}: {e}")
+            return
+        if mtime == self.loaded_mtime:
+            return
+
+        self.loaded_mtime = mtime
+        if mtime is None:
+            self.versions = {DEFAULT_VERSION: BUILTIN_PROMPT}
+            self.split = [(DEFAULT_VERSION, 1)]
+            self.salt = ""
+            logging.info(f"Файл промптів {self.path} відсутній - використовується вбудована версія")
+            return
+        try:
+            self._load()
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Помилка у файлі промптів {self.path}, залишено попередні версії: {e}")
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            config = json.load(f)
+
+        versions = {DEFAULT_VERSION: BUILTIN_PROMPT}
+        for name, overrides in (config.get("versions") or {}).items():
+            if not isinstance(overrides, dict):
+                raise ValueError(f"Версія {name} має бути об'єктом")
+            versions[name] = BUILTIN_PROMPT.derive(name, overrides)
+
+        split = []
+        for name, weight in (config.get("split") or {DEFAULT_VERSION: 1}).items():
+            if name not in versions:
+                raise ValueError(f"Версію {name} зі split не знайдено")
+            if not isinstance(weight, int) or weight < 0:
+                raise ValueError(f"Вага версії {name} має бути невід'ємним цілим числом")
+            if weight:
+                split.append((name, weight))
+        if not split:
+            raise ValueError("Сума ваг split має бути більшою за нуль")
+
+        self.versions = versions
+        self.split = split
+        self.salt = str(config.get("salt", ""))
+        self.reloads += 1
+        logging.info(
+            f"Промпти завантажено з {self.path}: версії {', '.join(versions)}, "
+            f"розподіл {', '.join(f'{name}={weight}' for name, weight in split)}"
+        )
+
+    def stats(self) -> dict:
+        total = sum(weight for _, weight in self.split)
+        return {
+            "versions": list(self.versions),
+            "split": {name: weight / total for name, weight in self.split},
+            "reloads": self.reloads,
+            "errors": self.errors,
+        }
+
+
+prompt_registry = PromptRegistry(PROMPTS_FILE, PROMPTS_RELOAD_INTERVAL)
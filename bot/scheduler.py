@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from config import ANALYSIS_CONCURRENCY, ANALYSIS_QUEUE_LIMIT, ANALYSIS_USER_QUEUE_LIMIT
+
+
+class QueueFull(Exception):
+    """Черга аналізів переповнена (загальний або персональний ліміт)"""
+
+
+class _Job:
+    __slots__ = ("user_id", "func", "args", "future", "enqueued_at", "task")
+
+    def __init__(self, user_id: int, func, args):
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        # Задача виконання (після виходу з черги)
+        self.task: Optional[asyncio.Task] = None
+
+
+class AnalysisScheduler:
+    """
+    Планувальник аналізів: обмежує кількість одночасних запитів до OpenAI
+    та обслуговує користувачів по колу (round-robin), а не в порядку надходження.
+    """
+
+    def __init__(self, concurrency: int, queue_limit: int, user_queue_limit: int, samples: int = 500):
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.user_queue_limit = user_queue_limit
+
+        # Черга кожного користувача та порядок обходу користувачів
+        self._queues: Dict[int, Deque[_Job]] = {}
+        self._ring: Deque[int] = deque()
+        self._queued = 0
+        self._in_flight = 0
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._workers = []
+
+        # Останні виміри для оцінки ліміту
+        self._wait_times: Deque[float] = deque(maxlen=samples)
+        self._service_times: Deque[float] = deque(maxlen=samples)
+        self._completed = 0
+        self._rejected = 0
+        self._cancelled = 0
+
+    async def start(self):
+        """Запускає воркери планувальника"""
+        if self._workers:
+            return
+        self._wakeup = asyncio.Condition()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        logging.info(f"Планувальник аналізів запущено: {self.concurrency} паралельних запитів")
+
+    async def stop(self):
+        """Зупиняє воркери та скасовує задачі, що ще чекають у черзі"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for queue in self._queues.values():
+            for job in queue:
+                job.future.cancel()
+        self._queues.clear()
+        self._ring.clear()
+        self._queued = 0
+
+    def ensure_capacity(self, user_id: int):
+        """Піднімає QueueFull, якщо нову задачу користувача не можна поставити в чергу"""
+        queue = self._queues.get(user_id)
+        if self._queued >= self.queue_limit or (queue and len(queue) >= self.user_queue_limit):
+            self._rejected += 1
+            raise QueueFull()
+
+    def position(self, job: _Job) -> int:
+        """
+        Повертає позицію задачі в порядку обслуговування (1 - наступна).
+        При обході по колу перед k-ю задачею користувача стоять перші k задач
+        кожного користувача та k-ті задачі користувачів, що стоять раніше в колі.
+        """
+        queue = self._queues.get(job.user_id)
+        if not queue or job not in queue:
+            return 0
+        k = queue.index(job)
+        ahead = 0
+        for user_id in self._ring:
+            other = len(self._queues[user_id])
+            if user_id == job.user_id:
+                ahead += k
+                # Користувачі після нас у колі на цьому колі ще не обслуговуються
+                ahead += sum(min(len(self._queues[u]), k) for u in self._after(user_id))
+                break
+            ahead += min(other, k + 1)
+        return ahead + 1
+
+    def _after(self, user_id: int):
+        seen = False
+        for other in self._ring:
+            if seen:
+                yield other
+            elif other == user_id:
+                seen = True
+
+    async def submit(
+        self,
+        user_id: int,
+        func: Callable[..., Awaitable],
+        *args,
+        on_position: Optional[Callable[[int], Awaitable]] = None,
+        refresh_interval: float = 5.0,
+    ):
+        """
+        Ставить виклик у чергу та чекає на результат.
+        on_position викликається з поточною позицією, поки задача чекає в черзі.
+        """
+        if self._wakeup is None:
+            await self.start()
+
+        self.ensure_capacity(user_id)
+        queue = self._queues.get(user_id)
+
+        job = _Job(user_id, func, args)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            self._ring.append(user_id)
+        queue.append(job)
+        self._queued += 1
+
+        async with self._wakeup:
+            self._wakeup.notify()
+
+        last_position = None
+        try:
+            while True:
+                position = self.position(job)
+                if position and on_position and position != last_position and self._in_flight >= self.concurrency:
+                    last_position = position
+                    try:
+                        await on_position(position)
+                    except Exception as e:
+                        logging.warning(f"Не вдалося оновити позицію в черзі: {e}")
+                try:
+                    return await asyncio.wait_for(asyncio.shield(job.future), timeout=refresh_interval)
+                except asyncio.TimeoutError:
+                    continue
+        except asyncio.CancelledError:
+            self._discard(job)
+            raise
+
+    def _discard(self, job: _Job):
+        """
+        Прибирає задачу з черги, якщо вона ще не почала виконуватись,
+        або перериває виконання - слот звільняється одразу, а не після відповіді OpenAI.
+        """
+        queue = self._queues.get(job.user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            self._queued -= 1
+            if not queue:
+                del self._queues[job.user_id]
+                self._ring.remove(job.user_id)
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+        if not job.future.done():
+            self._cancelled += 1
+        job.future.cancel()
+
+    def _next_job(self) -> Optional[_Job]:
+        if not self._ring:
+            return None
+        user_id = self._ring.popleft()
+        queue = self._queues[user_id]
+        job = queue.popleft()
+        self._queued -= 1
+        if queue:
+            self._ring.append(user_id)
+        else:
+            del self._queues[user_id]
+        return job
+
+    async def _worker(self):
+        while True:
+            async with self._wakeup:
+                await self._wakeup.wait_for(lambda: bool(self._ring))
+                job = self._next_job()
+            if job is None or job.future.done():
+                continue
+
+            started_at = time.monotonic()
+            self._wait_times.append(started_at - job.enqueued_at)
+            self._in_flight += 1
+            job.task = asyncio.ensure_future(job.func(*job.args))
+            try:
+                # wait не піднімає CancelledError, коли скасовано саму задачу (_discard)
+                await asyncio.wait({job.task})
+                if job.task.cancelled():
+                    job.future.cancel()
+                elif not job.future.done():
+                    error = job.task.exception()
+                    if error is not None:
+                        job.future.set_exception(error)
+                    else:
+                        job.future.set_result(job.task.result())
+                else:
+                    # Результат уже нікому не потрібен, але виняток задачі має бути прочитаний
+                    job.task.exception()
+            except asyncio.CancelledError:
+                job.task.cancel()
+                job.future.cancel()
+                raise
+            finally:
+                self._in_flight -= 1
+                self._completed += 1
+                self._service_times.append(time.monotonic() - started_at)
+
+    def stats(self) -> dict:
+        """Глибина черги, час очікування та обслуговування (середнє та p95, секунди)"""
+        return {
+            "concurrency": self.concurrency,
+            "queue_depth": self._queued,
+            "queued_users": len(self._ring),
+            "in_flight": self._in_flight,
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "cancelled": self._cancelled,
+            "wait_avg": _mean(self._wait_times),
+            "wait_p95": _percentile(self._wait_times, 0.95),
+            "service_avg": _mean(self._service_times),
+            "service_p95": _percentile(self._service_times, 0.95),
+        }
+
+
+def _mean(samples) -> float:
+    return sum(samples) / len(samples) if samples else 0.0
+
+
+def _percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+analysis_scheduler = AnalysisScheduler(
+    concurrency=ANALYSIS_CONCURRENCY,
+    queue_limit=ANALYSIS_QUEUE_LIMIT,
+    user_queue_limit=ANALYSIS_USER_QUEUE_LIMIT,
+)
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+from typing import Optional, Tuple
+
+from config import BOT_STATS_REFRESH_INTERVAL
+from db import queries as db
+
+
+def format_age(seconds: float) -> str:
+    """Вік знімка для адмін-панелі: "12 с", "4 хв", "2 год 5 хв" """
+    seconds = max(int(seconds), 0)
+    if seconds < 60:
+        return f"{seconds} с"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes} хв"
+    return f"{minutes // 60} год {minutes % 60} хв"
+
+
+class BotStatsSnapshot:
+    """
+    Знімок загальної статистики (db.get_bot_stats), який фонова задача оновлює
+    раз на refresh_interval. Адмін-панель відкривається одразу, незалежно від розміру таблиць,
+    і показує, наскільки знімок застарів. Якщо оновлення не вдалося, лишається попередній знімок.
+    """
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+
+        self._stats: Optional[dict] = None
+        self._taken_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+        self.refreshes = 0
+        self.failures = 0
+        self.last_duration = 0.0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"Не вдалося оновити знімок статистики: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def refresh(self):
+        started = time.monotonic()
+        stats = await db.get_bot_stats()
+        self.last_duration = time.monotonic() - started
+        self._stats = stats
+        self._taken_at = time.time()
+        self.refreshes += 1
+
+    async def get(self) -> Tuple[dict, float]:
+        """Останній знімок та його вік (секунди); поки знімка немає - рахує одразу"""
+        if self._stats is None:
+            await self.refresh()
+        return self._stats, time.time() - self._taken_at
+
+
+bot_stats = BotStatsSnapshot(refresh_interval=BOT_STATS_REFRESH_INTERVAL)
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiogram import types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+from bot.formatting import close_html_prefix, html_to_entities
+
+# Максимальна довжина тексту повідомлення Telegram
+MESSAGE_LIMIT = 4096
+# Індикатор того, що текст ще генерується
+CURSOR = " ▌"
+
+
+class StreamingMessage:
+    """
+    Поступово редагує повідомлення текстом, що надходить потоком від OpenAI.
+    Редагування обмежені за частотою (ліміт Telegram на edit), а кожен
+    проміжний текст обрізається так, щоб HTML залишався валідним, і
+    надсилається готовими сутностями (entities), без розбору HTML на сервері.
+    """
+
+    def __init__(self, message: types.Message, interval: float, reply_markup=None):
+        self.message = message
+        self.interval = interval
+        # Клавіатура проміжних повідомлень (кнопка скасування); остаточний текст - без неї
+        self.reply_markup = reply_markup
+        self.edits = 0
+        self.first_edit_at: Optional[float] = None
+        self._created_at = time.monotonic()
+        self._last_edit = 0.0
+        self._pending: Optional[str] = None
+        self._shown: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def update(self, text: str):
+        """Запам'ятовує новий текст; редагування відбудеться не частіше за interval"""
+        self._pending = text
+        if self._task is None or self._task.done():
+            delay = max(0.0, self._last_edit + self.interval - time.monotonic())
+            self._task = asyncio.create_task(self._flush(delay))
+
+    async def _flush(self, delay: float):
+        while True:
+            if delay:
+                await asyncio.sleep(delay)
+            text = self._pending
+            if not text:
+                return
+            limit = MESSAGE_LIMIT - len(CURSOR) - 64  # запас на закриваючі теги
+            preview = close_html_prefix(text[:limit])
+            if preview.strip() and preview != self._shown:
+                plain, entities = html_to_entities(preview)
+                await self._edit(plain + CURSOR, entities, reply_markup=self.reply_markup)
+                self._shown = preview
+            # Поки редагували, міг надійти новий текст
+            if self._pending == text:
+                return
+            delay = max(0.0, self._last_edit + self.interval - time.monotonic())
+
+    async def _edit(self, text: str, entities: list, **kwargs) -> bool:
+        try:
+            await self.message.edit_text(text, entities=entities, **kwargs)
+        except MessageNotModified:
+            pass
+        except RetryAfter as e:
+            # Telegram просить почекати - відкладаємо наступне редагування
+            self._last_edit = time.monotonic() + e.timeout
+            return False
+        except Exception as e:
+            logging.debug(f"Не вдалося оновити повідомлення під час стрімінгу: {e}")
+            return False
+        finally:
+            if self._last_edit < time.monotonic():
+                self._last_edit = time.monotonic()
+        self.edits += 1
+        if self.first_edit_at is None:
+            self.first_edit_at = time.monotonic()
+            logging.info(f"Перший текст аналізу показано через {self.first_edit_at - self._created_at:.2f}с")
+        return True
+
+    def stop(self):
+        """Скасовує заплановане редагування (аналіз перервано)"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    async def finalize(self, text: str, entities: list, **kwargs) -> bool:
+        """
+        Замінює проміжний текст остаточним (перша частина відповіді, див. split_entities) на місці.
+        Повертає False, якщо відредагувати не вдалося (тоді варто надіслати нове повідомлення).
+        """
+        if self._task and not self._task.done():
+            self._task.cancel()
+        try:
+            await self.message.edit_text(text, entities=entities, **kwargs)
+            return True
+        except MessageNotModified:
+            return True
+        except Exception as e:
+            logging.error(f"Не вдалося завершити повідомлення з аналізом: {e}")
+            return False
@@ -31,4 +31,187 @@ DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}" 
\ No newline at end of file
+DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# --- Пул підключень до PostgreSQL ---
+# Мінімальна та максимальна кількість підключень у пулі процесу
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Кеш підготовлених запитів на підключення (0 - за PgBouncer у режимі transaction)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# Таймаут запиту (секунди); запит, що не вклався, скасовується і на сервері
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+# Підключення, що простоює довше (секунди), закривається
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "300"))
+# application_name підключень (видно в pg_stat_activity)
+DB_APPLICATION_NAME = os.getenv("DB_APPLICATION_NAME", "cryptofuture")
+# Запити, довші за поріг (мілісекунди), пишуться в лог; 0 - вимкнено
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+
+# --- Планувальник аналізів ---
+# Максимальна кількість одночасних запитів до OpenAI
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "8"))
+# Максимальна кількість задач, що чекають у черзі (для всіх користувачів)
+ANALYSIS_QUEUE_LIMIT = int(os.getenv("ANALYSIS_QUEUE_LIMIT", "200"))
+# Максимальна кількість задач одного користувача в черзі
+ANALYSIS_USER_QUEUE_LIMIT = int(os.getenv("ANALYSIS_USER_QUEUE_LIMIT", "3"))
+# Новий графік від користувача скасовує його попередній незавершений аналіз
+ANALYSIS_SUPERSEDE = os.getenv("ANALYSIS_SUPERSEDE", "false").lower() == "true"
+
+# --- Черга аналізів у PostgreSQL ---
+# local - аналіз у процесі бота; queue - бот кладе задачу в таблицю analysis_jobs, виконують окремі процеси worker.py
+ANALYSIS_BACKEND = os.getenv("ANALYSIS_BACKEND", "local").lower()
+# Максимальна кількість задач, які один процес воркера виконує одночасно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))
+# Як часто воркер перевіряє таблицю, коли вільних задач немає (секунди)
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+# Оренда задачі (секунди): воркер продовжує її, поки працює; задачу з простроченою орендою забирає інший воркер
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Кількість спроб, після якої задача переходить у dead letter (status = 'dead')
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Затримка перед повтором після помилки (секунди, множиться на номер спроби)
+JOB_RETRY_DELAY = int(os.getenv("JOB_RETRY_DELAY", "10"))
+
+# --- Кеш результатів аналізу ---
+# Час життя запису (секунди) - графіки швидко застарівають
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "900"))
+# Максимальний розмір кешу (байти тексту результатів)
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+# Максимальна відстань Геммінга між перцептивними хешами (256 бітів) для влучання:
+# різні графіки з одного шаблону біржі відрізняються на десятки бітів, перестиснення - на одиниці
+ANALYSIS_CACHE_MAX_DISTANCE = int(os.getenv("ANALYSIS_CACHE_MAX_DISTANCE", "2"))
+# Чи списувати безкоштовну спробу, якщо результат взято з кешу аналізу іншого користувача
+ANALYSIS_CACHE_HIT_USES_FREE_TRADE = os.getenv("ANALYSIS_CACHE_HIT_USES_FREE_TRADE", "true").lower() == "true"
+
+# --- Кеш користувачів ---
+# Час життя запису (секунди) - межа застарівання, якщо подія інвалідації не дійшла
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+# Максимальна кількість користувачів у кеші (LRU)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# --- Інвалідація кешів між процесами (LISTEN/NOTIFY) ---
+# Слухати події інвалідації від інших процесів (бот, воркери) окремим підключенням до БД
+CACHE_INVALIDATION_LISTEN = os.getenv("CACHE_INVALIDATION_LISTEN", "true").lower() == "true"
+# Інтервал перевірки підключення слухача (секунди)
+CACHE_LISTENER_CHECK_INTERVAL = float(os.getenv("CACHE_LISTENER_CHECK_INTERVAL", "15"))
+# Максимальна пауза між спробами перепідключення слухача (секунди)
+CACHE_LISTENER_MAX_BACKOFF = float(os.getenv("CACHE_LISTENER_MAX_BACKOFF", "30"))
+
+# --- Потокова видача аналізу ---
+# Показувати текст аналізу по мірі генерації, редагуючи повідомлення
+ANALYSIS_STREAMING = os.getenv("ANALYSIS_STREAMING", "true").lower() == "true"
+# Мінімальний інтервал між редагуваннями повідомлення (секунди, ліміт Telegram)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# --- Підготовка зображень ---
+# Максимальна довша сторона зображення, що відправляється в OpenAI (пікселі)
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+# Якість JPEG при перекодуванні
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# Обрізати однотонні поля навколо графіка
+IMAGE_CROP_BORDERS = os.getenv("IMAGE_CROP_BORDERS", "true").lower() == "true"
+# Максимальний розмір файлу зображення, що завантажується (байти)
+IMAGE_MAX_DOWNLOAD_BYTES = int(os.getenv("IMAGE_MAX_DOWNLOAD_BYTES", str(10 * 1024 * 1024)))
+# Максимальна кількість пікселів зображення (більші не декодуються)
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(25_000_000)))
+# Сумарний бюджет пам'яті на зображення (байти): буфери пулу, декодування та файли в обробці
+IMAGE_MEMORY_BUDGET = int(os.getenv("IMAGE_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+# Частина бюджету під вільні буфери завантаження, що зберігаються для повторного використання
+IMAGE_BUFFER_POOL_BYTES = int(os.getenv("IMAGE_BUFFER_POOL_BYTES", str(8 * 1024 * 1024)))
+# Частина бюджету під декодовані зображення (Pillow)
+IMAGE_DECODE_MEMORY = int(os.getenv("IMAGE_DECODE_MEMORY", str(24 * 1024 * 1024)))
+
+# --- Попередній фільтр графіків ---
+# Мінімальна оцінка схожості на графік (0..1), нижче якої зображення відхиляється
+# без запиту до OpenAI та без списання спроби (0 - фільтр вимкнено).
+# За замовчуванням вимкнено: поріг вмикається після калібрування на розміченому
+# наборі (python -m benchmarks.chart_filter_calibration <каталог>), щоб не відхиляти справжні графіки
+CHART_FILTER_THRESHOLD = float(os.getenv("CHART_FILTER_THRESHOLD", "0"))
+# Чи перевіряти зображення підписників (інакше для них фільтр лише враховується в метриках)
+CHART_FILTER_SUBSCRIBERS = os.getenv("CHART_FILTER_SUBSCRIBERS", "false").lower() == "true"
+
+# --- Формат відповіді моделі ---
+# html - модель повертає готовий HTML за шаблоном із SYSTEM_PROMPT;
+# structured - модель повертає JSON з полями аналізу, HTML формується локально
+ANALYSIS_OUTPUT_MODE = os.getenv("ANALYSIS_OUTPUT_MODE", "html").lower()
+
+# --- Версії промптів ---
+# JSON-файл з версіями промптів та A/B-розподілом між ними (відсутній - вбудована версія)
+PROMPTS_FILE = os.getenv("PROMPTS_FILE", "prompts.json")
+# Як часто перевіряти зміну файлу промптів (секунди)
+PROMPTS_RELOAD_INTERVAL = float(os.getenv("PROMPTS_RELOAD_INTERVAL", "10"))
+
+# --- Клієнт OpenAI ---
+# Адреса API (порожньо - стандартна; можна вказати локальний тестовий сервер)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")
+# Основна модель та резервна, яка використовується, коли основна недоступна (порожньо - без резервної)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1")
+OPENAI_FALLBACK_MODEL = os.getenv("OPENAI_FALLBACK_MODEL", "gpt-4.1-mini")
+# Загальний дедлайн запиту з усіма повторами та таймаут однієї спроби (секунди)
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "75"))
+OPENAI_ATTEMPT_TIMEOUT = float(os.getenv("OPENAI_ATTEMPT_TIMEOUT", "30"))
+# Кількість повторів та параметри експоненційної затримки між ними (секунди)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+# Запобіжник: кількість помилок поспіль до спрацювання та пауза перед пробним запитом (секунди)
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+# Перцентиль латентності, після якого надсилається дубльований запит (0 - вимкнено),
+# та мінімальна кількість вимірів для його оцінки
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "0.95"))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+
+# --- Маршрутизація запитів до моделей ---
+# Модель, ліміт вихідних токенів та detail зображень (low/high; порожньо - за розміром
+# зображення) для підписників, пробних спроб та для всіх під навантаженням
+ROUTE_SUBSCRIBER_MODEL = os.getenv("ROUTE_SUBSCRIBER_MODEL", OPENAI_MODEL)
+ROUTE_SUBSCRIBER_MAX_TOKENS = int(os.getenv("ROUTE_SUBSCRIBER_MAX_TOKENS", "1500"))
+ROUTE_SUBSCRIBER_DETAIL = os.getenv("ROUTE_SUBSCRIBER_DETAIL", "").lower()
+ROUTE_TRIAL_MODEL = os.getenv("ROUTE_TRIAL_MODEL", "gpt-4.1-mini")
+ROUTE_TRIAL_MAX_TOKENS = int(os.getenv("ROUTE_TRIAL_MAX_TOKENS", "1500"))
+ROUTE_TRIAL_DETAIL = os.getenv("ROUTE_TRIAL_DETAIL", "").lower()
+ROUTE_DEGRADED_MODEL = os.getenv("ROUTE_DEGRADED_MODEL", "gpt-4.1-mini")
+ROUTE_DEGRADED_MAX_TOKENS = int(os.getenv("ROUTE_DEGRADED_MAX_TOKENS", "1500"))
+ROUTE_DEGRADED_DETAIL = os.getenv("ROUTE_DEGRADED_DETAIL", "low").lower()
+# Навантаження: глибина черги аналізів або середній час обробки запиту (секунди),
+# починаючи з яких запити переводяться на ROUTE_DEGRADED_* (0 - не враховувати)
+ROUTE_DEGRADE_QUEUE_DEPTH = int(os.getenv("ROUTE_DEGRADE_QUEUE_DEPTH", "20"))
+ROUTE_DEGRADE_LATENCY = float(os.getenv("ROUTE_DEGRADE_LATENCY", "25"))
+# Чи переводити під навантаженням також підписників
+ROUTE_DEGRADE_SUBSCRIBERS = os.getenv("ROUTE_DEGRADE_SUBSCRIBERS", "false").lower() == "true"
+
+# --- Обмеження частоти запитів ---
+# Для кожного класу обробників: запас запитів підряд (burst) та швидкість поповнення (за хвилину)
+THROTTLE_PHOTO_BURST = int(os.getenv("THROTTLE_PHOTO_BURST", "3"))
+THROTTLE_PHOTO_PER_MINUTE = float(os.getenv("THROTTLE_PHOTO_PER_MINUTE", "6"))
+THROTTLE_PROFILE_BURST = int(os.getenv("THROTTLE_PROFILE_BURST", "5"))
+THROTTLE_PROFILE_PER_MINUTE = float(os.getenv("THROTTLE_PROFILE_PER_MINUTE", "20"))
+THROTTLE_ADMIN_BURST = int(os.getenv("THROTTLE_ADMIN_BURST", "20"))
+THROTTLE_ADMIN_PER_MINUTE = float(os.getenv("THROTTLE_ADMIN_PER_MINUTE", "120"))
+THROTTLE_DEFAULT_BURST = int(os.getenv("THROTTLE_DEFAULT_BURST", "10"))
+THROTTLE_DEFAULT_PER_MINUTE = float(os.getenv("THROTTLE_DEFAULT_PER_MINUTE", "30"))
+
+# --- Альбоми графіків ---
+# Скільки секунд чекати на решту фото альбому (Telegram надсилає їх окремими повідомленнями)
+ALBUM_COLLECT_WINDOW = float(os.getenv("ALBUM_COLLECT_WINDOW", "1.0"))
+# Максимальна кількість графіків альбому, що аналізуються
+ALBUM_MAX_IMAGES = int(os.getenv("ALBUM_MAX_IMAGES", "4"))
+# combined - усі графіки одним запитом (мультитаймфреймовий аналіз);
+# parallel - кожен графік окремим запитом паралельно, результати зводяться в одну відповідь
+ALBUM_MODE = os.getenv("ALBUM_MODE", "combined").lower()
+# Максимальна кількість одночасних запитів для одного альбому в режимі parallel
+ALBUM_PARALLELISM = int(os.getenv("ALBUM_PARALLELISM", "3"))
+
+# --- Історія аналізів ---
+# Максимальний розмір пакета та інтервал запису історії в БД (секунди)
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "50"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2.0"))
+# Максимальна кількість записів, що чекають на запис (понад ліміт - відкидаються)
+HISTORY_QUEUE_LIMIT = int(os.getenv("HISTORY_QUEUE_LIMIT", "10000"))
+
+# --- Метрики ---
+# Скільки останніх днів зберігати розбивку вартості запитів до OpenAI по користувачах
+METRICS_COST_DAYS = int(os.getenv("METRICS_COST_DAYS", "7"))
+# Інтервал фонового оновлення знімка загальної статистики для адмін-панелі (секунди)
+BOT_STATS_REFRESH_INTERVAL = float(os.getenv("BOT_STATS_REFRESH_INTERVAL", "300"))
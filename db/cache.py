@@ -0,0 +1,150 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+
+from config import USER_CACHE_TTL, USER_CACHE_SIZE
+
+# Колонки users, що зберігаються в кеші (і вибираються get_user)
+USER_FIELDS = (
+    "user_id", "username", "first_name", "free_trades_left", "is_subscribed",
+    "subscription_expires_at", "referral_code", "user_referral_code", "created_at",
+)
+
+
+def utc_now() -> datetime:
+    """Поточний час у UTC без часової зони - так зберігаються TIMESTAMP-колонки users"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def subscription_active(is_subscribed: bool, expires_at: Optional[datetime]) -> bool:
+    """
+    Підписка активна: is_subscribed і термін не минув; без терміну (NULL) - безстрокова.
+    Те саме правило в SQL - db.queries.subscription_active_sql.
+    """
+    return bool(is_subscribed) and (expires_at is None or expires_at > utc_now())
+
+
+class CachedUser:
+    """
+    Рядок users у кеші: компактний запис замість dict.
+    Читається як user["поле"] або user.поле - так само, як результат get_user раніше.
+    """
+    __slots__ = USER_FIELDS + ("cached_until",)
+
+    def __init__(self, row, cached_until: float):
+        for field in USER_FIELDS:
+            setattr(self, field, row[field])
+        self.cached_until = cached_until
+
+    def __getitem__(self, field: str):
+        if field not in USER_FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field: str, default=None):
+        return getattr(self, field, default) if field in USER_FIELDS else default
+
+    @property
+    def subscription_active(self) -> bool:
+        return subscription_active(self.is_subscribed, self.subscription_expires_at)
+
+
+class UserCache:
+    """
+    Read-through кеш рядків users у пам'яті процесу з TTL та LRU-витісненням.
+    Кожна функція db.queries, що змінює користувача, скидає або оновлює його запис;
+    інші процеси скидають свої записи за подією NOTIFY (db/notify.py), а TTL обмежує
+    застарівання, якщо подію втрачено.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, CachedUser]" = OrderedDict()
+        # Логічний годинник змін: рядок, прочитаний до зміни свого користувача, не потрапляє в кеш.
+        # _changed - момент останньої зміни кожного користувача (не більше max_size, найстаріші
+        # забуваються); _forgotten - найпізніший забутий момент (і момент clear)
+        self._clock = 0
+        self._changed: "OrderedDict[int, int]" = OrderedDict()
+        self._forgotten = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @property
+    def generation(self) -> int:
+        """Мітка часу для put: береться до початку запиту до БД"""
+        return self._clock
+
+    def get(self, user_id: int) -> Optional[CachedUser]:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry.cached_until > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+        if entry is not None:
+            del self._entries[user_id]
+        self.misses += 1
+        return None
+
+    def put(self, row, generation: int) -> CachedUser:
+        """
+        Зберігає рядок, прочитаний з БД; generation - значення до початку запиту.
+        Якщо за час запиту цього користувача змінювали, рядок повертається, але не кешується;
+        зміни інших користувачів запису не заважають.
+        """
+        entry = CachedUser(row, time.monotonic() + self.ttl)
+        if self.ttl <= 0 or generation < self._forgotten or self._changed.get(entry.user_id, 0) > generation:
+            return entry
+        self._entries[entry.user_id] = entry
+        self._entries.move_to_end(entry.user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def update(self, user_id: int, **fields):
+        """Оновлює поля запису, якщо він є (значення щойно повернула БД)"""
+        self._mark_changed(user_id)
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            for field, value in fields.items():
+                setattr(entry, field, value)
+
+    def invalidate(self, user_id: int):
+        self._mark_changed(user_id)
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._clock += 1
+        self._forgotten = self._clock
+        self._changed.clear()
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def _mark_changed(self, user_id: int):
+        self._clock += 1
+        self._changed[user_id] = self._clock
+        self._changed.move_to_end(user_id)
+        if len(self._changed) > self.max_size:
+            _, changed_at = self._changed.popitem(last=False)
+            # Про забутого користувача невідомо нічого - відкидаємо всі старіші читання
+            self._forgotten = max(self._forgotten, changed_at)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+
+user_cache = UserCache(ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE)
@@ -0,0 +1,165 @@
+"""
+Інструментування запитів до PostgreSQL: для кожного іменованого запиту (функції db.queries)
+рахуються очікування підключення з пулу, час виконання та кількість рядків.
+Запити, повільніші за поріг, пишуться в лог без значень параметрів - лише їх типи.
+"""
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+import asyncpg
+
+from config import DB_SLOW_QUERY_MS
+from metrics import Histogram
+
+# Межі кошиків гістограм, мілісекунди
+MS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def redact(args) -> str:
+    """Параметри запиту без значень: "(int, str[12], NULL)" """
+    parts = []
+    for value in args:
+        if value is None:
+            parts.append("NULL")
+        elif isinstance(value, (str, bytes, list, tuple, dict)):
+            parts.append(f"{type(value).__name__}[{len(value)}]")
+        else:
+            parts.append(type(value).__name__)
+    return f"({', '.join(parts)})"
+
+
+def status_rows(status: str) -> int:
+    """Кількість рядків зі статусу команди ("UPDATE 3", "INSERT 0 1")"""
+    last = status.rsplit(" ", 1)[-1] if status else ""
+    return int(last) if last.isdigit() else 0
+
+
+class QueryStats:
+    """Показники одного іменованого запиту (кожна інструкція функції рахується окремо)"""
+    __slots__ = ("calls", "errors", "rows", "slow", "wait", "duration")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.slow = 0
+        self.wait = Histogram(MS_BUCKETS)
+        self.duration = Histogram(MS_BUCKETS)
+
+
+class InstrumentedConnection:
+    """
+    Підключення з пулу, що вимірює кожен запит. Решта методів asyncpg.Connection
+    (transaction, add_listener, ...) передаються без змін.
+    """
+    __slots__ = ("_conn", "_metrics", "_name", "_wait_ms")
+
+    def __init__(self, conn: asyncpg.Connection, metrics: "QueryMetrics", name: str, wait_ms: float):
+        self._conn = conn
+        self._metrics = metrics
+        self._name = name
+        self._wait_ms = wait_ms
+
+    def __getattr__(self, attr):
+        return getattr(self._conn, attr)
+
+    async def _run(self, method, count, query: str, args, kwargs):
+        started = time.monotonic()
+        try:
+            result = await method(query, *args, **kwargs)
+        except BaseException:
+            self._metrics.record(self._name, query, args, (time.monotonic() - started) * 1000, 0, self._wait_ms, failed=True)
+            raise
+        self._metrics.record(self._name, query, args, (time.monotonic() - started) * 1000, count(result), self._wait_ms)
+        return result
+
+    async def execute(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.execute, status_rows, query, args, kwargs)
+
+    async def executemany(self, query: str, args, **kwargs):
+        rows = len(args)
+        return await self._run(self._conn.executemany, lambda _: rows, query, (args,), kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.fetch, len, query, args, kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.fetchrow, lambda row: int(row is not None), query, args, kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.fetchval, lambda _: 1, query, args, kwargs)
+
+
+class QueryMetrics:
+    """Показники запитів у пам'яті процесу та лог повільних запитів"""
+
+    def __init__(self, slow_ms: float):
+        self.slow_ms = slow_ms
+        self.queries: Dict[str, QueryStats] = {}
+        self.acquire_wait = Histogram(MS_BUCKETS)
+        self.connections_opened = 0
+
+    @asynccontextmanager
+    async def acquire(self, pool: asyncpg.Pool, name: str):
+        """Підключення з пулу; очікування і запити враховуються під назвою name"""
+        started = time.monotonic()
+        async with pool.acquire() as conn:
+            wait_ms = (time.monotonic() - started) * 1000
+            self.acquire_wait.observe(wait_ms)
+            self._stats(name).wait.observe(wait_ms)
+            yield InstrumentedConnection(conn, self, name, wait_ms)
+
+    def _stats(self, name: str) -> QueryStats:
+        stats = self.queries.get(name)
+        if stats is None:
+            stats = self.queries[name] = QueryStats()
+        return stats
+
+    def record(self, name: str, query: str, args, duration_ms: float, rows: int, wait_ms: float, failed: bool = False):
+        stats = self._stats(name)
+        stats.calls += 1
+        stats.rows += rows
+        stats.duration.observe(duration_ms)
+        if failed:
+            stats.errors += 1
+        if self.slow_ms and duration_ms >= self.slow_ms:
+            stats.slow += 1
+            sql = _WHITESPACE_RE.sub(" ", query).strip()
+            logging.warning(
+                f"Повільний запит {name}: {duration_ms:.0f} мс (очікування пулу {wait_ms:.0f} мс), "
+                f"рядків {rows}{', помилка' if failed else ''}: {sql[:300]} {redact(args)}"
+            )
+
+    def on_connect(self, conn: asyncpg.Connection):
+        self.connections_opened += 1
+
+    def summary(self, top: int = 5) -> dict:
+        """Найдорожчі запити за сумарним часом виконання"""
+        ranked = sorted(self.queries.items(), key=lambda item: item[1].duration.total, reverse=True)
+        return {
+            "acquire_avg": self.acquire_wait.mean,
+            "acquire_p95": self.acquire_wait.percentile(0.95),
+            "connections_opened": self.connections_opened,
+            "slow": sum(stats.slow for stats in self.queries.values()),
+            "top": [
+                {
+                    "name": name,
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "rows": stats.rows / stats.calls if stats.calls else 0.0,
+                    "total": stats.duration.total,
+                    "avg": stats.duration.mean,
+                    "p95": stats.duration.percentile(0.95),
+                    "wait_avg": stats.wait.mean,
+                }
+                for name, stats in ranked[:top]
+            ],
+        }
+
+
+query_metrics = QueryMetrics(slow_ms=DB_SLOW_QUERY_MS)
@@ -0,0 +1,169 @@
+"""
+Версійовані міграції схеми БД: файли db/migrations/NNNN_назва.sql застосовуються по порядку
+номерів і записуються в schema_migrations разом з контрольною сумою вмісту.
+
+Файл виконується в одній транзакції разом із записом у schema_migrations. Якщо перший рядок
+файлу "-- no-transaction" (потрібно для CREATE INDEX CONCURRENTLY), інструкції виконуються
+по одній без транзакції; такі файли мають бути ідемпотентними (IF NOT EXISTS), бо при збої
+посередині міграція повториться з початку. Інструкції розділяються ";" у кінці рядка.
+
+Застосовану міграцію змінювати не можна - для змін додається новий файл.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import asyncpg
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+# Ключ pg_advisory_lock: кілька копій бота й воркерів стартують одночасно, міграції виконує одна
+MIGRATION_LOCK_KEY = 720_103_001
+NO_TRANSACTION = "-- no-transaction"
+# Пауза між спробами взяти блокування (секунди)
+LOCK_RETRY_INTERVAL = 0.5
+# Таймаут інструкції міграції (секунди): побудова індексу на великій таблиці довша за DB_COMMAND_TIMEOUT
+MIGRATION_TIMEOUT = 3600
+
+_FILE_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+_STATEMENT_END_RE = re.compile(r";[ \t]*(?:--[^\n]*)?$", re.M)
+_CONCURRENT_INDEX_RE = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+
+class Migration:
+    __slots__ = ("version", "name", "sql", "checksum")
+
+    def __init__(self, version: int, name: str, sql: str):
+        self.version = version
+        self.name = name
+        self.sql = sql
+        self.checksum = hashlib.sha256(sql.encode()).hexdigest()
+
+    @property
+    def transactional(self) -> bool:
+        return not self.sql.startswith(NO_TRANSACTION)
+
+    def statements(self) -> List[str]:
+        """Інструкції файлу по одній (для міграцій без транзакції)"""
+        parts = _STATEMENT_END_RE.split(self.sql)
+        statements = []
+        for part in parts:
+            lines = [line for line in part.splitlines() if line.strip() and not line.strip().startswith("--")]
+            if lines:
+                statements.append("\n".join(lines))
+        return statements
+
+
+def load_migrations(directory: Path = MIGRATIONS_DIR) -> List[Migration]:
+    migrations = []
+    for path in sorted(directory.glob("*.sql")):
+        match = _FILE_RE.match(path.name)
+        if not match:
+            raise RuntimeError(f"Некоректна назва файлу міграції: {path.name} (очікується NNNN_назва.sql)")
+        migrations.append(Migration(int(match.group(1)), match.group(2), path.read_text(encoding="utf-8")))
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Повторювані номери міграцій у {directory}")
+    return sorted(migrations, key=lambda migration: migration.version)
+
+
+async def _applied(conn) -> Dict[int, str]:
+    """Застосовані міграції {версія: контрольна сума}; порожньо, якщо таблиці ще немає"""
+    try:
+        rows = await conn.fetch("SELECT version, checksum FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return {}
+    return {row["version"]: row["checksum"] for row in rows}
+
+
+def _pending(migrations: List[Migration], applied: Dict[int, str]) -> List[Migration]:
+    for migration in migrations:
+        checksum = applied.get(migration.version)
+        if checksum is not None and checksum != migration.checksum:
+            raise RuntimeError(
+                f"Міграцію {migration.version}_{migration.name} змінено після застосування "
+                f"(контрольна сума не збігається) - додайте нову міграцію замість зміни старої"
+            )
+    return [migration for migration in migrations if migration.version not in applied]
+
+
+async def _apply(conn, migration: Migration):
+    started = time.monotonic()
+    record = (
+        "INSERT INTO schema_migrations (version, name, checksum, duration_ms) VALUES ($1, $2, $3, $4)"
+    )
+    if migration.transactional:
+        async with conn.transaction():
+            await conn.execute(migration.sql, timeout=MIGRATION_TIMEOUT)
+            await conn.execute(
+                record, migration.version, migration.name, migration.checksum,
+                int((time.monotonic() - started) * 1000),
+            )
+    else:
+        # Перервана побудова CONCURRENTLY лишає невалідний індекс, який IF NOT EXISTS пропустив би
+        names = _CONCURRENT_INDEX_RE.findall(migration.sql)
+        invalid = await conn.fetch(
+            """
+            SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE NOT i.indisvalid AND c.relname = ANY($1::TEXT[]) AND pg_table_is_visible(c.oid)
+            """,
+            names,
+        )
+        for row in invalid:
+            logging.warning(f"Міграції: перебудова невалідного індексу {row['relname']}")
+            await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{row["relname"]}"', timeout=MIGRATION_TIMEOUT)
+        for statement in migration.statements():
+            await conn.execute(statement, timeout=MIGRATION_TIMEOUT)
+        await conn.execute(
+            record, migration.version, migration.name, migration.checksum,
+            int((time.monotonic() - started) * 1000),
+        )
+    logging.info(
+        f"Міграцію {migration.version}_{migration.name} застосовано за {time.monotonic() - started:.2f}с"
+    )
+
+
+async def apply_migrations(pool: asyncpg.Pool, directory: Path = MIGRATIONS_DIR) -> int:
+    """
+    Доводить схему до останньої версії; повертає кількість застосованих міграцій.
+    Теплий старт - один запит до schema_migrations без блокувань.
+    """
+    migrations = load_migrations(directory)
+    latest = migrations[-1].version if migrations else 0
+
+    async with pool.acquire() as conn:
+        if not _pending(migrations, await _applied(conn)):
+            logging.info(f"Схема БД вже на версії {latest}")
+            return 0
+
+        # Сесійне блокування: міграції без транзакції виконуються кількома запитами.
+        # Чекаємо через pg_try_advisory_lock, а не pg_advisory_lock: запит, що висить
+        # на блокуванні, тримає транзакцію, і CREATE INDEX CONCURRENTLY у копії,
+        # яка виконує міграції, чекав би на неї - взаємоблокування.
+        while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_KEY):
+            await asyncio.sleep(LOCK_RETRY_INTERVAL)
+        try:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    checksum TEXT NOT NULL,
+                    duration_ms INT,
+                    applied_at TIMESTAMPTZ DEFAULT NOW()
+                )
+                """
+            )
+            # Інша копія могла застосувати міграції, поки ми чекали на блокування
+            pending = _pending(migrations, await _applied(conn))
+            for migration in pending:
+                await _apply(conn, migration)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
+
+    if pending:
+        logging.info(f"Схему БД оновлено до версії {latest} (міграцій: {len(pending)})")
+    return len(pending)
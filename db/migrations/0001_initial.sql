@@ -0,0 +1,77 @@
+-- Початкова схема. Написана ідемпотентно: на базах, створених до появи міграцій
+-- (create_tables або init.sql), лише додає відсутні колонки.
+
+-- Користувачі
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    free_trades_left INT DEFAULT 3,
+    is_subscribed BOOLEAN DEFAULT FALSE,
+    subscription_expires_at TIMESTAMP,
+    referral_code TEXT, -- реферальний код, через який прийшов користувач
+    user_referral_code TEXT UNIQUE, -- власний реферальний код користувача
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS user_referral_code TEXT UNIQUE;
+
+-- Реферальні посилання
+CREATE TABLE IF NOT EXISTS referral_links (
+    id SERIAL PRIMARY KEY,
+    code TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL, -- назва/опис посилання
+    admin_id BIGINT NOT NULL,
+    owner_user_id BIGINT, -- якщо прив'язане до користувача
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_active BOOLEAN DEFAULT TRUE
+);
+ALTER TABLE referral_links ADD COLUMN IF NOT EXISTS owner_user_id BIGINT;
+
+-- Статистика реферальних посилань
+CREATE TABLE IF NOT EXISTS referral_stats (
+    id SERIAL PRIMARY KEY,
+    referral_code TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    action_type TEXT NOT NULL, -- 'click', 'register', 'subscription'
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Історія аналізів
+CREATE TABLE IF NOT EXISTS analyses (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    file_unique_id TEXT, -- file_unique_id графіка (для альбому - через кому)
+    model TEXT, -- модель OpenAI або 'cache'
+    prompt_tokens INT DEFAULT 0,
+    cached_tokens INT DEFAULT 0,
+    completion_tokens INT DEFAULT 0,
+    latency_ms INT,
+    result_text TEXT, -- готовий HTML (режим html)
+    result_fields JSONB, -- поля аналізу (режим structured)
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Черга аналізів (ANALYSIS_BACKEND=queue, виконують процеси worker.py)
+CREATE TABLE IF NOT EXISTS analysis_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL, -- повідомлення з графіком
+    processing_message_id BIGINT NOT NULL, -- повідомлення "Аналізую..." з кнопкою скасування
+    files JSONB NOT NULL, -- файли зображень (file_id, file_unique_id, ...)
+    subscribed BOOLEAN DEFAULT FALSE,
+    refund BOOLEAN DEFAULT FALSE, -- зарезервовано безкоштовну спробу
+    status TEXT NOT NULL DEFAULT 'queued', -- 'queued', 'running', 'done', 'dead', 'cancelled'
+    attempts INT DEFAULT 0,
+    max_attempts INT DEFAULT 3,
+    run_after TIMESTAMPTZ DEFAULT NOW(), -- не раніше цього часу (затримка повтору)
+    lease_until TIMESTAMPTZ, -- оренда воркера; прострочену задачу забирає інший воркер
+    locked_by TEXT, -- ідентифікатор воркера
+    last_error TEXT,
+    cancel_reason TEXT, -- 'user', 'superseded'
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    finished_at TIMESTAMPTZ
+);
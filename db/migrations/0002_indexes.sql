@@ -0,0 +1,14 @@
+-- no-transaction
+-- Індекси будуються CONCURRENTLY - без блокування запису в таблиці.
+-- На базах до появи міграцій вони вже є, IF NOT EXISTS їх пропускає.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_subscription ON users(is_subscribed, subscription_expires_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_created_at ON users(created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_referral_code ON users(referral_code);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_user_referral_code ON users(user_referral_code);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referral_links_code ON referral_links(code);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referral_links_admin ON referral_links(admin_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referral_stats_code ON referral_stats(referral_code);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referral_stats_action ON referral_stats(action_type);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analyses_user_created ON analyses(user_id, created_at DESC, id DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analysis_jobs_pending ON analysis_jobs(id) WHERE status IN ('queued', 'running');
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analysis_jobs_user ON analysis_jobs(user_id, processing_message_id) WHERE finished_at IS NULL;
@@ -0,0 +1,19 @@
+-- Лічильники реферальних посилань: оновлюються разом із записом у referral_stats
+-- (add_referral_stat), тож списки й деталі посилань не агрегують усю історію переходів.
+CREATE TABLE IF NOT EXISTS referral_link_counters (
+    code TEXT PRIMARY KEY, -- referral_links.code
+    clicks BIGINT NOT NULL DEFAULT 0,
+    registrations BIGINT NOT NULL DEFAULT 0,
+    subscriptions BIGINT NOT NULL DEFAULT 0
+);
+
+-- Початкові значення з наявної історії
+INSERT INTO referral_link_counters (code, clicks, registrations, subscriptions)
+SELECT
+    referral_code,
+    COUNT(*) FILTER (WHERE action_type = 'click'),
+    COUNT(*) FILTER (WHERE action_type = 'register'),
+    COUNT(*) FILTER (WHERE action_type = 'subscription')
+FROM referral_stats
+GROUP BY referral_code
+ON CONFLICT (code) DO NOTHING;
@@ -0,0 +1,16 @@
+-- Метрики аналізу задачі (ANALYSIS_BACKEND=queue): воркер записує їх разом із завершенням задачі,
+-- а бот будує з них панелі вартості, версій промптів і латентності (у воркерів власні процеси).
+ALTER TABLE analysis_jobs
+    ADD COLUMN IF NOT EXISTS outcome TEXT, -- ok, html_repaired, refusal, not_chart, error або cache
+    ADD COLUMN IF NOT EXISTS model TEXT,
+    ADD COLUMN IF NOT EXISTS prompt_version TEXT,
+    ADD COLUMN IF NOT EXISTS route TEXT, -- маршрут <tier>:<model>
+    ADD COLUMN IF NOT EXISTS route_reason TEXT, -- причина дешевшого маршруту під навантаженням
+    ADD COLUMN IF NOT EXISTS prompt_tokens INT,
+    ADD COLUMN IF NOT EXISTS cached_tokens INT,
+    ADD COLUMN IF NOT EXISTS completion_tokens INT,
+    ADD COLUMN IF NOT EXISTS queue_ms INT,
+    ADD COLUMN IF NOT EXISTS download_ms INT,
+    ADD COLUMN IF NOT EXISTS upload_ms INT,
+    ADD COLUMN IF NOT EXISTS latency_ms INT, -- запит до моделі
+    ADD COLUMN IF NOT EXISTS cost DOUBLE PRECISION; -- $ за цінами на момент аналізу
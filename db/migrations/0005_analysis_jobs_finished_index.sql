@@ -0,0 +1,3 @@
+-- no-transaction
+-- Зведення метрик і статистика черги вибирають задачі за часом завершення.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_analysis_jobs_finished ON analysis_jobs(finished_at);
@@ -0,0 +1,180 @@
+"""
+Інвалідація кешів між процесами через PostgreSQL LISTEN/NOTIFY.
+Функції db.queries, що змінюють користувачів (кешованих у db.cache.user_cache), надсилають подію
+в канал INVALIDATION_CHANNEL - у самому запиті запису (notify_sql, часті записи) або
+окремим запитом після нього (publish); кожен процес (бот, воркери) слухає канал
+окремим підключенням і скидає відповідні записи локальних кешів.
+Замір затримки інвалідації під навантаженням - benchmarks/cache_invalidation.py.
+"""
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Callable, Dict, List
+
+import asyncpg
+
+from config import DB_DSN, CACHE_INVALIDATION_LISTEN, CACHE_LISTENER_CHECK_INTERVAL, CACHE_LISTENER_MAX_BACKOFF
+from db.cache import user_cache
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+# Тип події: ключ - user_id
+USER_EVENT = "u"
+
+
+async def publish(conn, kind: str, key):
+    """
+    Надсилає подію інвалідації: "<тип>:<ключ>:<час відправки, мс>".
+    Час потрібен лише для заміру затримки на стороні слухача.
+    Це окремий запит після запису: підключення пулу працюють в autocommit, тож запис
+    уже зафіксовано і слухачі не побачать старий рядок, але подія коштує ще одне
+    звернення до БД. Для частих записів подію вбудовано в сам запит (notify_sql).
+    """
+    await conn.execute(
+        "SELECT pg_notify($1, $2)", INVALIDATION_CHANNEL, f"{kind}:{key}:{int(time.time() * 1000)}"
+    )
+
+
+def notify_sql(kind: str, key_sql: str) -> str:
+    """
+    SQL-вираз pg_notify з тією ж подією, що й publish; ключ - вираз key_sql.
+    Вбудовується в запит, що змінює рядок: подія доставляється після COMMIT цього
+    запиту і не потребує окремого звернення до БД.
+    """
+    return (
+        f"pg_notify('{INVALIDATION_CHANNEL}', '{kind}:' || {key_sql} || ':' || "
+        f"(EXTRACT(EPOCH FROM clock_timestamp()) * 1000)::BIGINT)"
+    )
+
+
+class InvalidationListener:
+    """
+    Окреме підключення asyncpg (не з пулу), що слухає INVALIDATION_CHANNEL.
+    Розрив помічається через termination listener або періодичний SELECT 1;
+    далі - перепідключення з експоненційною паузою. Події, надіслані поки слухача
+    не було, втрачені, тому після кожного перепідключення кеші скидаються повністю (resync).
+    Власні події процесу теж приходять сюди - повторне скидання запису нічого не ламає.
+    """
+
+    def __init__(self, dsn: str, channel: str, check_interval: float, max_backoff: float):
+        self.dsn = dsn
+        self.channel = channel
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+
+        self._handlers: Dict[str, Callable[[str], None]] = {}
+        self._resync_handlers: List[Callable[[], None]] = []
+        self._task: asyncio.Task = None
+        self.connected = False
+
+        self.received = 0
+        self.malformed = 0
+        self.reconnects = 0
+        self.resyncs = 0
+        # Затримки останніх подій (мс): від pg_notify у процесі-відправнику до обробки тут
+        self._lags = deque(maxlen=1024)
+        self.lag_max = 0.0
+
+    def on(self, kind: str, handler: Callable[[str], None]):
+        """Обробник подій типу kind; отримує ключ рядком"""
+        self._handlers[kind] = handler
+
+    def on_resync(self, handler: Callable[[], None]):
+        """Повне скидання кешу після пропущених подій"""
+        self._resync_handlers.append(handler)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        backoff = 1.0
+        attempts = 0
+        while True:
+            conn = None
+            try:
+                attempts += 1
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(self.channel, self._on_notification)
+                self.connected = True
+                backoff = 1.0
+                # До першого підключення кеші могли наповнитись без інвалідації
+                if attempts > 1:
+                    self._resync()
+                logging.info(f"Слухач інвалідації кешів підключено (канал {self.channel})")
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), self.check_interval)
+                    except asyncio.TimeoutError:
+                        # Напіввідкрите TCP-з'єднання не закривається само - перевіряємо запитом
+                        await asyncio.wait_for(conn.fetchval("SELECT 1"), self.check_interval)
+                logging.warning("Слухач інвалідації кешів: підключення закрито")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Слухач інвалідації кешів: {e!r}, перепідключення через {backoff:.0f}с")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            self.reconnects += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _resync(self):
+        self.resyncs += 1
+        logging.info("Слухач інвалідації кешів: події могли бути пропущені, кеші скинуто")
+        for handler in self._resync_handlers:
+            handler()
+
+    def _on_notification(self, conn, pid: int, channel: str, payload: str):
+        try:
+            kind, key, sent_ms = payload.rsplit(":", 2)
+            lag = time.time() * 1000 - int(sent_ms)
+        except ValueError:
+            self.malformed += 1
+            logging.warning(f"Некоректна подія інвалідації: {payload!r}")
+            return
+        self.received += 1
+        self._lags.append(lag)
+        self.lag_max = max(self.lag_max, lag)
+        handler = self._handlers.get(kind)
+        if handler:
+            handler(key)
+
+    def stats(self) -> dict:
+        lags = sorted(self._lags)
+        return {
+            "connected": self.connected,
+            "received": self.received,
+            "malformed": self.malformed,
+            "reconnects": self.reconnects,
+            "resyncs": self.resyncs,
+            "lag_avg": statistics.fmean(lags) if lags else 0.0,
+            "lag_p95": lags[int(len(lags) * 0.95)] if lags else 0.0,
+            "lag_max": self.lag_max,
+        }
+
+
+invalidation_listener = InvalidationListener(
+    DB_DSN, INVALIDATION_CHANNEL, CACHE_LISTENER_CHECK_INTERVAL, CACHE_LISTENER_MAX_BACKOFF
+)
+invalidation_listener.on(USER_EVENT, lambda key: user_cache.invalidate(int(key)))
+invalidation_listener.on_resync(user_cache.clear)
+
+
+async def start_listener():
+    """Запуск слухача, якщо він увімкнений у конфігурації"""
+    if CACHE_INVALIDATION_LISTEN:
+        await invalidation_listener.start()
+
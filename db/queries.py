@@ -1,16 +1,37 @@
 import asyncpg
+import json
 import logging
 import random
 import string
-from datetime import datetime, timedelta
-from config import DB_DSN
+from datetime import timedelta
+from config import (
+    DB_DSN, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_STATEMENT_CACHE_SIZE, DB_COMMAND_TIMEOUT,
+    DB_MAX_INACTIVE_CONNECTION_LIFETIME, DB_APPLICATION_NAME,
+)
+from db.cache import user_cache, utc_now, USER_FIELDS
+from db.instrument import query_metrics
+from db.migrate import apply_migrations
+from db.notify import publish, notify_sql, USER_EVENT
 
 pool: asyncpg.Pool = None
 
+async def _init_connection(conn: asyncpg.Connection):
+    """Виконується для кожного нового підключення пулу"""
+    query_metrics.on_connect(conn)
+
 async def create_pool():
     global pool
     try:
-        pool = await asyncpg.create_pool(dsn=DB_DSN)
+        pool = await asyncpg.create_pool(
+            dsn=DB_DSN,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            server_settings={"application_name": DB_APPLICATION_NAME},
+            init=_init_connection,
+        )
         logging.info("Створено пул підключень до бази даних.")
     except Exception as e:
         logging.error(f"Помилка створення пулу підключень: {e}")
@@ -22,96 +43,42 @@ async def close_pool():
         await pool.close()
         logging.info("Пул підключень до бази даних закрито.")
 
-async def create_tables():
-    async with pool.acquire() as conn:
-        # Створення таблиці користувачів з усіма колонками
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                free_trades_left INT DEFAULT 3,
-                is_subscribed BOOLEAN DEFAULT FALSE,
-                subscription_expires_at TIMESTAMP,
-                referral_code TEXT,
-                user_referral_code TEXT UNIQUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
-        
-        # Додаємо колонку referral_code якщо її немає (для існуючих БД)
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN referral_code TEXT")
-        except Exception:
-            pass  # Колонка вже існує
-        
-        # Додаємо колонку created_at якщо її немає (для існуючих БД)
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-        except Exception:
-            pass  # Колонка вже існує
-        
-        # Додаємо колонку user_referral_code якщо її немає (для існуючих БД)
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN user_referral_code TEXT UNIQUE")
-        except Exception:
-            pass  # Колонка вже існує
-        
-        # Додаємо колонку owner_user_id для referral_links якщо її немає
-        try:
-            await conn.execute("ALTER TABLE referral_links ADD COLUMN owner_user_id BIGINT")
-        except Exception:
-            pass  # Колонка вже існує
-        
-        # Створення таблиці реферальних посилань
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS referral_links (
-                id SERIAL PRIMARY KEY,
-                code TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                admin_id BIGINT NOT NULL,
-                owner_user_id BIGINT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE
-            )
-            """
-        )
-        
-        # Створення таблиці статистики реферальних посилань
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS referral_stats (
-                id SERIAL PRIMARY KEY,
-                referral_code TEXT NOT NULL,
-                user_id BIGINT NOT NULL,
-                action_type TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
-        
-        # Створення індексів для оптимізації
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription ON users(is_subscribed, subscription_expires_at)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_user_referral_code ON users(user_referral_code)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_links_code ON referral_links(code)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_links_admin ON referral_links(admin_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_stats_code ON referral_stats(referral_code)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_stats_action ON referral_stats(action_type)")
-        
-        logging.info("Всі таблиці та індекси успішно створені/оновлені")
+def acquire(name: str):
+    """Підключення з пулу; запити через нього враховуються в query_metrics під назвою name"""
+    return query_metrics.acquire(pool, name)
+
+def get_pool_stats() -> dict:
+    """Стан пулу підключень та найдорожчі запити цього процесу"""
+    stats = query_metrics.summary()
+    stats["pool_size"] = pool.get_size() if pool else 0
+    stats["pool_idle"] = pool.get_idle_size() if pool else 0
+    stats["pool_max"] = DB_POOL_MAX_SIZE
+    return stats
+
+async def migrate():
+    """Доводить схему БД до останньої версії (db/migrations)"""
+    await apply_migrations(pool)
 
 async def get_user(user_id: int):
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-        return dict(user) if user else None
+    """
+    Користувач (CachedUser, читається як user["поле"]) або None.
+    Спочатку шукає в кеші користувачів - більшість повідомлень обходиться без запиту до БД.
+    """
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    async with acquire("get_user") as conn:
+        row = await conn.fetchrow(f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE user_id = $1", user_id)
+    return user_cache.put(row, generation) if row else None
+
+async def invalidate_user(conn, user_id: int):
+    """Скидає користувача в кеші цього процесу та сповіщає інші процеси"""
+    user_cache.invalidate(user_id)
+    await publish(conn, USER_EVENT, user_id)
 
 async def add_user(user_id: int, username: str, first_name: str, referral_code: str = None):
-    async with pool.acquire() as conn:
+    async with acquire("add_user") as conn:
         await conn.execute(
             """
             INSERT INTO users (user_id, username, first_name, referral_code) 
@@ -123,17 +90,86 @@ async def add_user(user_id: int, username: str, first_name: str, referral_code:
             first_name,
             referral_code,
         )
+        await invalidate_user(conn, user_id)
+
+def subscription_active_sql(table: str) -> str:
+    """
+    SQL-умова активної підписки для рядка users з псевдонімом table.
+    Те саме правило в Python - db.cache.subscription_active.
+    """
+    return (
+        f"({table}.is_subscribed AND ({table}.subscription_expires_at IS NULL "
+        f"OR {table}.subscription_expires_at > (NOW() AT TIME ZONE 'UTC')))"
+    )
 
-async def use_free_trade(user_id: int):
-    async with pool.acquire() as conn:
+async def reserve_analysis(user_id: int):
+    """
+    Перевіряє право на аналіз і резервує безкоштовну спробу одним запитом.
+    Повертає None, якщо користувача немає, інакше словник зі status:
+    subscribed - активна підписка (нічого не списується);
+    reserved - списано безкоштовну спробу (free_trades_left - залишок);
+    expired - підписка закінчилась; no_trades - спроби закінчились.
+    Списання атомарне: паралельні запити не можуть витратити більше спроб, ніж є.
+    Для активної підписки з кешу користувачів запит до БД не потрібен.
+    Про списання інші процеси дізнаються з події, надісланої тим самим запитом.
+    """
+    user = user_cache.get(user_id)
+    if user is not None and user.subscription_active:
+        return {"status": "subscribed", "free_trades_left": user.free_trades_left}
+
+    async with acquire("reserve_analysis") as conn:
+        row = await conn.fetchrow(
+            f"""
+            WITH target AS (
+                SELECT user_id, is_subscribed, subscription_expires_at, free_trades_left
+                FROM users WHERE user_id = $1
+            ), reserved AS (
+                UPDATE users u
+                SET free_trades_left = u.free_trades_left - 1
+                FROM target t
+                WHERE u.user_id = t.user_id AND NOT u.is_subscribed AND u.free_trades_left > 0
+                RETURNING u.free_trades_left
+            )
+            SELECT
+                t.is_subscribed,
+                {subscription_active_sql("t")} AS subscription_active,
+                r.free_trades_left AS reserved_left,
+                t.free_trades_left,
+                CASE WHEN r.free_trades_left IS NOT NULL THEN {notify_sql(USER_EVENT, "t.user_id")} END AS notified
+            FROM target t LEFT JOIN reserved r ON TRUE
+            """,
+            user_id,
+        )
+    if row is None:
+        return None
+    if row["reserved_left"] is not None:
+        user_cache.update(user_id, free_trades_left=row["reserved_left"])
+        return {"status": "reserved", "free_trades_left": row["reserved_left"]}
+    if row["is_subscribed"]:
+        status = "subscribed" if row["subscription_active"] else "expired"
+    else:
+        status = "no_trades"
+    return {"status": status, "free_trades_left": row["free_trades_left"]}
+
+async def refund_free_trade(user_id: int):
+    """Повертає зарезервовану спробу, якщо аналіз не вдався або не знадобився"""
+    async with acquire("refund_free_trade") as conn:
+        # Подія інвалідації - тим самим запитом
         await conn.execute(
-            "UPDATE users SET free_trades_left = free_trades_left - 1 WHERE user_id = $1 AND free_trades_left > 0",
+            f"""
+            WITH refunded AS (
+                UPDATE users SET free_trades_left = free_trades_left + 1 WHERE user_id = $1
+                RETURNING user_id
+            )
+            SELECT {notify_sql(USER_EVENT, "user_id")} FROM refunded
+            """,
             user_id
         )
+    user_cache.invalidate(user_id)
 
 async def activate_subscription(user_id: int):
-    async with pool.acquire() as conn:
-        expires_at = datetime.now() + timedelta(days=30)
+    async with acquire("activate_subscription") as conn:
+        expires_at = utc_now() + timedelta(days=30)
         await conn.execute(
             """
             UPDATE users 
@@ -143,10 +179,11 @@ async def activate_subscription(user_id: int):
             expires_at,
             user_id,
         )
+        await invalidate_user(conn, user_id)
 
 async def update_subscription_status(user_id: int, is_subscribed: bool):
     """Оновлює статус підписки користувача"""
-    async with pool.acquire() as conn:
+    async with acquire("update_subscription_status") as conn:
         await conn.execute(
             """
             UPDATE users 
@@ -156,6 +193,446 @@ async def update_subscription_status(user_id: int, is_subscribed: bool):
             is_subscribed,
             user_id,
         )
+        await invalidate_user(conn, user_id)
+
+# =============== ІСТОРІЯ АНАЛІЗІВ ===============
+
+async def add_analyses(records: list):
+    """
+    Записує пакет аналізів одним запитом.
+    records - кортежі (user_id, file_unique_id, model, prompt_tokens, cached_tokens,
+    completion_tokens, latency_ms, result_text, result_fields, created_at)
+    """
+    async with acquire("add_analyses") as conn:
+        await conn.executemany(
+            """
+            INSERT INTO analyses (
+                user_id, file_unique_id, model, prompt_tokens, cached_tokens,
+                completion_tokens, latency_ms, result_text, result_fields, created_at
+            )
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9::jsonb, $10)
+            """,
+            records,
+        )
+
+async def get_user_analyses(user_id: int, cursor: tuple = None, newer: bool = False, limit: int = 1):
+    """
+    Сторінка історії аналізів користувача з keyset-пагінацією (без OFFSET).
+    cursor - (created_at, id) запису, від якого рахується сторінка;
+    newer=False - старіші за курсор (від найновіших), newer=True - новіші.
+    Записи завжди повертаються від новіших до старіших.
+    """
+    async with acquire("get_user_analyses") as conn:
+        if cursor is None:
+            rows = await conn.fetch(
+                """
+                SELECT * FROM analyses
+                WHERE user_id = $1
+                ORDER BY created_at DESC, id DESC
+                LIMIT $2
+                """,
+                user_id, limit
+            )
+        elif not newer:
+            rows = await conn.fetch(
+                """
+                SELECT * FROM analyses
+                WHERE user_id = $1 AND (created_at, id) < ($2, $3)
+                ORDER BY created_at DESC, id DESC
+                LIMIT $4
+                """,
+                user_id, cursor[0], cursor[1], limit
+            )
+        else:
+            rows = await conn.fetch(
+                """
+                SELECT * FROM analyses
+                WHERE user_id = $1 AND (created_at, id) > ($2, $3)
+                ORDER BY created_at ASC, id ASC
+                LIMIT $4
+                """,
+                user_id, cursor[0], cursor[1], limit
+            )
+            rows = list(reversed(rows))
+        return [dict(row) for row in rows]
+
+# =============== ЧЕРГА АНАЛІЗІВ ===============
+# Статуси задачі: queued -> running -> done; після останньої невдалої спроби - dead (dead letter);
+# cancelled - скасовано користувачем або замінено новим графіком.
+# Воркер володіє задачею, поки діє його оренда (lease_until); задачу з простроченою орендою
+# забирає інший воркер, і це рахується як спроба. Безкоштовна спроба (refund) повертається
+# в тій самій транзакції, що завершує задачу, тому не може повернутися двічі.
+
+async def enqueue_analysis_job(user_id: int, chat_id: int, message_id: int, processing_message_id: int,
+                               files: list, subscribed: bool, refund: bool,
+                               user_limit: int, queue_limit: int, max_attempts: int):
+    """
+    Додає задачу аналізу в чергу. files - список словників з файлами зображень.
+    Повертає id задачі або None, якщо черга (загальна чи користувача) переповнена.
+    """
+    async with acquire("enqueue_analysis_job") as conn:
+        return await conn.fetchval(
+            """
+            INSERT INTO analysis_jobs (
+                user_id, chat_id, message_id, processing_message_id, files, subscribed, refund, max_attempts
+            )
+            SELECT $1, $2, $3, $4, $5::jsonb, $6, $7, $8
+            WHERE (SELECT COUNT(*) FROM analysis_jobs WHERE user_id = $1 AND finished_at IS NULL) < $9
+              AND (SELECT COUNT(*) FROM analysis_jobs WHERE status IN ('queued', 'running')) < $10
+            RETURNING id
+            """,
+            user_id, chat_id, message_id, processing_message_id, json.dumps(files),
+            subscribed, refund, max_attempts, user_limit, queue_limit
+        )
+
+async def claim_analysis_jobs(worker_id: str, lease_seconds: int, limit: int):
+    """
+    Забирає до limit задач: нові (queued, час повтору настав) та покинуті (running з простроченою орендою).
+    SKIP LOCKED - воркери не чекають один на одного і не отримують ту саму задачу.
+    """
+    async with acquire("claim_analysis_jobs") as conn:
+        rows = await conn.fetch(
+            """
+            UPDATE analysis_jobs j
+            SET status = 'running', attempts = j.attempts + 1, locked_by = $1,
+                lease_until = NOW() + $2::INT * INTERVAL '1 second',
+                updated_at = NOW()
+            WHERE j.id IN (
+                SELECT id FROM analysis_jobs
+                WHERE (status = 'queued' AND run_after <= NOW())
+                   OR (status = 'running' AND lease_until < NOW() AND attempts < max_attempts)
+                ORDER BY id
+                LIMIT $3
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING j.*
+            """,
+            worker_id, lease_seconds, limit
+        )
+        return [dict(row) for row in rows]
+
+async def extend_job_lease(job_id: int, worker_id: str, lease_seconds: int):
+    """
+    Продовжує оренду задачі. Повертає {status, cancel_reason} або None,
+    якщо задача вже не належить воркеру (оренду втрачено).
+    """
+    async with acquire("extend_job_lease") as conn:
+        row = await conn.fetchrow(
+            """
+            UPDATE analysis_jobs
+            SET lease_until = NOW() + $3::INT * INTERVAL '1 second',
+                updated_at = NOW()
+            WHERE id = $1 AND locked_by = $2 AND finished_at IS NULL
+            RETURNING status, cancel_reason
+            """,
+            job_id, worker_id, lease_seconds
+        )
+        return dict(row) if row else None
+
+# Метрики аналізу в рядку задачі (bot.metrics.result_metrics)
+JOB_METRIC_COLUMNS = (
+    "outcome", "model", "prompt_version", "route", "route_reason", "prompt_tokens", "cached_tokens",
+    "completion_tokens", "queue_ms", "download_ms", "upload_ms", "latency_ms", "cost",
+)
+
+async def complete_analysis_job(job_id: int, worker_id: str, refund: bool, metrics: dict = None) -> bool:
+    """
+    Завершує задачу (done або залишає cancelled) і, якщо refund, повертає спробу - однією транзакцією.
+    metrics - метрики аналізу (bot.metrics.result_metrics), зберігаються в рядку задачі.
+    False - задача вже не належить воркеру.
+    """
+    metrics = metrics or {}
+    assignments = ", ".join(f"{column} = ${index}" for index, column in enumerate(JOB_METRIC_COLUMNS, 4))
+    async with acquire("complete_analysis_job") as conn:
+        row = await conn.fetchrow(
+            f"""
+            WITH finished AS (
+                UPDATE analysis_jobs
+                SET status = CASE WHEN status = 'cancelled' THEN status ELSE 'done' END,
+                    lease_until = NULL, finished_at = NOW(), updated_at = NOW(),
+                    {assignments}
+                WHERE id = $1 AND locked_by = $2 AND finished_at IS NULL
+                RETURNING user_id, refund
+            ), refunded AS (
+                UPDATE users u SET free_trades_left = u.free_trades_left + 1
+                FROM finished f
+                WHERE u.user_id = f.user_id AND f.refund AND $3
+            )
+            SELECT user_id, refund FROM finished
+            """,
+            job_id, worker_id, refund, *(metrics.get(column) for column in JOB_METRIC_COLUMNS)
+        )
+        if row and row["refund"] and refund:
+            await invalidate_user(conn, row["user_id"])
+        return row is not None
+
+async def fail_analysis_job(job_id: int, worker_id: str, error: str, retry_delay: int):
+    """
+    Невдала спроба: задача повертається в чергу з затримкою retry_delay * attempts,
+    а після max_attempts спроб - у dead letter з поверненням спроби.
+    Повертає {status, cancel_reason} (новий статус: queued, dead, cancelled)
+    або None, якщо задача вже не належить воркеру.
+    """
+    async with acquire("fail_analysis_job") as conn:
+        row = await conn.fetchrow(
+            """
+            WITH failed AS (
+                UPDATE analysis_jobs
+                SET status = CASE
+                        WHEN status = 'cancelled' THEN status
+                        WHEN attempts >= max_attempts THEN 'dead'
+                        ELSE 'queued'
+                    END,
+                    finished_at = CASE
+                        WHEN status = 'cancelled' OR attempts >= max_attempts THEN NOW()
+                    END,
+                    run_after = NOW() + $4::INT * attempts * INTERVAL '1 second',
+                    last_error = $3, locked_by = NULL, lease_until = NULL,
+                    updated_at = NOW()
+                WHERE id = $1 AND locked_by = $2 AND finished_at IS NULL
+                RETURNING user_id, refund, status, cancel_reason
+            ), refunded AS (
+                UPDATE users u SET free_trades_left = u.free_trades_left + 1
+                FROM failed f
+                WHERE u.user_id = f.user_id AND f.refund AND f.status <> 'queued'
+            )
+            SELECT user_id, refund, status, cancel_reason FROM failed
+            """,
+            job_id, worker_id, error[:1000], retry_delay
+        )
+        if row is None:
+            return None
+        if row["refund"] and row["status"] != "queued":
+            await invalidate_user(conn, row["user_id"])
+        return {"status": row["status"], "cancel_reason": row["cancel_reason"]}
+
+async def release_analysis_job(job_id: int, worker_id: str):
+    """Повертає задачу в чергу без врахування спроби (воркер зупиняється)"""
+    async with acquire("release_analysis_job") as conn:
+        await conn.execute(
+            """
+            UPDATE analysis_jobs
+            SET status = 'queued', attempts = GREATEST(attempts - 1, 0), locked_by = NULL, lease_until = NULL,
+                run_after = NOW(), updated_at = NOW()
+            WHERE id = $1 AND locked_by = $2 AND status = 'running'
+            """,
+            job_id, worker_id
+        )
+
+async def reap_expired_jobs():
+    """
+    Завершує покинуті задачі, яких уже не забере жоден воркер: running з простроченою орендою
+    після останньої спроби (-> dead) та скасовані під час виконання. Повертає спроби.
+    Повертає завершені задачі (для повідомлення користувачам).
+    """
+    async with acquire("reap_expired_jobs") as conn:
+        rows = await conn.fetch(
+            """
+            WITH expired AS (
+                UPDATE analysis_jobs
+                SET status = CASE WHEN status = 'cancelled' THEN status ELSE 'dead' END,
+                    last_error = COALESCE(last_error, 'lease expired'),
+                    lease_until = NULL, finished_at = NOW(), updated_at = NOW()
+                WHERE finished_at IS NULL AND lease_until < NOW()
+                  AND (status = 'cancelled' OR (status = 'running' AND attempts >= max_attempts))
+                RETURNING id, user_id, chat_id, processing_message_id, status, refund, cancel_reason
+            ), refunded AS (
+                UPDATE users u SET free_trades_left = u.free_trades_left + r.count
+                FROM (SELECT user_id, COUNT(*) AS count FROM expired WHERE refund GROUP BY user_id) r
+                WHERE u.user_id = r.user_id
+            )
+            SELECT * FROM expired
+            """
+        )
+        for user_id in {row["user_id"] for row in rows if row["refund"]}:
+            await invalidate_user(conn, user_id)
+        return [dict(row) for row in rows]
+
+async def cancel_analysis_jobs(user_id: int, processing_message_id: int = None, reason: str = "user"):
+    """
+    Скасовує незавершені задачі користувача (одну - за processing_message_id).
+    Задачі в черзі завершуються одразу з поверненням спроби; задачі, що виконуються,
+    позначаються cancelled - воркер побачить це при продовженні оренди.
+    Повертає скасовані задачі з попереднім статусом (previous_status).
+    """
+    async with acquire("cancel_analysis_jobs") as conn:
+        rows = await conn.fetch(
+            """
+            WITH target AS (
+                SELECT id, status FROM analysis_jobs
+                WHERE user_id = $1 AND ($2::BIGINT IS NULL OR processing_message_id = $2)
+                  AND status IN ('queued', 'running')
+                FOR UPDATE
+            ), cancelled AS (
+                UPDATE analysis_jobs j
+                SET status = 'cancelled', cancel_reason = $3, updated_at = NOW(),
+                    finished_at = CASE WHEN t.status = 'queued' THEN NOW() END
+                FROM target t
+                WHERE j.id = t.id
+                RETURNING j.id, j.chat_id, j.processing_message_id, j.refund, t.status AS previous_status
+            ), refunded AS (
+                UPDATE users u SET free_trades_left = u.free_trades_left + r.count
+                FROM (SELECT COUNT(*) AS count FROM cancelled WHERE previous_status = 'queued' AND refund) r
+                WHERE u.user_id = $1 AND r.count > 0
+            )
+            SELECT * FROM cancelled
+            """,
+            user_id, processing_message_id, reason
+        )
+        if rows:
+            await invalidate_user(conn, user_id)
+    return [dict(row) for row in rows]
+
+async def get_analysis_job_stats():
+    """Кількість незавершених задач та задач у dead letter за останню добу"""
+    async with acquire("get_analysis_job_stats") as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT
+                COUNT(*) FILTER (WHERE status = 'queued') AS queued,
+                COUNT(*) FILTER (WHERE status = 'running') AS running,
+                COUNT(*) FILTER (WHERE status = 'dead') AS dead
+            FROM analysis_jobs
+            WHERE finished_at IS NULL OR finished_at > NOW() - INTERVAL '1 day'
+            """
+        )
+        return dict(row)
+
+async def count_queued_analysis_jobs() -> int:
+    """Задачі, що чекають на воркер - глибина черги для маршрутизації (ANALYSIS_BACKEND=queue)"""
+    async with acquire("count_queued_analysis_jobs") as conn:
+        return await conn.fetchval("SELECT COUNT(*) FROM analysis_jobs WHERE status = 'queued'")
+
+async def get_analysis_job_metrics(days: int, top: int = 5):
+    """
+    Метрики аналізів воркерів (ANALYSIS_BACKEND=queue) з рядків analysis_jobs за сьогодні
+    та попередні days - 1 днів (UTC) у форматі AnalysisMetrics.stats() і cost_rollup().
+    Кеш і відхилені фільтром графіки враховуються лише в результатах, як і в AnalysisMetrics.
+    """
+    since = "finished_at >= ((NOW() AT TIME ZONE 'UTC')::date - ($1::INT - 1)) AT TIME ZONE 'UTC'"
+    window = f"{since} AND outcome IS NOT NULL"
+    # Запити, що дійшли до моделі
+    requests = f"{window} AND outcome NOT IN ('cache', 'not_chart')"
+    async with acquire("get_analysis_job_metrics") as conn:
+        outcomes = await conn.fetch(
+            f"SELECT outcome AS name, COUNT(*) AS count FROM analysis_jobs WHERE {window} GROUP BY outcome",
+            days
+        )
+        cancelled = await conn.fetchval(
+            f"SELECT COUNT(*) FROM analysis_jobs WHERE status = 'cancelled' AND {since}", days
+        )
+        models = await conn.fetch(
+            f"SELECT model AS name, COUNT(*) AS count FROM analysis_jobs WHERE {requests} AND model IS NOT NULL GROUP BY model",
+            days
+        )
+        routes = await conn.fetch(
+            f"SELECT route AS name, COUNT(*) AS count FROM analysis_jobs WHERE {window} AND route IS NOT NULL GROUP BY route",
+            days
+        )
+        reasons = await conn.fetch(
+            f"""
+            SELECT route_reason AS name, COUNT(*) AS count FROM analysis_jobs
+            WHERE {window} AND route_reason IS NOT NULL GROUP BY route_reason
+            """,
+            days
+        )
+        totals = await conn.fetchrow(
+            f"""
+            SELECT
+                COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+                COALESCE(SUM(cached_tokens), 0) AS cached_tokens,
+                COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+                AVG(queue_ms)::FLOAT AS queue_avg,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY queue_ms) AS queue_p95,
+                AVG(download_ms)::FLOAT AS download_avg,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY download_ms) AS download_p95,
+                AVG(upload_ms)::FLOAT AS upload_avg,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY upload_ms) AS upload_p95,
+                AVG(latency_ms - upload_ms)::FLOAT AS generation_avg,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms - upload_ms) AS generation_p95,
+                AVG(queue_ms + download_ms + latency_ms)::FLOAT AS total_avg,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY queue_ms + download_ms + latency_ms) AS total_p95
+            FROM analysis_jobs WHERE {requests}
+            """,
+            days
+        )
+        versions = await conn.fetch(
+            f"""
+            SELECT
+                prompt_version AS name,
+                COUNT(*) AS requests,
+                COUNT(*) FILTER (WHERE outcome = 'refusal') AS refusals,
+                COUNT(*) FILTER (WHERE outcome = 'error') AS errors,
+                SUM(prompt_tokens) AS prompt_tokens,
+                SUM(cached_tokens) AS cached_tokens,
+                SUM(completion_tokens) AS completion_tokens,
+                SUM(cost) AS cost,
+                (AVG(latency_ms) FILTER (WHERE outcome <> 'error'))::FLOAT AS latency_avg,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms) FILTER (WHERE outcome <> 'error') AS latency_p95
+            FROM analysis_jobs WHERE {requests} AND prompt_version IS NOT NULL
+            GROUP BY prompt_version ORDER BY prompt_version
+            """,
+            days
+        )
+        daily = await conn.fetch(
+            f"""
+            SELECT to_char(finished_at AT TIME ZONE 'UTC', 'YYYY-MM-DD') AS day, SUM(cost) AS cost, COUNT(*) AS requests
+            FROM analysis_jobs WHERE {requests}
+            GROUP BY day ORDER BY day DESC
+            """,
+            days
+        )
+        top_users = await conn.fetch(
+            f"""
+            SELECT user_id, SUM(cost) AS cost FROM analysis_jobs
+            WHERE {requests} AND finished_at >= (NOW() AT TIME ZONE 'UTC')::date AT TIME ZONE 'UTC'
+            GROUP BY user_id ORDER BY cost DESC LIMIT $2
+            """,
+            days, top
+        )
+
+    def seconds(value) -> float:
+        return (value or 0) / 1000
+
+    prompt_tokens = totals["prompt_tokens"]
+    outcome_counts = {row["name"]: row["count"] for row in outcomes}
+    if cancelled:
+        outcome_counts["cancelled"] = cancelled
+    stats = {
+        "outcomes": outcome_counts,
+        "models": {row["name"]: row["count"] for row in models},
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": totals["cached_tokens"],
+        "completion_tokens": totals["completion_tokens"],
+        "cached_ratio": totals["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0,
+        "stages": {
+            name: (seconds(totals[f"{name}_avg"]), seconds(totals[f"{name}_p95"]))
+            for name in ("queue", "download", "upload", "generation", "total")
+        },
+        "routes": {row["name"]: row["count"] for row in routes},
+        "route_reasons": {row["name"]: row["count"] for row in reasons},
+        "prompt_versions": {
+            row["name"]: {
+                "requests": row["requests"],
+                "refusal_rate": row["refusals"] / row["requests"],
+                "error_rate": row["errors"] / row["requests"],
+                "prompt_tokens": row["prompt_tokens"] / row["requests"],
+                "completion_tokens": row["completion_tokens"] / row["requests"],
+                "cached_ratio": row["cached_tokens"] / row["prompt_tokens"] if row["prompt_tokens"] else 0.0,
+                "cost": row["cost"] / row["requests"],
+                "latency": (seconds(row["latency_avg"]), seconds(row["latency_p95"])),
+            }
+            for row in versions
+        },
+    }
+    today = utc_now().strftime("%Y-%m-%d")
+    cost = {
+        "today": next((row["cost"] for row in daily if row["day"] == today), 0.0),
+        "today_requests": next((row["requests"] for row in daily if row["day"] == today), 0),
+        "days": [(row["day"], row["cost"]) for row in daily],
+        "top_users": [(row["user_id"], row["cost"]) for row in top_users],
+    }
+    return stats, cost
 
 # =============== РЕФЕРАЛЬНА СИСТЕМА ===============
 
@@ -171,7 +648,7 @@ async def generate_user_referral_code(user_id: int) -> str:
 
 async def create_referral_link(admin_id: int, name: str, owner_user_id: int = None) -> str:
     """Створює новий реферальний код з можливістю прив'язки до користувача"""
-    async with pool.acquire() as conn:
+    async with acquire("create_referral_link") as conn:
         while True:
             code = generate_referral_code()
             try:
@@ -189,6 +666,7 @@ async def create_referral_link(admin_id: int, name: str, owner_user_id: int = No
                         "UPDATE users SET user_referral_code = $1 WHERE user_id = $2",
                         code, owner_user_id
                     )
+                    await invalidate_user(conn, owner_user_id)
                 
                 return code
             except asyncpg.UniqueViolationError:
@@ -197,7 +675,7 @@ async def create_referral_link(admin_id: int, name: str, owner_user_id: int = No
 
 async def get_referral_link(code: str):
     """Отримує інформацію про реферальний код"""
-    async with pool.acquire() as conn:
+    async with acquire("get_referral_link") as conn:
         link = await conn.fetchrow(
             "SELECT * FROM referral_links WHERE code = $1 AND is_active = TRUE",
             code
@@ -205,26 +683,43 @@ async def get_referral_link(code: str):
         return dict(link) if link else None
 
 async def get_admin_referral_links(admin_id: int):
-    """Отримує всі реферальні посилання адміна"""
-    async with pool.acquire() as conn:
+    """Отримує всі реферальні посилання адміна з лічильниками"""
+    async with acquire("get_admin_referral_links") as conn:
         links = await conn.fetch(
             """
-            SELECT rl.*, 
-                   COUNT(CASE WHEN rs.action_type = 'register' THEN 1 END) as registrations,
-                   COUNT(CASE WHEN rs.action_type = 'subscription' THEN 1 END) as subscriptions
+            SELECT rl.*,
+                   COALESCE(c.clicks, 0) as clicks,
+                   COALESCE(c.registrations, 0) as registrations,
+                   COALESCE(c.subscriptions, 0) as subscriptions
             FROM referral_links rl
-            LEFT JOIN referral_stats rs ON rl.code = rs.referral_code
+            LEFT JOIN referral_link_counters c ON c.code = rl.code
             WHERE rl.admin_id = $1
-            GROUP BY rl.id, rl.code, rl.name, rl.admin_id, rl.created_at, rl.is_active
             ORDER BY rl.created_at DESC
             """,
             admin_id
         )
         return [dict(link) for link in links]
 
+async def get_admin_referral_link(code: str, admin_id: int):
+    """Одне реферальне посилання адміна з лічильниками (активне чи ні)"""
+    async with acquire("get_admin_referral_link") as conn:
+        link = await conn.fetchrow(
+            """
+            SELECT rl.*,
+                   COALESCE(c.clicks, 0) as clicks,
+                   COALESCE(c.registrations, 0) as registrations,
+                   COALESCE(c.subscriptions, 0) as subscriptions
+            FROM referral_links rl
+            LEFT JOIN referral_link_counters c ON c.code = rl.code
+            WHERE rl.code = $1 AND rl.admin_id = $2
+            """,
+            code, admin_id
+        )
+        return dict(link) if link else None
+
 async def toggle_referral_link_status(code: str, admin_id: int):
     """Змінює статус активності реферального посилання"""
-    async with pool.acquire() as conn:
+    async with acquire("toggle_referral_link_status") as conn:
         await conn.execute(
             """
             UPDATE referral_links 
@@ -235,27 +730,38 @@ async def toggle_referral_link_status(code: str, admin_id: int):
         )
 
 async def add_referral_stat(referral_code: str, user_id: int, action_type: str):
-    """Додає статистику використання реферального коду"""
-    async with pool.acquire() as conn:
+    """
+    Додає статистику використання реферального коду.
+    Лічильник посилання в referral_link_counters збільшується тим самим запитом (однією транзакцією).
+    """
+    async with acquire("add_referral_stat") as conn:
         await conn.execute(
             """
-            INSERT INTO referral_stats (referral_code, user_id, action_type)
-            VALUES ($1, $2, $3)
+            WITH stat AS (
+                INSERT INTO referral_stats (referral_code, user_id, action_type)
+                VALUES ($1, $2, $3)
+            )
+            INSERT INTO referral_link_counters AS c (code, clicks, registrations, subscriptions)
+            VALUES ($1, ($3 = 'click')::INT, ($3 = 'register')::INT, ($3 = 'subscription')::INT)
+            ON CONFLICT (code) DO UPDATE SET
+                clicks = c.clicks + EXCLUDED.clicks,
+                registrations = c.registrations + EXCLUDED.registrations,
+                subscriptions = c.subscriptions + EXCLUDED.subscriptions
             """,
             referral_code, user_id, action_type
         )
 
 async def get_referral_stats_summary(admin_id: int):
     """Отримує загальну статистику реферальних посилань адміна"""
-    async with pool.acquire() as conn:
+    async with acquire("get_referral_stats_summary") as conn:
         stats = await conn.fetchrow(
             """
             SELECT 
-                COUNT(DISTINCT rl.code) as total_links,
-                COUNT(CASE WHEN rs.action_type = 'register' THEN 1 END) as total_registrations,
-                COUNT(CASE WHEN rs.action_type = 'subscription' THEN 1 END) as total_subscriptions
+                COUNT(*) as total_links,
+                COALESCE(SUM(c.registrations), 0)::BIGINT as total_registrations,
+                COALESCE(SUM(c.subscriptions), 0)::BIGINT as total_subscriptions
             FROM referral_links rl
-            LEFT JOIN referral_stats rs ON rl.code = rs.referral_code
+            LEFT JOIN referral_link_counters c ON c.code = rl.code
             WHERE rl.admin_id = $1
             """,
             admin_id
@@ -266,7 +772,7 @@ async def get_referral_stats_summary(admin_id: int):
 
 async def get_user_referrals(user_id: int):
     """Отримує список рефералів користувача"""
-    async with pool.acquire() as conn:
+    async with acquire("get_user_referrals") as conn:
         # Знаходимо реферальне посилання прив'язане до користувача
         link = await conn.fetchrow(
             "SELECT code FROM referral_links WHERE owner_user_id = $1 AND is_active = TRUE",
@@ -292,7 +798,7 @@ async def get_user_referrals(user_id: int):
 
 async def get_user_referral_stats(user_id: int):
     """Отримує статистику рефералів користувача"""
-    async with pool.acquire() as conn:
+    async with acquire("get_user_referral_stats") as conn:
         # Знаходимо реферальне посилання прив'язане до користувача
         link = await conn.fetchrow(
             "SELECT code, name FROM referral_links WHERE owner_user_id = $1 AND is_active = TRUE",
@@ -332,7 +838,7 @@ async def get_user_referral_stats(user_id: int):
 
 async def get_user_by_referral_code(referral_code: str):
     """Перевіряє чи існує користувач з таким реферальним кодом (через referral_links)"""
-    async with pool.acquire() as conn:
+    async with acquire("get_user_by_referral_code") as conn:
         # Шукаємо посилання з цим кодом та owner_user_id
         link = await conn.fetchrow(
             "SELECT owner_user_id FROM referral_links WHERE code = $1 AND owner_user_id IS NOT NULL",
@@ -353,8 +859,8 @@ async def get_user_by_referral_code(referral_code: str):
 
 async def admin_grant_subscription(user_id: int):
     """Адмін надає підписку користувачу"""
-    async with pool.acquire() as conn:
-        expires_at = datetime.now() + timedelta(days=30)
+    async with acquire("admin_grant_subscription") as conn:
+        expires_at = utc_now() + timedelta(days=30)
         await conn.execute(
             """
             UPDATE users 
@@ -363,10 +869,11 @@ async def admin_grant_subscription(user_id: int):
             """,
             expires_at, user_id
         )
+        await invalidate_user(conn, user_id)
 
 async def admin_grant_free_tries(user_id: int, count: int = 1):
     """Адмін надає безкоштовні спроби користувачу"""
-    async with pool.acquire() as conn:
+    async with acquire("admin_grant_free_tries") as conn:
         await conn.execute(
             """
             UPDATE users 
@@ -375,10 +882,11 @@ async def admin_grant_free_tries(user_id: int, count: int = 1):
             """,
             count, user_id
         )
+        await invalidate_user(conn, user_id)
 
 async def get_user_by_username(username: str):
     """Знаходить користувача за username"""
-    async with pool.acquire() as conn:
+    async with acquire("get_user_by_username") as conn:
         user = await conn.fetchrow(
             "SELECT * FROM users WHERE username = $1",
             username
@@ -387,7 +895,7 @@ async def get_user_by_username(username: str):
 
 async def search_users(query: str, limit: int = 10):
     """Пошук користувачів за username або first_name"""
-    async with pool.acquire() as conn:
+    async with acquire("search_users") as conn:
         users = await conn.fetch(
             """
             SELECT user_id, username, first_name, is_subscribed, free_trades_left
@@ -403,46 +911,29 @@ async def search_users(query: str, limit: int = 10):
 # =============== ЗАГАЛЬНА СТАТИСТИКА БОТА ===============
 
 async def get_bot_stats():
-    """Отримує загальну статистику бота"""
-    async with pool.acquire() as conn:
-        # Загальна кількість користувачів
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        
-        # Активні підписки
-        active_subscriptions = await conn.fetchval(
-            """
-            SELECT COUNT(*) FROM users 
-            WHERE is_subscribed = TRUE 
-            AND (subscription_expires_at IS NULL OR subscription_expires_at > NOW())
-            """
-        )
-        
-        # Користувачі за останні 7 днів
-        recent_users = await conn.fetchval(
+    """
+    Отримує загальну статистику бота одним запитом.
+    Кожен лічильник - окремий підзапит: так планувальник бере index-only scan по своєму індексу
+    (COUNT(*) FILTER в одному проході по users вимушує повне сканування таблиці).
+    Реферальні переходи й підписки беруться з лічильників посилань, а не з історії referral_stats.
+    Адмін-панель читає статистику зі знімка (bot/stats.py), а не викликає напряму.
+    """
+    async with acquire("get_bot_stats") as conn:
+        row = await conn.fetchrow(
+            f"""
+            SELECT
+                -- Загальна кількість користувачів
+                (SELECT COUNT(*) FROM users) AS total_users,
+                -- Активні підписки
+                (
+                    SELECT COUNT(*) FROM users WHERE {subscription_active_sql("users")}
+                ) AS active_subscriptions,
+                -- Користувачі за останні 7 днів
+                (SELECT COUNT(*) FROM users WHERE created_at > NOW() - INTERVAL '7 days') AS recent_users,
+                -- Реферальні посилання, переходи та підписки через них
+                (SELECT COUNT(*) FROM referral_links) AS total_referral_links,
+                (SELECT COALESCE(SUM(registrations), 0)::BIGINT FROM referral_link_counters) AS total_referral_clicks,
+                (SELECT COALESCE(SUM(subscriptions), 0)::BIGINT FROM referral_link_counters) AS referral_subscriptions
             """
-            SELECT COUNT(*) FROM users 
-            WHERE created_at > NOW() - INTERVAL '7 days'
-            """
-        )
-        
-        # Загальна кількість реферальних посилань
-        total_referral_links = await conn.fetchval("SELECT COUNT(*) FROM referral_links")
-        
-        # Загальна кількість переходів по реферальних посиланнях
-        total_referral_clicks = await conn.fetchval(
-            "SELECT COUNT(*) FROM referral_stats WHERE action_type = 'register'"
         )
-        
-        # Загальна кількість підписок через реферальні посилання
-        referral_subscriptions = await conn.fetchval(
-            "SELECT COUNT(*) FROM referral_stats WHERE action_type = 'subscription'"
-        )
-        
-        return {
-            "total_users": total_users or 0,
-            "active_subscriptions": active_subscriptions or 0,
-            "recent_users": recent_users or 0,
-            "total_referral_links": total_referral_links or 0,
-            "total_referral_clicks": total_referral_clicks or 0,
-            "referral_subscriptions": referral_subscriptions or 0
-        } 
\ No newline at end of file
+        return {key: value or 0 for key, value in row.items()}
@@ -10,7 +10,14 @@ from bot.handlers.user_handlers import register_user_handlers
 from bot.handlers.trade_handlers import register_trade_handlers
 from bot.handlers.payment_handlers import register_payment_handlers
 from bot.handlers.admin_handlers import register_admin_handlers
+from bot.handlers.history_handlers import register_history_handlers
+from bot.scheduler import analysis_scheduler
+from bot.history import history_writer
+from bot.stats import bot_stats
+from bot.middlewares.album import album_middleware
+from bot.middlewares.throttling import throttling_middleware
 from db import queries as db
+from db.notify import invalidation_listener, start_listener
 
 # Встановлюємо рівень логування
 logging.basicConfig(level=logging.INFO)
@@ -25,21 +32,37 @@ async def on_startup(dp):
     """Виконується при старті бота"""
     logging.info("Створення підключення до PostgreSQL...")
     await db.create_pool()
-    logging.info("Створення таблиць (якщо не існують)...")
-    await db.create_tables()
+    logging.info("Перевірка міграцій схеми БД...")
+    await db.migrate()
+    # Події інвалідації кешу користувачів від воркерів та інших копій бота
+    await start_listener()
+    await analysis_scheduler.start()
+    await history_writer.start()
+    # Статистика для адмін-панелі рахується у фоні
+    await bot_stats.start()
 
 
 async def on_shutdown(dp):
     """Виконується при зупинці бота"""
+    await invalidation_listener.stop()
+    await bot_stats.stop()
+    await analysis_scheduler.stop()
+    # Дописуємо історію до закриття пулу
+    await history_writer.stop()
     logging.info("Закриття підключення до PostgreSQL...")
     await db.close_pool()
 
 
 if __name__ == "__main__":
+    # Альбом збирається до перевірки ліміту, щоб він рахувався як один запит
+    dp.middleware.setup(album_middleware)
+    dp.middleware.setup(throttling_middleware)
+
     register_user_handlers(dp)
     register_trade_handlers(dp)
     register_payment_handlers(dp)
     register_admin_handlers(dp)
+    register_history_handlers(dp)
 
     executor.start_polling(
         dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown
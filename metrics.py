@@ -0,0 +1,37 @@
+"""
+Спільні примітиви метрик без залежностей від бота чи БД:
+їх використовують і bot.metrics (аналізи), і db.instrument (запити до PostgreSQL).
+"""
+import bisect
+
+
+class Histogram:
+    """Гістограма з фіксованими кошиками: кількість, сума та наближені перцентилі"""
+    __slots__ = ("bounds", "buckets", "count", "total")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        """Верхня межа кошика, в який потрапляє перцентиль q"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float("inf")
+        return float("inf")
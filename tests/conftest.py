@@ -0,0 +1,59 @@
+"""
+Спільні налаштування тестів. config.py при імпорті вимагає токени та DSN,
+тому фіктивні значення підставляються до імпорту модулів бота.
+Інтеграційні тести з БД піднімають тимчасовий PostgreSQL через pgserver
+(requirements-dev.txt) і пропускаються, якщо його немає.
+"""
+import contextlib
+import os
+import uuid
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("DB_DSN", "postgresql://test@localhost/test")
+os.environ.setdefault("ADMIN_ID", "1")
+
+
+@pytest.fixture(scope="session")
+def postgres_server(tmp_path_factory):
+    """Тимчасовий сервер PostgreSQL на час сесії тестів"""
+    pgserver = pytest.importorskip("pgserver")
+    server = pgserver.get_server(str(tmp_path_factory.mktemp("pgdata")), cleanup_mode="stop")
+    yield server
+    server.cleanup()
+
+
+@pytest.fixture
+def database(postgres_server):
+    """DSN окремої порожньої бази для одного тесту"""
+    name = f"test_{uuid.uuid4().hex[:12]}"
+    postgres_server.psql(f"CREATE DATABASE {name};")
+    yield postgres_server.get_uri(name)
+    postgres_server.psql(f"DROP DATABASE {name} WITH (FORCE);")
+
+
+@pytest.fixture
+def db_pool(database):
+    """
+    Фабрика пулу db.queries на тестовій базі з накатаними міграціями:
+    async with db_pool(max_size=...) as pool - в циклі подій самого тесту.
+    """
+    import asyncpg
+    from db import queries
+    from db.cache import user_cache
+
+    @contextlib.asynccontextmanager
+    async def open_pool(**options):
+        queries.pool = await asyncpg.create_pool(database, init=queries._init_connection, **options)
+        user_cache.clear()
+        try:
+            await queries.migrate()
+            yield queries.pool
+        finally:
+            await queries.pool.close()
+            queries.pool = None
+            user_cache.clear()
+
+    return open_pool
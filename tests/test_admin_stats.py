@@ -0,0 +1,62 @@
+"""
+Панелі статистики адміністратора вміщуються в одне повідомлення Telegram
+навіть із великою кількістю версій промптів, моделей і днів вартості.
+"""
+import asyncio
+
+import pytest
+
+from bot.handlers import admin_handlers
+from bot.streaming import MESSAGE_LIMIT
+from tests.test_formatting import assert_telegram_html
+
+
+def version_summary(requests: int) -> dict:
+    return {
+        "requests": requests, "refusal_rate": 0.01, "error_rate": 0.02, "prompt_tokens": 1234.0,
+        "completion_tokens": 456.0, "cached_ratio": 0.5, "cost": 0.0123, "latency": (7.5, 12.0),
+    }
+
+
+@pytest.fixture
+def crowded_metrics(monkeypatch):
+    """Метрики, які без обмежень дали б повідомлення в десятки тисяч символів"""
+    metrics = admin_handlers.analysis_metrics
+    stats = metrics.stats()
+    stats["prompt_versions"] = {f"version-{index:03d}": version_summary(index) for index in range(300)}
+    stats["outcomes"] = {f"outcome-{index}": index for index in range(100)}
+    monkeypatch.setattr(metrics, "stats", lambda: stats)
+    monkeypatch.setattr(metrics, "cost_rollup", lambda: {
+        "today": 12.5, "today_requests": 1000,
+        "days": [(f"2026-{month:02d}-{day:02d}", 3.25) for month in range(1, 13) for day in range(1, 29)],
+        "top_users": [(1000000 + index, 0.5) for index in range(5)],
+    })
+
+    upstream = admin_handlers.openai_client.stats()
+    model = dict(breaker="closed", trips=0, latency_avg=1.0, stream_latency_avg=0.5,
+                 hedge_delay=2.0, stream_hedge_delay=1.0)
+    upstream["models"] = {f"model-{index}": model for index in range(200)}
+    monkeypatch.setattr(admin_handlers.openai_client, "stats", lambda: upstream)
+
+    registry = admin_handlers.prompt_registry.stats()
+    registry["split"] = {f"version-{index:03d}": 1 / 300 for index in range(300)}
+    monkeypatch.setattr(admin_handlers.prompt_registry, "stats", lambda: registry)
+
+
+@pytest.mark.parametrize("section", sorted(admin_handlers.STATS_SECTIONS))
+def test_stats_sections_fit_one_message(crowded_metrics, section):
+    text = admin_handlers._fit_message(asyncio.run(admin_handlers.STATS_SECTIONS[section]()))
+    assert len(text) <= MESSAGE_LIMIT
+    assert_telegram_html(text)
+
+
+def test_prompt_versions_are_capped(crowded_metrics):
+    text = asyncio.run(admin_handlers._stats_prompts())
+    assert "version-299" in text and "version-000:" not in text
+    assert "…ще 293 версій" in text
+
+
+def test_fit_message_keeps_html_valid():
+    text = admin_handlers._fit_message("<b>" + "рядок статистики\n" * 1000 + "</b>")
+    assert len(text) <= MESSAGE_LIMIT
+    assert_telegram_html(text)
@@ -0,0 +1,248 @@
+"""
+Черга аналізів у PostgreSQL (ANALYSIS_BACKEND=queue) на тимчасовому сервері:
+SKIP LOCKED, оренди, повтори, dead letter, скасування та воркер worker.py.
+"""
+import asyncio
+import itertools
+
+import worker
+from bot.ai import ANALYSIS_ERROR_MESSAGE, AnalysisResult, Route
+from bot.handlers import trade_handlers
+from bot.metrics import request_cost
+from db import queries as db
+from db.cache import user_cache
+from tests.test_db import create_user
+
+PHOTO = {"file_id": "photo-file-id", "file_unique_id": "photo-unique-id", "width": 800, "height": 600}
+_message_ids = itertools.count(1000)
+
+
+async def enqueue(user_id: int, chat_id: int = None, refund: bool = False, max_attempts: int = 3) -> int:
+    message_id = next(_message_ids)
+    return await db.enqueue_analysis_job(
+        user_id, chat_id or user_id, message_id, message_id + 100000, [PHOTO], False, refund,
+        user_limit=100, queue_limit=1000, max_attempts=max_attempts,
+    )
+
+
+async def free_trades(user_id: int) -> int:
+    user_cache.clear()
+    return (await db.get_user(user_id))["free_trades_left"]
+
+
+async def job(job_id: int) -> dict:
+    async with db.acquire("test") as conn:
+        return dict(await conn.fetchrow("SELECT * FROM analysis_jobs WHERE id = $1", job_id))
+
+
+def test_parallel_workers_never_claim_the_same_job(db_pool):
+    async def scenario():
+        async with db_pool(min_size=8, max_size=8):
+            await create_user(1)
+            ids = [await enqueue(1) for _ in range(40)]
+
+            async def drain(worker_id: str):
+                claimed = []
+                while True:
+                    jobs = await db.claim_analysis_jobs(worker_id, 60, 3)
+                    if not jobs:
+                        return claimed
+                    claimed += [(job["id"], job["locked_by"]) for job in jobs]
+
+            claims = await asyncio.gather(*(drain(f"worker-{index}") for index in range(6)))
+            claimed = [job_id for worker_claims in claims for job_id, _ in worker_claims]
+            assert sorted(claimed) == ids
+            assert all(locked_by == f"worker-{index}" for index, worker_claims in enumerate(claims)
+                       for _, locked_by in worker_claims)
+    asyncio.run(scenario())
+
+
+def test_expired_lease_moves_job_to_another_worker_then_dead_letter(db_pool):
+    async def scenario():
+        async with db_pool():
+            await create_user(2, free_trades_left=0)
+            job_id = await enqueue(2, refund=True, max_attempts=2)
+
+            [first] = await db.claim_analysis_jobs("worker-a", 1, 10)
+            assert first["attempts"] == 1
+            # Поки оренда діє, задачу не отримує ніхто інший
+            assert await db.claim_analysis_jobs("worker-b", 1, 10) == []
+
+            await asyncio.sleep(1.2)
+            [second] = await db.claim_analysis_jobs("worker-b", 30, 10)
+            assert second["id"] == job_id and second["attempts"] == 2
+            # Перший воркер втратив оренду: ні завершити, ні продовжити задачу не може
+            assert await db.extend_job_lease(job_id, "worker-a", 30) is None
+            assert await db.complete_analysis_job(job_id, "worker-a", True) is False
+
+            # Остання спроба невдала - dead letter і повернення спроби
+            state = await db.fail_analysis_job(job_id, "worker-b", "boom", 0)
+            assert state == {"status": "dead", "cancel_reason": None}
+            assert (await job(job_id))["last_error"] == "boom"
+            assert await free_trades(2) == 1
+            assert await db.claim_analysis_jobs("worker-c", 30, 10) == []
+            assert (await db.get_analysis_job_stats())["dead"] == 1
+    asyncio.run(scenario())
+
+
+def test_failed_attempt_is_retried_after_delay(db_pool):
+    async def scenario():
+        async with db_pool():
+            await create_user(3)
+            job_id = await enqueue(3, max_attempts=3)
+            await db.claim_analysis_jobs("worker-a", 30, 10)
+            assert (await db.fail_analysis_job(job_id, "worker-a", "timeout", 1))["status"] == "queued"
+            # Затримка повтору retry_delay * attempts
+            assert await db.claim_analysis_jobs("worker-b", 30, 10) == []
+            await asyncio.sleep(1.2)
+            [retried] = await db.claim_analysis_jobs("worker-b", 30, 10)
+            assert retried["id"] == job_id and retried["attempts"] == 2
+            assert await db.complete_analysis_job(job_id, "worker-b", False)
+            assert (await job(job_id))["status"] == "done"
+    asyncio.run(scenario())
+
+
+def test_cancellation_refunds_queued_and_flags_running_jobs(db_pool):
+    async def scenario():
+        async with db_pool():
+            await create_user(4, free_trades_left=0)
+            running_id = await enqueue(4, refund=True)
+            queued_id = await enqueue(4, refund=True)
+            await db.claim_analysis_jobs("worker-a", 30, 1)
+
+            cancelled = await db.cancel_analysis_jobs(4, reason="superseded")
+            assert {row["id"]: row["previous_status"] for row in cancelled} == {
+                running_id: "running", queued_id: "queued",
+            }
+            # Задача в черзі завершена одразу з поверненням спроби
+            assert (await job(queued_id))["finished_at"] is not None
+            assert await free_trades(4) == 1
+            # Воркер дізнається про скасування при продовженні оренди і повертає спробу при завершенні
+            assert await db.extend_job_lease(running_id, "worker-a", 30) == {
+                "status": "cancelled", "cancel_reason": "superseded",
+            }
+            assert await db.complete_analysis_job(running_id, "worker-a", True)
+            assert (await job(running_id))["status"] == "cancelled"
+            assert await free_trades(4) == 2
+    asyncio.run(scenario())
+
+
+class FakeBot:
+    """Bot API воркера: записує надіслані повідомлення"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def delete_message(self, chat_id, message_id):
+        pass
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        pass
+
+
+def analysis_result(prompt_version: str = "baseline") -> AnalysisResult:
+    result = AnalysisResult("<b>аналіз</b>", "gpt-4o", prompt_tokens=1000, cached_tokens=500,
+                            completion_tokens=200, latency=2.0, prompt_version=prompt_version)
+    result.upload_time = 0.5
+    result.queue_time = 1.0
+    result.route = Route("degraded", "gpt-4o", 600, reason="queue")
+    return result
+
+
+def test_worker_completes_jobs_and_dead_letters_failures(db_pool, monkeypatch):
+    async def analyse_and_reply(message, image_files, processing_message, subscribed, refund):
+        assert image_files[0].file_unique_id == PHOTO["file_unique_id"]
+        if message.chat.id == 666:
+            raise RuntimeError("OpenAI недоступний")
+        await asyncio.sleep(0.05)
+        return False, analysis_result()
+
+    monkeypatch.setattr(worker, "analyse_and_reply", analyse_and_reply)
+
+    async def scenario():
+        async with db_pool(min_size=2, max_size=6):
+            await create_user(5)
+            ids = [await enqueue(5) for _ in range(8)]
+            failing_id = await enqueue(5, chat_id=666, max_attempts=2)
+
+            bot = FakeBot()
+            analysis_worker = worker.AnalysisWorker(bot, concurrency=3, lease_seconds=30, retry_delay=0, poll_interval=0.05)
+            run = asyncio.create_task(analysis_worker.run())
+            for _ in range(100):
+                if analysis_worker.completed == len(ids) and analysis_worker.dead == 1:
+                    break
+                await asyncio.sleep(0.05)
+            analysis_worker.shutdown()
+            await run
+            await analysis_worker.stop()
+
+            assert analysis_worker.completed == len(ids)
+            assert analysis_worker.retried == 1 and analysis_worker.dead == 1
+            assert [(await job(job_id))["status"] for job_id in ids] == ["done"] * len(ids)
+            assert (await job(failing_id))["status"] == "dead"
+            assert bot.sent == [(666, ANALYSIS_ERROR_MESSAGE)]
+    asyncio.run(scenario())
+
+
+def test_worker_metrics_feed_bot_rollups(db_pool, monkeypatch):
+    """Метрики аналізів воркера бот бачить через рядки analysis_jobs"""
+    versions = iter(["baseline", "baseline", "candidate"])
+
+    async def analyse_and_reply(message, image_files, processing_message, subscribed, refund):
+        if message.chat.id == 777:
+            result = AnalysisResult("кешований аналіз", "cache")
+            result.route = Route("subscriber", "gpt-4o", 1500)
+            return False, result
+        return False, analysis_result(next(versions))
+
+    monkeypatch.setattr(worker, "analyse_and_reply", analyse_and_reply)
+
+    async def scenario():
+        async with db_pool():
+            await create_user(6)
+            ids = [await enqueue(6) for _ in range(3)] + [await enqueue(6, chat_id=777)]
+            assert await db.count_queued_analysis_jobs() == 4
+
+            analysis_worker = worker.AnalysisWorker(FakeBot(), concurrency=2, lease_seconds=30, retry_delay=0, poll_interval=0.05)
+            run = asyncio.create_task(analysis_worker.run())
+            for _ in range(100):
+                if analysis_worker.completed == len(ids):
+                    break
+                await asyncio.sleep(0.05)
+            analysis_worker.shutdown()
+            await run
+            await analysis_worker.stop()
+            assert await db.count_queued_analysis_jobs() == 0
+
+            stats, cost = await db.get_analysis_job_metrics(7)
+            one = request_cost("gpt-4o", 1000, 500, 200)
+            assert stats["outcomes"] == {"ok": 3, "cache": 1}
+            assert stats["models"] == {"gpt-4o": 3}
+            assert stats["routes"] == {"degraded:gpt-4o": 3, "subscriber:gpt-4o": 1}
+            assert stats["route_reasons"] == {"queue": 3}
+            assert stats["prompt_tokens"] == 3000 and stats["cached_ratio"] == 0.5
+            assert stats["stages"]["generation"][0] == 1.5
+            assert stats["stages"]["total"][0] == 3.0
+            assert set(stats["prompt_versions"]) == {"baseline", "candidate"}
+            baseline = stats["prompt_versions"]["baseline"]
+            assert baseline["requests"] == 2 and abs(baseline["cost"] - one) < 1e-9
+            assert baseline["latency"][0] == 2.0
+            assert cost["today_requests"] == 3 and abs(cost["today"] - 3 * one) < 1e-9
+            assert [user for user, _ in cost["top_users"]] == [6]
+    asyncio.run(scenario())
+
+
+def test_queue_backend_routes_by_pending_jobs(db_pool, monkeypatch):
+    monkeypatch.setattr(trade_handlers, "ANALYSIS_BACKEND", "queue")
+
+    async def scenario():
+        async with db_pool():
+            await create_user(7)
+            for _ in range(5):
+                await enqueue(7)
+            queue_depth, _ = await trade_handlers.routing_load()
+            assert queue_depth == 5
+    asyncio.run(scenario())
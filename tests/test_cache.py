@@ -0,0 +1,133 @@
+"""
+Кеш аналізів (bot.cache.AnalysisCache): результати різних варіантів запиту
+(маршрут і модель, версія промптів, формат відповіді) зберігаються окремо,
+а близькі хеші шукаються через індекс смуг.
+"""
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+from bot.ai import Route
+from bot.cache import AnalysisCache
+from bot.handlers import trade_handlers
+from bot.handlers.trade_handlers import cache_variant
+from bot.media import perceptual_hash, HASH_BITS
+from bot.prompts import prompt_registry
+
+TRIAL = cache_variant(Route("trial", "gpt-4o-mini", 600))
+SUBSCRIBER = cache_variant(Route("subscriber", "gpt-4o", 1500))
+
+
+def make_cache(max_distance: int = 4) -> AnalysisCache:
+    return AnalysisCache(ttl=60, max_bytes=1 << 20, max_distance=max_distance, hit_uses_free_trade=False)
+
+
+def chart(seed: int) -> Image.Image:
+    """Свічковий графік з однаковим шаблоном біржі; свічки залежать від seed"""
+    candles = random.Random(seed)
+    width, height = 1280, 720
+    image = Image.new("RGB", (width, height), (19, 23, 34))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width, 40), fill=(30, 34, 45))
+    draw.text((10, 12), "BTCUSDT Perpetual 4h", fill=(220, 220, 220))
+    for x in range(0, width - 80, 80):
+        draw.line((x, 40, x, height - 30), fill=(35, 40, 52))
+    for y in range(40, height - 30, 60):
+        draw.line((0, y, width - 80, y), fill=(35, 40, 52))
+    draw.rectangle((width - 80, 40, width, height), fill=(25, 29, 40))
+    price = 400
+    for index in range(120):
+        close = price + candles.gauss(0, 12)
+        high = max(price, close) + abs(candles.gauss(0, 6))
+        low = min(price, close) - abs(candles.gauss(0, 6))
+        x = 10 + index * 10
+        color = (38, 166, 154) if close < price else (239, 83, 80)
+        draw.line((x + 3, high, x + 3, low), fill=color)
+        draw.rectangle((x, min(price, close), x + 6, max(price, close) + 1), fill=color)
+        price = min(max(close, 80), height - 80)
+    return image
+
+
+def encode(image: Image.Image, format: str = "PNG", **params) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format, **params)
+    return output.getvalue()
+
+
+def test_variants_do_not_share_entries():
+    cache = make_cache()
+    cache.put(0b1010, "file", "пробний аналіз", user_id=1, variant=TRIAL)
+
+    assert cache.get_by_file_id("file", SUBSCRIBER) is None
+    # Ні точний, ні близький хеш не віддає запис іншого варіанта
+    assert cache.get_by_hash(0b1010, "file", SUBSCRIBER) is None
+    assert cache.get_by_hash(0b1011, "file", SUBSCRIBER) is None
+
+    cache.put(0b1010, "file", "повний аналіз", user_id=2, variant=SUBSCRIBER)
+    assert cache.get_by_file_id("file", TRIAL).result == "пробний аналіз"
+    assert cache.get_by_file_id("file", SUBSCRIBER).result == "повний аналіз"
+    assert cache.get_by_hash(0b1011, None, TRIAL).result == "пробний аналіз"
+    assert cache.stats()["entries"] == 2
+
+
+def test_eviction_keeps_other_variant_index():
+    cache = make_cache()
+    cache.put(1, "file", "a", user_id=1, variant=TRIAL)
+    cache.put(1, "file", "b", user_id=1, variant=SUBSCRIBER)
+    # Перезапис одного варіанта не скидає індекс file_id іншого
+    cache.put(1, "file", "c", user_id=1, variant=TRIAL)
+    assert cache.get_by_file_id("file", SUBSCRIBER).result == "b"
+    assert cache.get_by_file_id("file", TRIAL).result == "c"
+
+
+def test_route_model_is_part_of_variant():
+    assert cache_variant(Route("subscriber", "gpt-4o", 1500)) != cache_variant(Route("subscriber", "gpt-4.1", 1500))
+
+
+def test_prompt_version_and_output_mode_split_cache(monkeypatch):
+    route = Route("subscriber", "gpt-4o", 1500)
+    baseline = prompt_registry.get()
+    candidate = baseline.derive("candidate", {"system": "інший системний промпт"})
+    cache = make_cache()
+    cache.put(7, "file", "відповідь baseline", user_id=1, variant=cache_variant(route, baseline))
+
+    # Нова версія промптів (A/B) не отримує відповідь старої ні за file_id, ні за хешем
+    assert cache.get_by_file_id("file", cache_variant(route, candidate)) is None
+    assert cache.get_by_hash(7, "file", cache_variant(route, candidate)) is None
+    assert cache.get_by_file_id("file", cache_variant(route, baseline)).result == "відповідь baseline"
+
+    # Перемикання ANALYSIS_OUTPUT_MODE теж змінює варіант
+    html_variant = cache_variant(route, baseline)
+    monkeypatch.setattr(trade_handlers, "ANALYSIS_OUTPUT_MODE", "structured")
+    assert cache_variant(route, baseline) != html_variant
+    assert cache.get_by_file_id("file", cache_variant(route, baseline)) is None
+
+
+def test_band_index_finds_every_hash_within_distance():
+    cache = make_cache(max_distance=2)
+    stored = random.Random(1).getrandbits(HASH_BITS)
+    cache.put(stored, "file", "аналіз", user_id=1, variant=TRIAL)
+
+    # Два змінені біти в одній смузі чи в різних - запис знаходиться
+    for first, second in ((0, 1), (0, HASH_BITS - 1), (HASH_BITS // 2, HASH_BITS // 2 + 1)):
+        assert cache.get_by_hash(stored ^ (1 << first) ^ (1 << second), None, TRIAL).result == "аналіз"
+    assert cache.get_by_hash(stored ^ 0b111, None, TRIAL) is None
+
+    # Витіснений запис зникає з індексу смуг
+    cache._remove((TRIAL, stored))
+    assert cache._bands == {} and cache.get_by_hash(stored ^ 1, None, TRIAL) is None
+
+
+def test_same_template_charts_do_not_collide():
+    cache = make_cache(max_distance=2)
+    first = chart(seed=1)
+    cache.put(perceptual_hash(encode(first)), "first", "аналіз першого графіка", user_id=1, variant=TRIAL)
+
+    # Перестиснена копія того ж графіка - влучання
+    copy = perceptual_hash(encode(first, "JPEG", quality=90))
+    assert cache.get_by_hash(copy, "copy", TRIAL).result == "аналіз першого графіка"
+
+    # Той самий шаблон біржі, інші свічки - промах, чужий аналіз не віддається
+    for seed in range(2, 12):
+        assert cache.get_by_hash(perceptual_hash(encode(chart(seed))), f"other{seed}", TRIAL) is None
@@ -0,0 +1,166 @@
+"""
+Інтеграційні тести db.queries на тимчасовому PostgreSQL (фікстура db_pool у conftest.py).
+"""
+import asyncio
+import json
+from datetime import timedelta
+
+from bot.ai import AnalysisResult
+from bot.history import HistoryWriter
+from db import queries as db
+from db.cache import user_cache, utc_now
+from db.notify import InvalidationListener, INVALIDATION_CHANNEL, USER_EVENT
+
+
+async def create_user(user_id: int, free_trades_left: int = 0, is_subscribed: bool = False, expires_at=None):
+    await db.add_user(user_id, f"user{user_id}", "Тест")
+    async with db.acquire("test") as conn:
+        await conn.execute(
+            """
+            UPDATE users SET free_trades_left = $2, is_subscribed = $3, subscription_expires_at = $4
+            WHERE user_id = $1
+            """,
+            user_id, free_trades_left, is_subscribed, expires_at,
+        )
+    user_cache.invalidate(user_id)
+
+
+def test_parallel_reserves_cannot_overspend(db_pool):
+    async def scenario():
+        async with db_pool(min_size=10, max_size=10):
+            await create_user(1, free_trades_left=3)
+            results = await asyncio.gather(*(db.reserve_analysis(1) for _ in range(30)))
+
+            statuses = [result["status"] for result in results]
+            assert statuses.count("reserved") == 3
+            assert statuses.count("no_trades") == 27
+            assert sorted(result["free_trades_left"] for result in results if result["status"] == "reserved") == [0, 1, 2]
+
+            user_cache.clear()
+            assert (await db.get_user(1))["free_trades_left"] == 0
+
+            # Повернені спроби знову доступні рівно один раз
+            await asyncio.gather(db.refund_free_trade(1), db.refund_free_trade(1))
+            results = await asyncio.gather(*(db.reserve_analysis(1) for _ in range(10)))
+            assert [result["status"] for result in results].count("reserved") == 2
+    asyncio.run(scenario())
+
+
+def test_subscription_rule_agrees_everywhere(db_pool):
+    async def scenario():
+        async with db_pool():
+            now = utc_now()
+            cases = {
+                # user_id: (is_subscribed, subscription_expires_at, активна)
+                10: (True, None, True),
+                11: (True, now + timedelta(days=3), True),
+                12: (True, now - timedelta(minutes=1), False),
+                13: (False, now + timedelta(days=3), False),
+            }
+            for user_id, (is_subscribed, expires_at, _) in cases.items():
+                await create_user(user_id, is_subscribed=is_subscribed, expires_at=expires_at)
+
+            for user_id, (is_subscribed, _, active) in cases.items():
+                user_cache.clear()
+                assert (await db.get_user(user_id)).subscription_active is active
+                # Перевірка в БД (кеш порожній) і в кеші (щойно прочитаний рядок)
+                user_cache.clear()
+                expected = "subscribed" if active else ("expired" if is_subscribed else "no_trades")
+                assert (await db.reserve_analysis(user_id))["status"] == expected
+                await db.get_user(user_id)
+                assert (await db.reserve_analysis(user_id))["status"] == expected
+
+            stats = await db.get_bot_stats()
+            assert stats["active_subscriptions"] == sum(active for _, _, active in cases.values())
+    asyncio.run(scenario())
+
+
+def test_history_writer_batches_into_postgres(db_pool):
+    async def scenario():
+        async with db_pool():
+            writer = HistoryWriter(batch_size=3, flush_interval=0.05, queue_limit=100)
+            await writer.start()
+            for index in range(7):
+                result = AnalysisResult(f"<b>аналіз {index}</b>", "gpt-test", prompt_tokens=10, latency=1.5)
+                writer.record(20, f"file{index}", result)
+            writer.record(20, "file-structured", AnalysisResult("", "gpt-test", fields={"instrument": "BTC/USDT"}))
+            writer.record(21, "other", AnalysisResult("інший користувач", "gpt-test"))
+            await asyncio.sleep(0.3)
+            await writer.stop()
+
+            assert writer.written == 9 and writer.dropped == 0
+            assert writer.batches >= 3
+            rows = await db.get_user_analyses(20, limit=100)
+            assert [row["file_unique_id"] for row in rows] == ["file-structured"] + [f"file{i}" for i in range(6, -1, -1)]
+            # Структурована відповідь зберігається полями, HTML - текстом
+            assert rows[0]["result_text"] is None
+            assert json.loads(rows[0]["result_fields"]) == {"instrument": "BTC/USDT"}
+            assert rows[1]["result_text"] == "<b>аналіз 6</b>" and rows[1]["latency_ms"] == 1500
+    asyncio.run(scenario())
+
+
+def test_history_keyset_pagination(db_pool):
+    async def scenario():
+        async with db_pool():
+            base = utc_now().replace(microsecond=0)
+            # Частина записів з однаковим created_at - порядок визначає id
+            times = [base, base, base + timedelta(seconds=1), base + timedelta(seconds=1),
+                     base + timedelta(seconds=1), base + timedelta(seconds=2), base + timedelta(seconds=3)]
+            await db.add_analyses([
+                (30, f"file{index}", "gpt-test", 0, 0, 0, 100, f"text{index}", None, created_at)
+                for index, created_at in enumerate(times)
+            ] + [(31, "other", "gpt-test", 0, 0, 0, 100, "other", None, base)])
+
+            expected = [f"file{index}" for index in range(6, -1, -1)]
+
+            # Від найновіших до найстаріших сторінками по 3
+            pages, cursor = [], None
+            while True:
+                page = await db.get_user_analyses(30, cursor, limit=3)
+                if not page:
+                    break
+                pages.append([row["file_unique_id"] for row in page])
+                cursor = (page[-1]["created_at"], page[-1]["id"])
+            assert pages == [expected[0:3], expected[3:6], expected[6:7]]
+
+            # Назад до новіших від найстарішого запису; сторінка теж від новіших до старіших
+            oldest = await db.get_user_analyses(30, cursor, newer=True, limit=1)
+            assert [row["file_unique_id"] for row in oldest] == ["file1"]
+            newer = await db.get_user_analyses(30, (oldest[0]["created_at"], oldest[0]["id"]), newer=True, limit=3)
+            assert [row["file_unique_id"] for row in newer] == ["file4", "file3", "file2"]
+    asyncio.run(scenario())
+
+
+def test_reserve_and_refund_notify_other_processes(db_pool, database):
+    async def scenario():
+        async with db_pool():
+            await create_user(40, free_trades_left=1)
+            # Слухач "іншого процесу" з власним підключенням
+            events = []
+            listener = InvalidationListener(database, INVALIDATION_CHANNEL, check_interval=5, max_backoff=1)
+            listener.on(USER_EVENT, events.append)
+            await listener.start()
+            try:
+                for _ in range(50):
+                    if listener.connected:
+                        break
+                    await asyncio.sleep(0.05)
+
+                async def next_events(count: int):
+                    for _ in range(40):
+                        if len(events) >= count:
+                            break
+                        await asyncio.sleep(0.05)
+                    return list(events)
+
+                assert (await db.reserve_analysis(40))["status"] == "reserved"
+                assert await next_events(1) == ["40"]
+                # Спроб немає - нічого не змінилось, подія не надсилається
+                assert (await db.reserve_analysis(40))["status"] == "no_trades"
+                await db.refund_free_trade(40)
+                assert await next_events(2) == ["40", "40"]
+                await asyncio.sleep(0.2)
+                assert len(events) == 2 and listener.malformed == 0
+            finally:
+                await listener.stop()
+    asyncio.run(scenario())
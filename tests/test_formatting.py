@@ -0,0 +1,121 @@
+"""
+Санітайзер Telegram HTML (bot.formatting.sanitize_html): фаз-тест на випадкових
+фрагментах розмітки та явні випадки з відповідей моделі.
+Вихід має містити лише теги й атрибути, які приймає Telegram, бути збалансованим,
+без голих "<", ">" і "&", та не змінюватись при повторній обробці.
+"""
+import random
+import re
+import time
+
+import pytest
+
+from bot.formatting import sanitize_html, html_to_entities, close_html_prefix
+
+# Відкриваючі теги, які приймає Telegram (у канонічному вигляді, який видає санітайзер)
+TELEGRAM_OPEN_TAG_RE = re.compile(
+    r'<(?:b|i|u|s|tg-spoiler|code|pre|blockquote)>'
+    r'|<blockquote expandable>'
+    r'|<span class="tg-spoiler">'
+    r'|<a href="[^"<>]*">'
+    r'|<code class="language-[\w+#-]+">'
+)
+TAG_RE = re.compile(r'<(/?)([a-z-]+)[^<>]*>')
+ENTITY_RE = re.compile(r'&(?:lt|gt|amp|quot|#[0-9]{1,7}|#[xX][0-9a-fA-F]{1,6});')
+
+# Фрагменти для фаз-тесту: дозволені й невідомі теги, аліаси, атрибути, сутності,
+# незакриті та зламані теги, які трапляються у відповідях моделі
+FRAGMENTS = (
+    "<b>", "</b>", "<i>", "</i>", "<u>", "</u>", "<s>", "</s>",
+    "<strong>", "</strong>", "<em>", "</em>", "<del>", "</del>", "<ins>", "</ins>",
+    "<code>", "</code>", "<pre>", "</pre>", "<pre><code class='language-python'>", "<code class=\"x\">",
+    "<blockquote>", "<blockquote expandable>", "</blockquote>",
+    "<a href='https://t.me/x?a=1&b=2'>", "<a>", "<a href=\"\">", "</a>",
+    "<span class=\"tg-spoiler\">", "<span>", "</span>", "<tg-spoiler>", "</tg-spoiler>",
+    "<div>", "</div>", "<p>", "<script>", "</script>", "<img src=x onerror=y>", "<br>", "<br/>",
+    "</b</b>", "</b></b>", "<b ", "<", ">", "</", "<>", "< b>", "<1>",
+    "&", "&amp;", "&lt;", "&gt;", "&quot;", "&#128200;", "&#x1F4C8;", "&nbsp;", "&unknown;", "&#;",
+    "61 000", "BTC/USDT", "📊 ", "🟢", " ", "\n", "текст ", "RSI < 30",
+)
+
+
+def assert_telegram_html(text: str):
+    """Розмітка, яку Telegram прийме без помилки розбору"""
+    stack = []
+    for match in TAG_RE.finditer(text):
+        is_closing, name = match.groups()
+        if is_closing:
+            assert stack and stack[-1] == name, f"незбалансований </{name}> у {text!r}"
+            stack.pop()
+            continue
+        assert TELEGRAM_OPEN_TAG_RE.fullmatch(match.group()), f"недозволений тег {match.group()!r}"
+        if stack and stack[-1] in ("code", "pre"):
+            assert stack[-1] == "pre" and name == "code", f"розмітка всередині {stack[-1]}: {text!r}"
+        stack.append(name)
+    assert not stack, f"незакриті теги {stack} у {text!r}"
+
+    rest = ENTITY_RE.sub("", TAG_RE.sub("", text))
+    assert not set(rest) & set("<>&"), f"неекранований спецсимвол у {text!r}"
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_fuzz_output_is_valid_telegram_html(seed):
+    rng = random.Random(seed)
+    for _ in range(5000):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 40)))
+        sanitized = sanitize_html(text)
+        assert_telegram_html(sanitized)
+        assert sanitize_html(sanitized) == sanitized
+        # Обрізаний на довільному місці текст (попередній перегляд стріму) теж валідний
+        assert_telegram_html(close_html_prefix(text[:rng.randint(0, len(text))]))
+
+        plain, entities = html_to_entities(sanitized)
+        for entity in entities:
+            assert entity["length"] > 0
+            assert entity["offset"] + entity["length"] <= len(plain.encode("utf-16-le")) // 2
+
+
+@pytest.mark.parametrize("text, expected", [
+    # Перехресне вкладення: внутрішній тег закривається й відкривається знову
+    ("<b><i>x</b>y</i>", "<b><i>x</i></b><i>y</i>"),
+    # Невідомі теги прибираються, текст лишається
+    ("<div><p>x</p></div><script>y</script>", "xy"),
+    # Аліаси зводяться до канонічних тегів
+    ("<strong>a</strong><em>b</em><del>c</del>", "<b>a</b><i>b</i><s>c</s>"),
+    # Незакриті теги закриваються в кінці, зайві закриваючі відкидаються
+    ("<b>x<code>1", "<b>x<code>1</code></b>"),
+    ("x</b></i>", "x"),
+    # Зламані теги з відповідей моделі
+    ("<b>Вхід:</b</b> <code>61 000</code>", "<b>Вхід:</b> <code>61 000</code>"),
+    ("<b>Вхід:</b <code>61 000</code>", "<b>Вхід: <code>61 000</code></b>"),
+    ("<b>a</b></b>", "<b>a</b>"),
+    # Сутності Telegram лишаються, решта "&" та голі "<" ">" екрануються
+    ("a &amp; b & c &nbsp; &#128200;", "a &amp; b &amp; c &amp;nbsp; &#128200;"),
+    ("RSI < 30 > 20", "RSI &lt; 30 &gt; 20"),
+    # Атрибути: лише дозволені та в канонічному вигляді
+    ("<a href='https://x.y/?a=1&b=2'>l</a>", '<a href="https://x.y/?a=1&amp;b=2">l</a>'),
+    ("<a>l</a><span>s</span>", "ls"),
+    ("<blockquote expandable class='x'>q</blockquote>", "<blockquote expandable>q</blockquote>"),
+    ("<pre><code class=\"language-python\">x</code></pre>", '<pre><code class="language-python">x</code></pre>'),
+    # У code розмітка не допускається
+    ("<code><b>x</b></code>", "<code>x</code>"),
+    # Порожні елементи прибираються, <br> стає переносом рядка
+    ("<b></b>a<br>b", "a\nb"),
+])
+def test_known_cases(text, expected):
+    assert sanitize_html(text) == expected
+    assert_telegram_html(expected)
+
+
+@pytest.mark.parametrize("text", [
+    "<" * 200_000,
+    "<b " * 100_000,
+    "&" * 200_000,
+    "<b>" * 50_000,
+    "<b>" * 3000 + "<i>" * 3000 + "</b>" * 3000,
+])
+def test_adversarial_input_is_linear(text):
+    started = time.perf_counter()
+    sanitized = sanitize_html(text)
+    assert time.perf_counter() - started < 2
+    assert_telegram_html(sanitized)
@@ -0,0 +1,57 @@
+"""
+Облік пам'яті на зображення (bot.media): резерв на повну місткість буфера з пулу,
+пул, обмежений байтами, та оцінка декодування за заголовком.
+"""
+import io
+
+import pytest
+from PIL import Image
+
+from bot import media
+from bot.media import BufferPool, ImageTooLarge, buffer_capacity, estimate_decode_memory, estimate_peak_memory
+
+
+def png(width: int, height: int, mode: str = "RGB") -> bytes:
+    output = io.BytesIO()
+    Image.new(mode, (width, height)).save(output, "PNG")
+    return output.getvalue()
+
+
+def test_peak_memory_reserves_rounded_buffer():
+    size = 10 * 2 ** 20
+    assert buffer_capacity(size) == 16 * 2 ** 20
+    assert len(BufferPool(0).acquire(size)) == buffer_capacity(size)
+    assert estimate_peak_memory(size) - estimate_peak_memory(size, pooled=False) == 6 * 2 ** 20
+
+
+def test_pool_is_bounded_by_bytes():
+    pool = BufferPool(max_bytes=3 * 2 ** 20)
+    buffers = [pool.acquire(2 ** 20) for _ in range(4)]
+    for buffer in buffers:
+        pool.release(buffer)
+    assert pool.retained == 3 * 2 ** 20
+    # Буфер, що не вміщується в ліміт пулу, не зберігається
+    pool.release(pool.acquire(4 * 2 ** 20))
+    assert pool.retained == 3 * 2 ** 20
+    pool.acquire(2 ** 20)
+    assert pool.retained == 2 * 2 ** 20 and pool.reused == 1
+
+
+def test_decode_estimate_from_header():
+    data = png(2000, 1000)
+    # Декодований RGB, копія RGB, фон і різниця для обрізки полів - по 4 байти на піксель
+    assert estimate_decode_memory(data, 4096, crop_borders=True) == 2000 * 1000 * 4 * 4
+    assert estimate_decode_memory(data, 4096, crop_borders=False) == 2000 * 1000 * 4 * 2
+
+
+def test_decode_estimate_accounts_for_jpeg_draft():
+    output = io.BytesIO()
+    Image.new("RGB", (4000, 3000)).save(output, "JPEG")
+    # JPEG декодується одразу зменшеним (у 2, 4 чи 8 разів, не менше за max_side)
+    assert estimate_decode_memory(output.getvalue(), 1000, crop_borders=False) == 2000 * 1500 * 4 * 2
+
+
+def test_pixel_cap_rejects_decompression_bombs(monkeypatch):
+    monkeypatch.setattr(media, "IMAGE_MAX_PIXELS", 1000 * 1000)
+    with pytest.raises(ImageTooLarge):
+        estimate_decode_memory(png(1001, 1000, "L"), 1024, crop_borders=True)
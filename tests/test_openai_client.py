@@ -0,0 +1,210 @@
+"""
+ResilientOpenAI (bot.openai_client) проти фейкового OpenAI-сервера на aiohttp:
+повтори, Retry-After, запобіжник, резервна модель, дублювання потоків та
+дедлайн на читання потоку в complete_html.
+"""
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+from bot import ai
+from bot.ai import Route, OVERLOADED_MESSAGE
+from bot.openai_client import ResilientOpenAI, CircuitOpen
+from bot.prompts import prompt_registry
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+def completion(model: str) -> dict:
+    return {
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"ok {model}"}}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def chunk(model: str, content: str) -> bytes:
+    data = {
+        "id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": model,
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+    }
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+class FakeOpenAI:
+    """
+    Сервер /v1/chat/completions, що відповідає за сценарієм: кожен запит
+    забирає наступну дію ("ok", "500", "503", "429:<мс>", "slow:<с>",
+    "stream", "stream-slow:<с>", "stream-stall"); без сценарію - "ok".
+    """
+
+    def __init__(self, script=()):
+        self.script = list(script)
+        self.calls = []
+        self.closed_streams = 0
+        self._runner = None
+        self.url = None
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/v1"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._runner.cleanup()
+
+    async def handle(self, request):
+        body = await request.json()
+        model = body["model"]
+        self.calls.append(model)
+        action = self.script.pop(0) if self.script else "ok"
+        name, _, arg = action.partition(":")
+        if name in ("500", "503"):
+            return web.json_response({"error": {"message": "boom"}}, status=int(name))
+        if name == "429":
+            return web.json_response({"error": {"message": "rate"}}, status=429, headers={"retry-after-ms": arg})
+        if name == "slow":
+            await asyncio.sleep(float(arg))
+            return web.json_response(completion(model))
+        if name.startswith("stream"):
+            if name == "stream-slow":
+                await asyncio.sleep(float(arg))
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            try:
+                await response.write(chunk(model, "<b>part</b>"))
+                if name == "stream-stall":
+                    # Коментарі SSE клієнт пропускає; запис у закрите з'єднання падає
+                    for _ in range(300):
+                        await asyncio.sleep(0.1)
+                        await response.write(b": ping\n\n")
+                await response.write(b"data: [DONE]\n\n")
+            except (asyncio.CancelledError, ConnectionResetError):
+                self.closed_streams += 1
+                raise
+            return response
+        return web.json_response(completion(model))
+
+
+def make_client(url: str, **overrides) -> ResilientOpenAI:
+    options = dict(
+        model="primary", fallback_model="fallback", deadline=5, attempt_timeout=2, max_retries=2,
+        backoff_base=0.01, backoff_max=5, breaker_threshold=3, breaker_cooldown=60,
+        hedge_percentile=0.9, hedge_min_samples=3, api_key="test", base_url=url,
+    )
+    options.update(overrides)
+    return ResilientOpenAI(**options)
+
+
+def test_retries_server_errors():
+    async def scenario():
+        async with FakeOpenAI(["500", "500", "ok"]) as server:
+            client = make_client(server.url)
+            response = await client.create(messages=MESSAGES)
+            assert response.choices[0].message.content == "ok primary"
+            assert server.calls == ["primary"] * 3
+            assert client.retries == 2 and client.fallbacks == 0
+    asyncio.run(scenario())
+
+
+def test_retry_after_header_sets_delay():
+    async def scenario():
+        async with FakeOpenAI(["429:400", "ok"]) as server:
+            # Власна затримка (<= 0.02с) значно менша за вказану сервером
+            client = make_client(server.url)
+            started = time.monotonic()
+            await client.create(messages=MESSAGES)
+            assert time.monotonic() - started >= 0.4
+            assert client.retries == 1
+    asyncio.run(scenario())
+
+
+def test_breaker_opens_and_fallback_serves():
+    async def scenario():
+        async with FakeOpenAI(["503", "503", "503"]) as server:
+            client = make_client(server.url)
+            response = await client.create(messages=MESSAGES)
+            # Основна модель вичерпала повтори - відповідає резервна
+            assert response.model == "fallback"
+            assert server.calls == ["primary"] * 3 + ["fallback"]
+            assert client.fallbacks == 1
+            assert client.breaker("primary").state == "open"
+
+            # Запобіжник відкритий: основна модель не викликається взагалі
+            server.calls.clear()
+            response = await client.create(messages=MESSAGES)
+            assert response.model == "fallback"
+            assert server.calls == ["fallback"]
+            assert client.rejected == 1
+
+            stats = client.stats()
+            assert stats["models"]["primary"]["breaker"] == "open"
+            assert stats["models"]["fallback"]["breaker"] == "closed"
+    asyncio.run(scenario())
+
+
+def test_all_models_unavailable_raise_circuit_open():
+    async def scenario():
+        async with FakeOpenAI(["503"] * 6) as server:
+            client = make_client(server.url, max_retries=2)
+            try:
+                await client.create(messages=MESSAGES)
+            except Exception:
+                pass
+            server.calls.clear()
+            try:
+                await client.create(messages=MESSAGES)
+                raise AssertionError("очікувався CircuitOpen")
+            except CircuitOpen:
+                pass
+            assert server.calls == []
+    asyncio.run(scenario())
+
+
+def test_stream_is_hedged_and_loser_closed():
+    async def scenario():
+        async with FakeOpenAI(["stream"] * 3 + ["stream-slow:1.5", "stream"]) as server:
+            client = make_client(server.url)
+            for _ in range(3):
+                stream = await client.create(messages=MESSAGES, stream=True)
+                await stream.close()
+            assert client.stats()["models"]["primary"]["stream_hedge_delay"] > 0
+
+            started = time.monotonic()
+            stream = await client.create(messages=MESSAGES, stream=True)
+            await stream.close()
+            assert time.monotonic() - started < 1.0
+            assert client.hedges == 1 and client.hedge_wins == 1
+    asyncio.run(scenario())
+
+
+def test_stream_consumption_is_bounded_by_deadline(monkeypatch):
+    async def scenario():
+        async with FakeOpenAI(["stream-stall"]) as server:
+            client = make_client(server.url, deadline=1)
+            monkeypatch.setattr(ai, "openai_client", client)
+            received = []
+
+            async def on_text(text):
+                received.append(text)
+
+            started = time.monotonic()
+            result = await ai.complete_html(MESSAGES, prompt_registry.get(), Route("subscriber", "primary", 100), on_text)
+            assert time.monotonic() - started < 2
+            assert result.text == OVERLOADED_MESSAGE
+            assert received == ["<b>part</b>"]
+            assert client.stream_timeouts == 1
+            for _ in range(20):
+                if server.closed_streams:
+                    break
+                await asyncio.sleep(0.1)
+            assert server.closed_streams == 1
+    asyncio.run(scenario())
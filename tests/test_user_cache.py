@@ -0,0 +1,59 @@
+"""
+Кеш користувачів (db.cache.UserCache): рядок, прочитаний до зміни свого
+користувача, не кешується, а зміни інших користувачів йому не заважають.
+"""
+from db.cache import UserCache, USER_FIELDS
+
+
+def row(user_id: int, free_trades_left: int = 3) -> dict:
+    values = dict.fromkeys(USER_FIELDS)
+    values.update(user_id=user_id, free_trades_left=free_trades_left, is_subscribed=False)
+    return values
+
+
+def test_unrelated_changes_do_not_drop_put():
+    cache = UserCache(ttl=60, max_size=100)
+    generation = cache.generation
+    # Поки йде запит для користувача 1, змінюються інші
+    cache.invalidate(2)
+    cache.update(3, free_trades_left=0)
+    cache.put(row(1), generation)
+    assert cache.get(1) is not None
+
+
+def test_change_during_read_drops_put():
+    cache = UserCache(ttl=60, max_size=100)
+    generation = cache.generation
+    cache.invalidate(1)
+    assert cache.put(row(1), generation).user_id == 1
+    assert cache.get(1) is None
+
+    generation = cache.generation
+    cache.update(1, free_trades_left=2)
+    cache.put(row(1), generation)
+    assert cache.get(1) is None
+
+    # Читання після зміни кешується
+    cache.put(row(1, 2), cache.generation)
+    assert cache.get(1).free_trades_left == 2
+
+
+def test_clear_drops_reads_in_flight():
+    cache = UserCache(ttl=60, max_size=100)
+    generation = cache.generation
+    cache.clear()
+    cache.put(row(1), generation)
+    assert cache.get(1) is None
+
+
+def test_forgotten_changes_are_conservative():
+    cache = UserCache(ttl=60, max_size=2)
+    generation = cache.generation
+    cache.invalidate(1)
+    # Зміна користувача 1 витіснена з пам'яті змін - старе читання не кешується
+    cache.invalidate(2)
+    cache.invalidate(3)
+    cache.put(row(1), generation)
+    assert cache.get(1) is None
+    cache.put(row(1), cache.generation)
+    assert cache.get(1) is not None
@@ -0,0 +1,260 @@
+"""
+Воркер черги аналізів (ANALYSIS_BACKEND=queue): забирає задачі з таблиці analysis_jobs,
+аналізує графіки та надсилає відповідь через Bot API. Процесів можна запускати скільки завгодно:
+    python worker.py
+Кеш аналізів і планувальник у кожного процесу власні. Метрики аналізу (вартість, маршрут,
+версія промптів, час етапів) записуються в рядок задачі - з них бот будує панелі статистики.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import uuid
+from typing import Dict
+
+from aiogram import Bot, types
+
+from config import BOT_TOKEN, WORKER_CONCURRENCY, WORKER_POLL_INTERVAL, JOB_LEASE_SECONDS, JOB_RETRY_DELAY
+from bot.ai import ANALYSIS_ERROR_MESSAGE
+from bot.cancellation import active_analyses, CANCELLED_BY_USER
+from bot.handlers.trade_handlers import analyse_and_reply, image_file_from_payload, cancelled_text
+from bot.history import history_writer
+from bot.metrics import result_metrics
+from bot.scheduler import analysis_scheduler
+from db import queries as db
+from db.notify import invalidation_listener, start_listener
+
+# Встановлюємо рівень логування
+logging.basicConfig(level=logging.INFO)
+
+
+def job_message(job: dict, message_id: int) -> types.Message:
+    """Повідомлення з чату задачі - для відповіді та редагування через Bot API"""
+    return types.Message.to_object({
+        "message_id": message_id,
+        "date": 0,
+        "chat": {"id": job["chat_id"], "type": "private"},
+        "from": {"id": job["user_id"], "is_bot": False, "first_name": ""},
+    })
+
+
+class AnalysisWorker:
+    """
+    Виконує задачі з черги БД, не більше concurrency одночасно.
+    Поки задача виконується, оренда продовжується кожну третину lease_seconds:
+    скасування, записане ботом у задачу, перериває аналіз через active_analyses,
+    а втрата оренди (задачу вже забрав інший воркер) - без відповіді користувачу.
+    Помилка повертає задачу в чергу із затримкою, після max_attempts - у dead letter.
+    """
+
+    def __init__(self, bot: Bot, concurrency: int, lease_seconds: int, retry_delay: int, poll_interval: float):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+        self._jobs: Dict[int, asyncio.Task] = {}
+        self._wakeup: asyncio.Event = None
+        self._stopping = False
+
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+        self.lost = 0
+
+    async def run(self):
+        """Цикл вибору задач до виклику shutdown()"""
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        last_reap = None
+        logging.info(f"Воркер {self.worker_id} запущено (задач одночасно: {self.concurrency})")
+        while not self._stopping:
+            # Покинуті задачі, яких уже ніхто не забере, перевіряються раз на оренду
+            if last_reap is None or loop.time() - last_reap >= self.lease_seconds:
+                last_reap = loop.time()
+                await self._reap()
+
+            free = self.concurrency - len(self._jobs)
+            jobs = []
+            if free > 0:
+                try:
+                    jobs = await db.claim_analysis_jobs(self.worker_id, self.lease_seconds, free)
+                except Exception as e:
+                    logging.error(f"Не вдалося отримати задачі з черги: {e}")
+            for job in jobs:
+                task = asyncio.create_task(self._process(job))
+                self._jobs[job["id"]] = task
+                task.add_done_callback(lambda _, job_id=job["id"]: self._finished(job_id))
+            # Забрали все, що могли - можливо, в черзі є ще
+            if jobs and len(jobs) == free:
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def shutdown(self):
+        """Перестає брати нові задачі (обробник сигналу)"""
+        self._stopping = True
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def stop(self):
+        """Перериває задачі, що виконуються; вони повертаються в чергу без врахування спроби"""
+        self.shutdown()
+        tasks = list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _finished(self, job_id: int):
+        self._jobs.pop(job_id, None)
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _process(self, job: dict):
+        job_id = job["id"]
+        logging.info(f"Задача {job_id}: спроба {job['attempts']} з {job['max_attempts']}")
+        work = asyncio.ensure_future(self._execute(job))
+        heartbeat = asyncio.ensure_future(self._heartbeat(job, work))
+        try:
+            # wait не піднімає CancelledError при скасуванні work - лише при зупинці воркера
+            await asyncio.wait({work})
+        except asyncio.CancelledError:
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+            try:
+                await db.release_analysis_job(job_id, self.worker_id)
+            except Exception as e:
+                logging.warning(f"Задачу {job_id} не повернуто в чергу, її забере інший воркер після оренди: {e}")
+            raise
+        finally:
+            heartbeat.cancel()
+
+        if work.cancelled():
+            # Оренду втрачено - задача вже належить іншому воркеру, відповідати не можна
+            self.lost += 1
+            return
+
+        try:
+            error = work.exception()
+            if error is None:
+                refund, result = work.result()
+                metrics = result_metrics(result) if result else None
+                if await db.complete_analysis_job(job_id, self.worker_id, refund, metrics):
+                    self.completed += 1
+                else:
+                    logging.warning(f"Задача {job_id} завершилась уже після втрати оренди")
+                return
+
+            logging.error(f"Помилка задачі {job_id} (спроба {job['attempts']}): {error!r}")
+            state = await db.fail_analysis_job(job_id, self.worker_id, repr(error), self.retry_delay)
+            if state is None:
+                return
+            if state["status"] == "queued":
+                self.retried += 1
+            elif state["status"] == "dead":
+                self.dead += 1
+                await self._notify_dead(job)
+            elif state["status"] == "cancelled":
+                await self._notify_cancelled(job, state["cancel_reason"])
+        except Exception as e:
+            # Без запису в БД задачу після оренди забере інший воркер
+            logging.error(f"Не вдалося зберегти результат задачі {job_id}: {e}")
+
+    async def _execute(self, job: dict):
+        """Аналіз і відповідь; повертає (чи треба повернути безкоштовну спробу, результат аналізу)"""
+        message = job_message(job, job["message_id"])
+        processing_message = job_message(job, job["processing_message_id"])
+        image_files = [image_file_from_payload(payload) for payload in json.loads(job["files"])]
+        return await analyse_and_reply(message, image_files, processing_message, job["subscribed"], job["refund"])
+
+    async def _heartbeat(self, job: dict, work: asyncio.Future):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                state = await db.extend_job_lease(job["id"], self.worker_id, self.lease_seconds)
+            except Exception as e:
+                logging.warning(f"Не вдалося продовжити оренду задачі {job['id']}: {e}")
+                continue
+            if state is None:
+                logging.warning(f"Задача {job['id']}: оренду втрачено, аналіз перервано")
+                work.cancel()
+                return
+            if state["status"] == "cancelled":
+                active_analyses.cancel(
+                    job["user_id"], job["processing_message_id"], state["cancel_reason"] or CANCELLED_BY_USER
+                )
+
+    async def _reap(self):
+        try:
+            jobs = await db.reap_expired_jobs()
+        except Exception as e:
+            logging.error(f"Не вдалося перевірити покинуті задачі: {e}")
+            return
+        for job in jobs:
+            logging.warning(f"Покинута задача {job['id']} завершена зі статусом {job['status']}")
+            if job["status"] == "dead":
+                self.dead += 1
+                await self._notify_dead(job)
+            else:
+                await self._notify_cancelled(job, job["cancel_reason"])
+
+    async def _notify_dead(self, job: dict):
+        """Задача в dead letter: повідомляємо користувача і прибираємо "Аналізую..." """
+        try:
+            await self.bot.send_message(job["chat_id"], ANALYSIS_ERROR_MESSAGE)
+            await self.bot.delete_message(job["chat_id"], job["processing_message_id"])
+        except Exception as e:
+            logging.warning(f"Не вдалося повідомити про невдалу задачу {job['id']}: {e}")
+
+    async def _notify_cancelled(self, job: dict, reason: str):
+        try:
+            await self.bot.edit_message_text(
+                cancelled_text(reason or CANCELLED_BY_USER, job["refund"]), job["chat_id"], job["processing_message_id"]
+            )
+        except Exception as e:
+            logging.warning(f"Не вдалося оновити повідомлення скасованої задачі {job['id']}: {e}")
+
+
+async def main():
+    bot = Bot(token=BOT_TOKEN, parse_mode=types.ParseMode.HTML)
+    # Повідомлення задач (types.Message) надсилаються через поточного бота
+    Bot.set_current(bot)
+
+    logging.info("Створення підключення до PostgreSQL...")
+    await db.create_pool()
+    await db.migrate()
+    await start_listener()
+    await analysis_scheduler.start()
+    await history_writer.start()
+
+    worker = AnalysisWorker(bot, WORKER_CONCURRENCY, JOB_LEASE_SECONDS, JOB_RETRY_DELAY, WORKER_POLL_INTERVAL)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.shutdown)
+
+    try:
+        await worker.run()
+    finally:
+        await worker.stop()
+        await invalidation_listener.stop()
+        await analysis_scheduler.stop()
+        # Дописуємо історію до закриття пулу
+        await history_writer.stop()
+        await db.close_pool()
+        await bot.close()
+        logging.info(
+            f"Воркер {worker.worker_id} зупинено: виконано {worker.completed}, повторів {worker.retried}, "
+            f"dead letter {worker.dead}, втрачено оренд {worker.lost}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())